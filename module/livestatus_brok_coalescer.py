@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+During a check storm, a batch of broks often holds several check results
+and status updates of the same host or service. Each of them fully
+replaces the attributes it carries, so only the last one of each type
+matters to the regenerator: the earlier ones would be applied, indexed
+and assessed against the query cache for nothing.
+
+coalesce_broks drops these superseded broks from a batch. The others,
+and the order of all the broks kept, are left as they are.
+"""
+
+# The broks which only set some attributes of their host or service
+COALESCED_BROK_TYPES = (
+    'update_host_status',
+    'host_check_result',
+    'host_next_schedule',
+    'update_service_status',
+    'service_check_result',
+    'service_next_schedule',
+)
+
+# The broks after which none of the previous ones can be dropped
+BARRIER_BROK_TYPES = (
+    'program_status',
+    'clean_all_my_instance_id',
+    'initial_broks_done',
+)
+
+
+def object_key(brok):
+    """
+    The host name and service description of the object a (prepared)
+    brok is about, or None.
+    """
+    data = brok.data
+    if not isinstance(data, dict) or 'host_name' not in data:
+        return None
+    return (data['host_name'], data.get('service_description'))
+
+
+def coalesce_broks(broks):
+    """
+    Return the broks of a (prepared) batch without the status updates
+    superseded by a later brok of the same type about the same object.
+
+    Any other brok about this object (an initial status, a downtime, a
+    notification...) in between keeps both, as do the updates bringing a
+    topology change, which are not repeated by the next ones. The log
+    broks are not about an object and don't get in the way.
+    """
+    kept = []
+    pending = {}  # object key -> {brok type: position in kept}
+    for brok in broks:
+        key = object_key(brok)
+        if brok.type in COALESCED_BROK_TYPES and key is not None:
+            types = pending.setdefault(key, {})
+            pos = types.get(brok.type)
+            if pos is not None and not kept[pos].data.get('topology_change'):
+                kept[pos] = None
+            types[brok.type] = len(kept)
+        elif brok.type in BARRIER_BROK_TYPES:
+            pending.clear()
+        elif key is not None:
+            pending.pop(key, None)
+        kept.append(brok)
+    return [brok for brok in kept if brok is not None]
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import types
+
+from shinken.objects.host import Host
+from shinken.objects.service import Service
+
+from livestatus_regenerator import hinted_ids
+
+"""
+What a cached query result depends on, so that a status change of a host
+or service only invalidates the results it can affect.
+
+The dependencies of a result are a list of (table, attributes, ids):
+a change of one of the attributes (None: of any attribute) of one of the
+objects with these ids (None: of any object) of the table invalidates it.
+The attributes read by a column are found in the code of its mapping
+function. When this can't be known for sure (the function calls other
+functions or reads other objects), the result depends on any change.
+"""
+
+TABLES = {
+    'hosts': Host,
+    'services': Service,
+}
+
+# The attributes which refer to other hosts or services, whose status
+# changes don't come with the broks of the item itself
+RELATIONS = frozenset(['host', 'services', 'parents', 'childs', 'source_problems', 'impacts',
+                       'act_depend_of', 'chk_depend_of', 'act_depend_of_me', 'chk_depend_of_me',
+                       'parent_dependencies', 'child_dependencies'])
+
+# The columns of the configuration of the items, which no status brok
+# changes (a new configuration wipes the whole cache out)
+STATIC_COLUMNS = frozenset(['name', 'host_name', 'description', 'display_name', 'host_display_name',
+                            'alias', 'host_alias', 'address', 'host_address', 'groups', 'host_groups',
+                            'contacts', 'contact_groups', 'parents', 'childs', 'custom_variable_names',
+                            'custom_variable_values', 'custom_variables', 'notes', 'notes_url',
+                            'action_url', 'icon_image', 'business_impact', 'criticity'])
+
+# The functions the mapping functions may call without reading anything else
+BUILTINS = frozenset(['None', 'True', 'False', 'int', 'float', 'str', 'unicode', 'len', 'bool',
+                      'max', 'min', 'sum'])
+
+# The dependencies of the results which can't be tracked more precisely
+ANY_CHANGE = [('hosts', None, None), ('services', None, None)]
+
+_column_attributes = {}
+
+
+def object_table(obj):
+    if isinstance(obj, Host):
+        return 'hosts'
+    if isinstance(obj, Service):
+        return 'services'
+    return None
+
+
+def code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= code_names(const)
+    return names
+
+
+def column_attributes(cls, column):
+    """The attributes of an item read by one of its columns, or None"""
+    try:
+        return _column_attributes[(cls, column)]
+    except KeyError:
+        pass
+    attributes = None
+    if column in STATIC_COLUMNS:
+        _column_attributes[(cls, column)] = frozenset()
+        return frozenset()
+    function = getattr(getattr(cls, 'lsm_' + column, None), 'im_func', None)
+    # the redirections to other objects are closures
+    if function is not None and not function.func_closure:
+        attributes = code_names(function.func_code) - BUILTINS
+        for name in attributes:
+            if name in RELATIONS or \
+                    (name not in cls.properties and name not in cls.running_properties):
+                attributes = None
+                break
+    if attributes is not None:
+        attributes = frozenset(attributes)
+    _column_attributes[(cls, column)] = attributes
+    return attributes
+
+
+def query_dependencies(query):
+    """
+    The dependencies of the result of query (a LiveStatusQuery whose
+    columns are not yet rewritten for Stats:), or None if they are only
+    those of its cache category.
+    """
+    cls = TABLES.get(query.table)
+    if cls is None:
+        return None
+    if not query.columns and not query.stats_query:
+        # all the columns
+        return ANY_CHANGE
+    attributes = set()
+    for column in query.columns + query.filtercolumns + query.prefiltercolumns + \
+            query.stats_columns + list(query.stats_group_by):
+        read = column_attributes(cls, query.strip_table_from_column(column))
+        if read is None:
+            return ANY_CHANGE
+        attributes |= read
+    ids = hinted_ids(getattr(query.datamgr.rg, query.table), query.metainfo.query_hints)
+    if ids is not None:
+        ids = frozenset(ids)
+    return [(query.table, frozenset(attributes), ids)]
+
+
+def changed_attributes(brok, obj):
+    """The attributes of obj which brok changes"""
+    changed = set()
+    for name, value in brok.data.iteritems():
+        try:
+            if getattr(obj, name) != value:
+                changed.add(name)
+        except Exception:
+            changed.add(name)
+    return changed
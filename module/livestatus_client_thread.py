@@ -16,10 +16,12 @@ from .livestatus_obj import LiveStatus
 from .livestatus_response import LiveStatusListResponse
 from .livestatus_query_error import LiveStatusQueryError
 from .livestatus_response import LiveStatusResponse
+from .livestatus_request_buffer import LiveStatusRequestBuffer, RECV_SIZE
 
 #############################################################################
 
-RECV_SIZE = 8192
+# The responses are sent by chunks of at least this size:
+OUTPUT_BUFFER_SIZE = 65536
 
 #############################################################################
 
@@ -48,27 +50,40 @@ class Error:
 
 #############################################################################
 
-class LiveStatusClientThread(threading.Thread):
-    ''' A LiveStatus Client Thread will handle a full LS client connection.
+def make_client_livestatus(livestatus_broker):
+    ''' Create a LiveStatus instance suitable for serving clients outside of
+    the broker main thread: it has its own copy of the broker db (which has
+    to be opened in the thread which will use it) but shares the counters.
     '''
-    def __init__(self, client_sock, client_address, livestatus_broker):
+    broker = livestatus_broker
+    broker_db = copy.copy(broker.db)
+    broker_db.max_logs_age = 0
+    return LiveStatus(broker.datamgr, broker.query_cache,
+                      broker_db, broker.pnp_path, broker.from_q,
+                      counters=broker.livestatus.counters)
+
+
+class LiveStatusClient(object):
+    ''' A LiveStatus Client holds the state of one LS client connection:
+    its socket, its input buffer and the logic to read requests from it
+    and to send the responses back to it.
+    How the connection is driven (one thread per client or a shared
+    event loop) is left to the subclasses.
+    '''
+    def __init__(self, client_sock, client_address, livestatus_broker, livestatus=None):
         '''
         :param client_sock: The socket instance of the client.
         :param client_address:  The address of the client.
         :param livestatus_broker:
         :type livestatus_broker: .livestatus_broker.LiveStatus_broker
+        :param livestatus: The LiveStatus instance used to handle the requests.
         '''
-        super(LiveStatusClientThread, self).__init__()
         self.client_sock = client_sock
         self.client_address = client_address
-        broker = self.livestatus_broker = livestatus_broker
-        broker_db = copy.copy(broker.db)
-        broker_db.max_logs_age = 0
-        self.livestatus = LiveStatus(broker.datamgr, broker.query_cache,
-                                     broker_db, broker.pnp_path, broker.from_q,
-                                     counters=broker.livestatus.counters)
+        self.livestatus_broker = livestatus_broker
+        self.livestatus = livestatus
         self.stop_requested = False
-        self.buffer_list = []
+        self.request_buffer = LiveStatusRequestBuffer()
         now = time.time()
         self.start_time = now
         self.last_read = self.last_write = now
@@ -78,7 +93,7 @@ class LiveStatusClientThread(threading.Thread):
         self.requests_received = 0  # number of requests received
 
     def __str__(self):
-        return 'livestatus-th-%s nr=%s' % (self.ident, self.requests_received)
+        return 'livestatus-client-%s nr=%s' % (id(self), self.requests_received)
 
     def get_request(self):
         ''' Try to get the next request available in our input buffer.
@@ -87,90 +102,44 @@ class LiveStatusClientThread(threading.Thread):
         If none is yet fully available:
             -> returns None.
         '''
-        buf = b''
-        for idx, data in enumerate(self.buffer_list):
-            buf += data
-            endline = buf.find(b'\n\n')
-            sz = 2
-            if endline < 0:
-                endline = buf.find(b'\r\n\r\n')
-                sz = 4
-            if endline >= 0:
-                for di in range(idx):
-                    del self.buffer_list[0]
-                self.buffer_list[0] = self.buffer_list[0][endline + sz:]
-                if not self.buffer_list[0]:
-                    del self.buffer_list[0]
-                self.requests_received += 1
-                return buf[:endline + sz]
-        return None
+        request = self.request_buffer.get_request()
+        if request is not None:
+            self.requests_received += 1
+        return request
+
+    def get_unterminated_request(self):
+        ''' To be called once the client closed its side of the connection.
+        If we already got some data, AND it ends by a '\n', then returns it
+        so that it can be considered as a valid query, otherwise returns None.
+        '''
+        request = self.request_buffer.get_unterminated_request()
+        if request is not None:
+            self.logger.debug(
+                "Have a query not fully terminated but input closed by remote side.. "
+                "Let's consider this as a valid query and try process it..")
+        return request
 
     def _read(self, size=RECV_SIZE):
-        '''Read at most `size´ bytes of data.
-        :return: the data read.
+        '''Read at most `size´ bytes of data into our input buffer.
+        :return: the number of bytes read.
         '''
         try:
-            data = self.client_sock.recv(size)
+            received = self.request_buffer.recv_into(self.client_sock, size)
         except socket.error as err:
             if err.args[0] == errno.EWOULDBLOCK:
                 # but should not happen as we are in non-blocking mode..
-                return b''
+                return 0
             else:
                 raise Error.ClientReadError('Could not read from client: %s' % err)
-        if not data:
+        if not received:
             raise Error.client_left
         self.last_read = time.time()
-        return data
-
-    def read_request(self):
-        '''
-        :return: a full bytes buffer which should contain a valid LiveStatus request
-        '''
-
-        fds = [self.client_sock]
-        timeout_time = time.time() + self.read_timeout
-
-        request = self.get_request()  # there can be already buffered request
-        if request is not None:
-            return request
-
-        while not self.stop_requested:
-            inputready, _, exceptready = select.select(fds, [], [], 1)
-            if exceptready:
-                raise Error.client_error
-            if inputready:
-                try:
-                    data = self._read()
-                except Error.ClientLeft:
-                    # special case : if we already got some data,
-                    # AND it ends by a '\n' :
-                    if (self.buffer_list and self.buffer_list[-1]
-                            and self.buffer_list[-1][-1] == '\n'):
-                        # then try to consider it as a valid query
-                        self.logger.debug(
-                            "Have a query not fully terminated but input closed by remote side.. "
-                            "Let's consider this as a valid query and try process it..")
-                        ret = b''.join(self.buffer_list)
-                        del self.buffer_list[:]
-                        return ret
-                    # otherwise simply let the ClientLeft propagate:
-                    raise
-
-                self.buffer_list.append(data)
-                request = self.get_request()
-                if request is not None:
-                    self.last_query_time = time.time()
-                    return request
-                continue
-            if time.time() > timeout_time:
-                raise Error.ClientTimeout('Timeout reading full request from client')
-            timeout_time += self.read_timeout
-
-        raise Error.Interrupted('We have been interrupted')
+        return received
 
     def _send_data(self, data):
         if not data:
             return
+        counters = self.livestatus.counters
         fds = [self.client_sock]
         total_sent = 0
         len_data = len(data)
@@ -194,6 +163,8 @@ class LiveStatusClientThread(threading.Thread):
                     raise Error.ClientWriteError('Could not send response: %s' % err)
             if sent <= 0:
                 raise Error.client_left
+            counters.increment('output_syscalls')
+            counters.increment('output_bytes', sent)
             self.last_write = time.time()
             total_sent += sent
             if total_sent >= len_data:
@@ -203,29 +174,52 @@ class LiveStatusClientThread(threading.Thread):
         raise Error.interrupted
 
     def send_response(self, response):
+        ''' Send the response to the client.
+        The (possibly numerous and small) fragments of the response are
+        coalesced so that each send moves at least OUTPUT_BUFFER_SIZE bytes,
+        except for the last one.
+        '''
         if not isinstance(response, LiveStatusListResponse):
             response = [response]
+        pending = []
+        pending_len = 0
         for data in response:
-            self._send_data(data)
+            if not data:
+                continue
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            pending.append(data)
+            pending_len += len(data)
+            if pending_len >= OUTPUT_BUFFER_SIZE:
+                self._send_data(b''.join(pending))
+                del pending[:]
+                pending_len = 0
+        if pending:
+            self._send_data(b''.join(pending))
 
     def request_stop(self):
         self.stop_requested = True
 
+    def wait_query_done(self, wait):
+        ''' :return: True if the wait query condition is fulfilled or timed out. '''
+        if wait.condition_fulfilled():
+            return True
+        if wait.wait_timeout:
+            now = time.time()
+            if now - wait.wait_start > wait.wait_timeout:
+                return True
+        return False
+
     def handle_wait_query(self, wait, query):
         while not self.stop_requested:
-            if wait.condition_fulfilled():
+            if self.wait_query_done(wait):
                 break
-            elif wait.wait_timeout:
-                now = time.time()
-                if now - wait.wait_start > wait.wait_timeout:
-                    break
             time.sleep(1)
         else:
             raise Error.Interrupted
         output, _ = query.process_query()
         return output
 
-
     def handle_request(self, request_data):
         response, _ = self.livestatus.handle_request(request_data)
 
@@ -236,13 +230,76 @@ class LiveStatusClientThread(threading.Thread):
             if response:
                 self.send_response(response)
         except LiveStatusQueryError as err:
-            code, detail = err.args
-            response = LiveStatusResponse()
-            response.set_error(code, detail)
-            if 'fixed16' in request_data:
-                response.responseheader = 'fixed16'
-            output, _ = response.respond()
-            self.send_response(output)
+            self.send_error(err, request_data)
+
+    def send_error(self, err, request_data):
+        code, detail = err.args
+        response = LiveStatusResponse()
+        response.set_error(code, detail)
+        if 'fixed16' in request_data:
+            response.responseheader = 'fixed16'
+        output, _ = response.respond()
+        self.send_response(output)
+
+    def close(self):
+        try:
+            self.client_sock.shutdown(socket.SHUT_RDWR)
+        except Exception as err:
+            self.logger.warning('Error on client socket shutdown: %s', err)
+        try:
+            self.client_sock.close()
+        except Exception as err:
+            self.logger.warning('Error on client socket close: %s', err)
+
+#############################################################################
+
+class LiveStatusClientThread(LiveStatusClient, threading.Thread):
+    ''' A LiveStatus Client Thread will handle a full LS client connection.
+    '''
+    def __init__(self, client_sock, client_address, livestatus_broker):
+        threading.Thread.__init__(self)
+        LiveStatusClient.__init__(self, client_sock, client_address, livestatus_broker,
+                                  make_client_livestatus(livestatus_broker))
+
+    def __str__(self):
+        return 'livestatus-th-%s nr=%s' % (self.ident, self.requests_received)
+
+    def read_request(self):
+        '''
+        :return: a full bytes buffer which should contain a valid LiveStatus request
+        '''
+
+        fds = [self.client_sock]
+        timeout_time = time.time() + self.read_timeout
+
+        request = self.get_request()  # there can be already buffered request
+        if request is not None:
+            return request
+
+        while not self.stop_requested:
+            inputready, _, exceptready = select.select(fds, [], [], 1)
+            if exceptready:
+                raise Error.client_error
+            if inputready:
+                try:
+                    self._read()
+                except Error.ClientLeft:
+                    ret = self.get_unterminated_request()
+                    if ret is not None:
+                        return ret
+                    # otherwise simply let the ClientLeft propagate:
+                    raise
+
+                request = self.get_request()
+                if request is not None:
+                    self.last_query_time = time.time()
+                    return request
+                continue
+            if time.time() > timeout_time:
+                raise Error.ClientTimeout('Timeout reading full request from client')
+            timeout_time += self.read_timeout
+
+        raise Error.Interrupted('We have been interrupted')
 
     def run(self):
         assert isinstance(self.livestatus, LiveStatus)
@@ -255,21 +312,14 @@ class LiveStatusClientThread(threading.Thread):
         except Error.Interrupted:
             pass
         except Error.ClientLeft as err:
-            if self.buffer_list:
+            if self.request_buffer:
                 self.logger.error('Client left while some data remaining in input buffer: %s', err)
         except LiveStatusClientError as err:
             self.logger.error('LiveStatusClientError: %s', err)
         except Exception as err:
             self.logger.error('Unexpected error: %s ; traceback: %s', err, traceback.format_exc())
         finally:
-            try:
-                self.client_sock.shutdown(socket.SHUT_RDWR)
-            except Exception as err:
-                self.logger.warning('Error on client socket shutdown: %s', err)
-            try:
-                self.client_sock.close()
-            except Exception as err:
-                self.logger.warning('Error on client socket close: %s', err)
+            self.close()
             try:
                 self.livestatus.db.close()
             except Exception as err:
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import operator
+from array import array
+from itertools import compress, count, imap, repeat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from shinken.log import logger
+
+"""
+A columnar mirror of the hot status columns of hosts and services.
+
+Evaluating "Filter: state != 0" over 200000 services means 200000 calls
+of the filter function, each one reading attributes of a full Service
+object. A LiveStatusColumnStore keeps the values of a few numeric columns
+in typed arrays, one row per item in the sorted order of the collection
+(_id_heap), so that the comparisons of such filters are done with a few
+array operations: with numpy if it is installed, else with C level
+iterations of the itertools over array.array.
+
+A filter tree whose leaves are all comparisons of such columns with
+numbers is evaluated entirely on the arrays, and its result needs no
+further check. Otherwise the rows found are only candidates, like with
+the indexes (see livestatus_index).
+"""
+
+# The columns mirrored unless the columnar_columns parameter says otherwise.
+# Like the indexed columns, their values must not depend on the request.
+DEFAULT_COLUMNAR_COLUMNS = ('state', 'state_type', 'acknowledged', 'scheduled_downtime_depth',
+                            'last_check', 'has_been_checked', 'is_flapping')
+
+COMPARATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+# Numbers above this are not exactly represented by a double
+MAX_EXACT = 2 ** 53
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and -MAX_EXACT <= value <= MAX_EXACT
+
+
+class NumpyMasks(object):
+    """Row masks as numpy arrays of booleans"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def values(self, size):
+        return numpy.zeros(size, dtype=numpy.float64)
+
+    def rows(self, rows):
+        mask = numpy.zeros(self.size, dtype=bool)
+        mask[list(rows)] = True
+        return mask
+
+    def compare(self, values, op, reference):
+        return COMPARATORS[op](values, reference)
+
+    def union(self, a, b):
+        return a | b
+
+    def intersection(self, a, b):
+        return a & b
+
+    def difference(self, a, b):
+        return a & ~b
+
+    def complement(self, a):
+        return ~a
+
+    def equal(self, a, b):
+        return not (a ^ b).any()
+
+    def positions(self, mask):
+        return numpy.flatnonzero(mask).tolist()
+
+
+class SetMasks(object):
+    """Row masks as sets of row numbers"""
+
+    def __init__(self, size):
+        self.size = size
+        self.universe = frozenset(xrange(size))
+
+    def values(self, size):
+        return array('d', [0.0]) * size
+
+    def rows(self, rows):
+        return frozenset(rows)
+
+    def compare(self, values, op, reference):
+        return frozenset(compress(count(), imap(COMPARATORS[op], values, repeat(reference))))
+
+    def union(self, a, b):
+        return a | b
+
+    def intersection(self, a, b):
+        return a & b
+
+    def difference(self, a, b):
+        return a - b
+
+    def complement(self, a):
+        return self.universe - a
+
+    def equal(self, a, b):
+        return a == b
+
+    def positions(self, mask):
+        return sorted(mask)
+
+
+class LiveStatusColumnStore(object):
+    """
+    The values of some columns of a host or service collection, one row
+    per item in the order of _id_heap. The rows where the value of a column
+    isn't a number (None for example) are only known as unknown rows.
+    """
+
+    def __init__(self, collection, cls, columns=DEFAULT_COLUMNAR_COLUMNS):
+        self.ids = list(collection._id_heap)
+        self.rows = collection._id_heap_position
+        self.size = len(self.ids)
+        if numpy is not None:
+            self.masks = NumpyMasks(self.size)
+        else:
+            self.masks = SetMasks(self.size)
+        self.functions = {}
+        self.values = {}
+        self.unknown = {}
+        for column in columns:
+            function = getattr(getattr(cls, 'lsm_' + column, None), 'im_func', None)
+            if function is None:
+                logger.debug("[Livestatus Columns] %s has no column %s" % (cls.__name__, column))
+                continue
+            self.functions[column] = function
+            self.values[column] = self.masks.values(self.size)
+            self.unknown[column] = set()
+            for row, item_id in enumerate(self.ids):
+                self.set_value(column, row, collection.items[item_id])
+
+    def set_value(self, column, row, item):
+        function = self.functions[column]
+        try:
+            value = function(item, None)
+        except Exception:
+            # the filters compare the default value in this case
+            value = getattr(function, 'default', None)
+        if is_number(value):
+            self.values[column][row] = value
+            self.unknown[column].discard(row)
+        else:
+            self.unknown[column].add(row)
+
+    def item_updated(self, item):
+        row = self.rows.get(getattr(item, 'id', None))
+        if row is None or row >= self.size or self.ids[row] != item.id:
+            return
+        for column in self.functions:
+            self.set_value(column, row, item)
+
+    def evaluate(self, tree):
+        """
+        The masks (upper, lower) of the rows which can match, and which
+        surely match tree. None if the arrays don't tell anything.
+        """
+        masks = self.masks
+        kind = tree[0]
+        if kind == 'leaf':
+            op, column, reference = tree[1:]
+            if column not in self.values or op not in COMPARATORS or not is_number(reference):
+                return None
+            matching = masks.compare(self.values[column], op, reference)
+            unknown = self.unknown[column]
+            if not unknown:
+                return matching, matching
+            unknown = masks.rows(unknown)
+            return masks.union(matching, unknown), masks.difference(matching, unknown)
+        if kind == 'and':
+            children = [self.evaluate(child) for child in tree[1]]
+            known = [child for child in children if child is not None]
+            if not known:
+                return None
+            upper = reduce(masks.intersection, [child[0] for child in known])
+            if len(known) < len(children):
+                lower = masks.rows(())
+            else:
+                lower = reduce(masks.intersection, [child[1] for child in known])
+            return upper, lower
+        if kind == 'or':
+            children = [self.evaluate(child) for child in tree[1]]
+            if None in children:
+                return None
+            return (reduce(masks.union, [child[0] for child in children]),
+                    reduce(masks.union, [child[1] for child in children]))
+        if kind == 'not':
+            child = self.evaluate(tree[1])
+            if child is None:
+                return None
+            return masks.complement(child[1]), masks.complement(child[0])
+        return None
+
+    def candidates(self, tree):
+        """
+        Returns the ids (in sorted order) of the items which can match
+        tree, and whether they all surely match it. None if the arrays
+        can't be used for tree.
+        """
+        result = self.evaluate(tree)
+        if result is None:
+            return None, False
+        upper, lower = result
+        ids = self.ids
+        return [ids[row] for row in self.masks.positions(upper)], self.masks.equal(upper, lower)
@@ -36,7 +36,16 @@ class LiveStatusCounters:  # (LiveStatus):
             'host_checks': 0,
             'forks': 0,
             'log_message': 0,
-            'external_commands': 0
+            'external_commands': 0,
+            'output_bytes': 0,
+            'output_syscalls': 0,
+            'output_cache_hits': 0,
+            'coalesced_queries': 0,
+            'history_cache_hits': 0,
+            'plan_cache_hits': 0,
+            'plan_cache_misses': 0,
+            'broks_received': 0,
+            'broks_applied': 0
         }
         self.last_counters = {
             'neb_callbacks': 0,
@@ -45,7 +54,16 @@ class LiveStatusCounters:  # (LiveStatus):
             'host_checks': 0,
             'forks': 0,
             'log_message': 0,
-            'external_commands': 0
+            'external_commands': 0,
+            'output_bytes': 0,
+            'output_syscalls': 0,
+            'output_cache_hits': 0,
+            'coalesced_queries': 0,
+            'history_cache_hits': 0,
+            'plan_cache_hits': 0,
+            'plan_cache_misses': 0,
+            'broks_received': 0,
+            'broks_applied': 0
         }
         self.rate = {
             'neb_callbacks': 0.0,
@@ -54,16 +72,25 @@ class LiveStatusCounters:  # (LiveStatus):
             'host_checks': 0.0,
             'forks': 0.0,
             'log_message': 0.0,
-            'external_commands': 0.0
+            'external_commands': 0.0,
+            'output_bytes': 0.0,
+            'output_syscalls': 0.0,
+            'output_cache_hits': 0.0,
+            'coalesced_queries': 0.0,
+            'history_cache_hits': 0.0,
+            'plan_cache_hits': 0.0,
+            'plan_cache_misses': 0.0,
+            'broks_received': 0.0,
+            'broks_applied': 0.0
         }
         self.last_update = 0
         self.interval = 10
         self.rating_weight = 0.25
 
-    def increment(self, counter):
+    def increment(self, counter, value=1):
         if counter in self.counters:
             with self.lock:
-                self.counters[counter] += 1
+                self.counters[counter] += value
 
     def calc_rate(self):
         with self.lock:
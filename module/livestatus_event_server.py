@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import time
+import errno
+import fcntl
+import select
+import socket
+import threading
+import traceback
+import collections
+import Queue
+
+from shinken.log import logger
+
+from .livestatus_client_thread import (
+    Error,
+    LiveStatusClient,
+    LiveStatusClientError,
+    make_client_livestatus,
+)
+from .livestatus_query_error import LiveStatusQueryError
+
+#############################################################################
+
+# The event loop wakes up at least every POLL_TIMEOUT seconds,
+# and the workers recheck their pending wait queries at the same pace.
+POLL_TIMEOUT = 1
+
+#############################################################################
+
+
+class Poller(object):
+    ''' Minimal read-readiness poller over epoll, poll or select,
+    whichever is the best available on this platform.
+    '''
+    def __init__(self):
+        self.fds = set()
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+            self.poll = self._poll_epoll
+        elif hasattr(select, 'poll'):
+            self._poll = select.poll()
+            self.poll = self._poll_poll
+        else:
+            self.poll = self._poll_select
+
+    def register(self, fd):
+        if hasattr(self, '_epoll'):
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+        elif hasattr(self, '_poll'):
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+        self.fds.add(fd)
+
+    def unregister(self, fd):
+        if fd not in self.fds:
+            return
+        self.fds.discard(fd)
+        if hasattr(self, '_epoll'):
+            self._epoll.unregister(fd)
+        elif hasattr(self, '_poll'):
+            self._poll.unregister(fd)
+
+    def close(self):
+        if hasattr(self, '_epoll'):
+            self._epoll.close()
+        self.fds.clear()
+
+    # Errors and hang-ups are reported as readiness: the following
+    # recv() will then fail or return EOF, which is handled there.
+
+    def _poll_epoll(self, timeout):
+        try:
+            return [fd for fd, _ in self._epoll.poll(timeout)]
+        except IOError as err:
+            if err.errno != errno.EINTR:
+                raise
+            return []
+
+    def _poll_poll(self, timeout):
+        try:
+            return [fd for fd, _ in self._poll.poll(timeout * 1000)]
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def _poll_select(self, timeout):
+        fds = list(self.fds)
+        try:
+            inputready, _, exceptready = select.select(fds, [], fds, timeout)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+        return list(set(inputready + exceptready))
+
+
+#############################################################################
+
+
+class LiveStatusConnection(LiveStatusClient):
+    ''' A client connection driven by the LiveStatusEventServer.
+    It has no LiveStatus instance of its own: the worker serving
+    its current request lends it its own one.
+    '''
+    def __init__(self, client_sock, client_address, livestatus_broker):
+        super(LiveStatusConnection, self).__init__(client_sock, client_address, livestatus_broker)
+        self.fileno = client_sock.fileno()
+        self.registered = False
+        # set when the client closed its side after its last request:
+        self.closing = False
+        # (wait, query) of a wait query whose condition isn't fulfilled yet:
+        self.waiting = None
+        self.last_request = None
+        # when the client closed its side while its wait query was parked:
+        self.eof_time = None
+
+    def __str__(self):
+        return 'livestatus-conn-%s nr=%s' % (self.fileno, self.requests_received)
+
+    def handle_request(self, request_data):
+        self.last_request = request_data
+        super(LiveStatusConnection, self).handle_request(request_data)
+
+    def handle_wait_query(self, wait, query):
+        ''' Never block the worker: if the wait condition isn't fulfilled
+        yet, the query is parked and will be resumed later. '''
+        if self.wait_query_done(wait):
+            output, _ = query.process_query()
+            return output
+        self.waiting = (wait, query)
+        return None
+
+    def client_present(self):
+        ''' Check, without reading any request, the socket of a connection
+        whose wait query is parked, which the event loop doesn't watch.
+        :return: False if the client is gone, and the query can be dropped.
+
+        A closed or failed connection (POLLHUP/POLLERR, which a unix socket
+        reports once the client closed it) is gone at once. A client which
+        only closed its sending side may still wait for the response, but
+        over TCP it looks the same as a client which closed the connection:
+        it is then given at most read_timeout seconds more.
+        '''
+        sock = self.client_sock
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(self.fileno, select.POLLIN | select.POLLPRI)
+            events = 0
+            for _, event in poller.poll(0):
+                events |= event
+            if events & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                return False
+            if not events:
+                return True
+        elif not select.select([sock], [], [], 0)[0]:
+            return True
+        try:
+            data = sock.recv(1, socket.MSG_PEEK)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            return False
+        if data:
+            # a pipelined request, handled once the wait query is done
+            return True
+        if self.eof_time is None:
+            self.eof_time = time.time()
+        return time.time() - self.eof_time <= self.read_timeout
+
+    def resume_wait_query(self):
+        wait, query = self.waiting
+        if not self.wait_query_done(wait):
+            return
+        self.waiting = None
+        try:
+            output, _ = query.process_query()
+            if output:
+                self.send_response(output)
+        except LiveStatusQueryError as err:
+            self.send_error(err, self.last_request)
+
+
+#############################################################################
+
+
+class LiveStatusWorker(threading.Thread):
+    ''' A query worker: executes the requests posted by the event loop
+    with its own LiveStatus instance (and so its own db connection).
+    '''
+    def __init__(self, server, num):
+        super(LiveStatusWorker, self).__init__(name='livestatus-worker-%d' % num)
+        self.server = server
+        self.livestatus = make_client_livestatus(server.livestatus_broker)
+        # connections with a pending wait query, rechecked periodically:
+        self.waiting = []
+        self.next_recheck = 0
+
+    def run(self):
+        self.livestatus.db.open()
+        try:
+            while not self.server.stop_requested:
+                try:
+                    conn, request = self.server.requests.get(True, POLL_TIMEOUT)
+                except Queue.Empty:
+                    pass
+                else:
+                    self.serve(conn, request)
+                if self.waiting and time.time() >= self.next_recheck:
+                    self.next_recheck = time.time() + POLL_TIMEOUT
+                    waiting, self.waiting = self.waiting, []
+                    for conn in waiting:
+                        if conn.client_present():
+                            self.serve(conn)
+                        else:
+                            self.drop(conn)
+        except Exception as err:
+            logger.error('[Livestatus Worker] Unexpected error: %s ; traceback: %s',
+                         err, traceback.format_exc())
+        finally:
+            try:
+                self.livestatus.db.close()
+            except Exception as err:
+                logger.warning('[Livestatus Worker] Error on close database: %s', err)
+
+    def drop(self, conn):
+        ''' Give up the parked wait query of a connection whose client left. '''
+        logger.debug('[Livestatus Worker] %s left during its wait query', conn)
+        conn.waiting = None
+        conn.livestatus = None
+        self.server.release(conn, False)
+
+    def serve(self, conn, request=None):
+        ''' Handle `request´ on `conn´, or resume its pending wait query if
+        `request´ is None, then any other request already buffered for it.
+        Once done, hand the connection back to the event loop. '''
+        conn.livestatus = self.livestatus
+        keep = True
+        try:
+            if request is None:
+                conn.resume_wait_query()
+            else:
+                conn.handle_request(request)
+            while conn.waiting is None and not conn.closing:
+                request = conn.get_request()
+                if request is None:
+                    break
+                conn.handle_request(request)
+        except Error.ClientLeft:
+            keep = False
+        except LiveStatusClientError as err:
+            logger.error('[Livestatus Worker] LiveStatusClientError: %s', err)
+            keep = False
+        except Exception as err:
+            logger.error('[Livestatus Worker] Unexpected error: %s ; traceback: %s',
+                         err, traceback.format_exc())
+            keep = False
+        if keep and conn.waiting is not None:
+            self.waiting.append(conn)
+            return
+        conn.livestatus = None
+        self.server.release(conn, keep and not conn.closing)
+
+
+#############################################################################
+
+
+class LiveStatusEventServer(object):
+    ''' Serve all the livestatus clients from one I/O loop.
+
+    The loop owns the listening and client sockets. Once a full request has
+    been read from a client, the client is removed from the poller and the
+    request is posted to a fixed-size pool of LiveStatusWorker threads.
+    The worker sends the response back, then releases the client to the
+    loop which watches it again for its next request.
+    '''
+    def __init__(self, livestatus_broker, workers=8):
+        self.livestatus_broker = livestatus_broker
+        self.nb_workers = max(1, workers)
+        self.workers = []
+        self.connections = {}  # keys are fileno of clients, values are LiveStatusConnection
+        self.requests = Queue.Queue()
+        self.released = collections.deque()
+        self.poller = None
+        self.stop_requested = False
+        self._wakeup_r = self._wakeup_w = None
+
+    def run(self):
+        broker = self.livestatus_broker
+        self.poller = Poller()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self._wakeup_r)
+        listeners = {}
+        for s in broker.listeners:
+            listeners[s.fileno()] = s
+            self.poller.register(s.fileno())
+
+        for num in range(self.nb_workers):
+            worker = LiveStatusWorker(self, num)
+            worker.start()
+            self.workers.append(worker)
+        logger.info("[Livestatus Broker] event loop server started with %d workers", self.nb_workers)
+
+        try:
+            while not broker.interrupted and not self.stop_requested:
+                for fd in self.poller.poll(POLL_TIMEOUT):
+                    if fd == self._wakeup_r:
+                        self._drain_wakeup()
+                    elif fd in listeners:
+                        self.accept(listeners[fd])
+                    else:
+                        conn = self.connections.get(fd)
+                        if conn is not None and conn.registered:
+                            self.handle_readable(conn)
+                self.rearm_connections()
+        except Exception as err:
+            logger.error('[Livestatus Broker] Unexpected error in event loop: %s ; traceback: %s',
+                         err, traceback.format_exc())
+        finally:
+            self.stop()
+
+    def accept(self, listener):
+        sock, address = self.livestatus_broker.accept_client(listener)
+        if sock is None:
+            return
+        conn = LiveStatusConnection(sock, address, self.livestatus_broker)
+        self.connections[conn.fileno] = conn
+        self.watch(conn)
+
+    def watch(self, conn):
+        conn.registered = True
+        self.poller.register(conn.fileno)
+
+    def unwatch(self, conn):
+        conn.registered = False
+        self.poller.unregister(conn.fileno)
+
+    def handle_readable(self, conn):
+        try:
+            conn._read()
+        except Error.ClientLeft as err:
+            request = conn.get_unterminated_request()
+            if request is None:
+                if conn.request_buffer:
+                    logger.error('Client left while some data remaining in input buffer: %s', err)
+                self.close_connection(conn)
+                return
+            conn.closing = True
+        except LiveStatusClientError as err:
+            logger.error('LiveStatusClientError: %s', err)
+            self.close_connection(conn)
+            return
+        else:
+            request = conn.get_request()
+            if request is None:
+                return
+            conn.last_query_time = time.time()
+        # the connection is not watched while a worker owns it:
+        self.unwatch(conn)
+        self.requests.put((conn, request))
+
+    def release(self, conn, keep):
+        ''' Called by the workers once done with a connection. '''
+        self.released.append((conn, keep))
+        try:
+            os.write(self._wakeup_w, b'x')
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def rearm_connections(self):
+        while self.released:
+            conn, keep = self.released.popleft()
+            if keep and not self.stop_requested:
+                self.watch(conn)
+            else:
+                self.close_connection(conn)
+
+    def close_connection(self, conn):
+        self.connections.pop(conn.fileno, None)
+        if conn.registered:
+            self.unwatch(conn)
+        conn.close()
+
+    def stop(self):
+        self.stop_requested = True
+        for conn in self.connections.values():
+            conn.request_stop()
+        for worker in self.workers:
+            worker.join()
+        del self.workers[:]
+        for conn in self.connections.values():
+            self.close_connection(conn)
+        self.released.clear()
+        self.poller.close()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
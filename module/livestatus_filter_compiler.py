@@ -0,0 +1,256 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+from shinken.log import logger
+from mapping import table_class_map
+from livestatus_query_error import LiveStatusQueryError
+
+"""
+The closures built by LiveStatusQuery.make_converted_filter look up
+their lsm_ accessor with getattr() on each call, and LiveStatusStack
+wraps them again for each And:, Or: and Negate:. Evaluating a filter
+tree thus costs several Python frames per predicate and object.
+
+A LiveStatusFilterProgram instead turns the operations recorded on a
+filter stack into Python source: one function per element left on the
+stack, where the comparisons are inlined, the references are constants
+and, for objects of the table's class, the accessors and their default
+values are resolved in advance. Objects of any other class take the
+generic path, which is the code of the closures. Both paths keep their
+semantics: default value fallback, 450 errors and evaluation order.
+"""
+
+COMPARISONS = {'=': '==', '!=': '!=', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+NEGATIONS = {'!~': '~', '!=~': '=~', '!~~': '~~'}
+TRUE = ('true',)
+
+
+def combine(op, children):
+    """An 'and' or 'or' node, with the children in evaluation order"""
+    flat = []
+    for child in children:
+        if child[0] == op:
+            # (a and b) and c evaluates exactly like a and b and c
+            flat.extend(child[1])
+        else:
+            flat.append(child)
+    return (op, flat)
+
+
+def build_filter_trees(program, conjoin=False):
+    """
+    Replay the operations of a filter stack program (see
+    LiveStatusQuery.run_stack_operation) like LiveStatusStack would,
+    but on trees. Returns the trees left on the stack, bottom first.
+    With conjoin, they are anded into one, like the Filter: stack is
+    before the query is executed.
+    """
+    stack = []
+
+    def pop():
+        if stack:
+            return stack.pop()
+        return TRUE
+
+    for operation in program:
+        op = operation[0]
+        if op == 'put':
+            stack.append(('leaf',) + tuple(operation[1:]))
+        elif op == 'and' or op == 'or':
+            num = operation[1]
+            if num > 1:
+                children = [pop() for _ in range(num)]
+                if op == 'or':
+                    # LiveStatusStack.or_elements also tries them in reverse order
+                    children.reverse()
+                stack.append(combine(op, children))
+        elif op == 'not':
+            stack.append(('not', pop()))
+    if conjoin and len(stack) > 1:
+        stack = [combine('and', [pop() for _ in range(len(stack))])]
+    return stack
+
+
+def indent(lines):
+    return ['    ' + line for line in lines]
+
+
+class LiveStatusFilterProgram(object):
+    """
+    The compiled form of the program of one filter stack. It doesn't
+    depend on a particular query, so it can be kept with the query plan.
+    If the trees can't be compiled (too deeply nested for example),
+    factory is None and the caller has to build the closures.
+    """
+
+    def __init__(self, table, program, conjoin=False):
+        self.cls = table_class_map.get(table, (None, None))[1]
+        self.trees = build_filter_trees(program, conjoin)
+        self.constants = {
+            'LiveStatusQueryError': LiveStatusQueryError,
+            're': re,
+            'K': self.cls,
+        }
+        self.source = None
+        self.factory = None
+        try:
+            self.source = self.generate()
+            code = compile(self.source, '<livestatus filter>', 'exec')
+            namespace = dict(self.constants)
+            exec code in namespace
+            self.factory = namespace['make']
+        except Exception, exp:
+            logger.debug("[Livestatus Filter Compiler] falling back to closures: %s" % exp)
+
+    def make_filters(self, query):
+        """Return the filter functions for query, bottom of the stack first"""
+        return self.factory(query)
+
+    def constant(self, prefix, value):
+        name = '%s%d' % (prefix, len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def generate(self):
+        lines = ['def make(req):']
+        names = []
+        for tree in self.trees:
+            name = 'f%d' % len(names)
+            names.append(name)
+            body = self.generate_node(tree) + ['return r']
+            lines.extend(indent(['def %s(item):' % name] + indent(body)))
+        lines.extend(indent(['return [%s]' % ', '.join(names)]))
+        return '\n'.join(lines) + '\n'
+
+    def generate_node(self, node):
+        kind = node[0]
+        if kind == 'true':
+            return ['r = True']
+        if kind == 'not':
+            return self.generate_node(node[1]) + ['r = not r']
+        if kind == 'leaf':
+            return self.generate_leaf(*node[1:])
+        # and: stop at the first false child, or: at the first true one
+        stop = kind == 'and' and 'if not r:' or 'if r:'
+        body = []
+        for child in node[1][:-1]:
+            body.extend(self.generate_node(child))
+            body.extend([stop, '    break'])
+        body.extend(self.generate_node(node[1][-1]))
+        body.append('break')
+        return ['while 1:'] + indent(body) + ['r = not not r']
+
+    def generate_leaf(self, operator, attribute, reference):
+        if operator == 'dummy':
+            return ['r = True']
+        negate = operator in NEGATIONS
+        operator = NEGATIONS.get(operator, operator)
+        attribute = 'lsm_' + attribute
+        names = {
+            'attr': self.constant('n', attribute),
+            'column': self.constant('e', attribute.replace('lsm_', '')),
+            'ref': self.constant('c', reference),
+        }
+        if operator in ('~', '~~'):
+            flags = operator == '~~' and re.I or 0
+            try:
+                names['pattern'] = self.constant('p', re.compile(str(reference), flags))
+            except Exception:
+                # raise the 450 while filtering, like the closure does
+                names['pattern'] = 're.compile(str(%s)%s)' % (names['ref'], flags and ', re.I' or '')
+        elif operator == '=~':
+            try:
+                names['lower'] = self.constant('l', reference.lower())
+            except Exception:
+                names['lower'] = '%s.lower()' % names['ref']
+
+        generic = dict(names,
+                       value='getattr(item, %(attr)s)(req)' % names,
+                       default='getattr(item.__class__, %(attr)s).im_func.default' % names,
+                       datatype='getattr(item, %(attr)s).im_func.datatype' % names)
+        lines = self.generate_comparison(operator, generic, True)
+
+        function = getattr(getattr(self.cls, attribute, None), 'im_func', None)
+        if function is not None:
+            resolved = dict(names, value='%s(item, req)' % self.constant('a', function))
+            if hasattr(function, 'default'):
+                resolved['default'] = self.constant('d', function.default)
+            else:
+                resolved['default'] = generic['default']
+            if hasattr(function, 'datatype'):
+                resolved['is_list'] = function.datatype == list
+            else:
+                resolved['datatype'] = generic['datatype']
+            lines = (['if item.__class__ is K:'] +
+                     indent(self.generate_comparison(operator, resolved, False)) +
+                     ['else:'] + indent(lines))
+        if negate:
+            lines.append('r = not r')
+        return lines
+
+    def generate_comparison(self, operator, names, check_attribute):
+        if operator in ('~', '~~'):
+            return [
+                'try:',
+                '    r = %(pattern)s.search(%(value)s)' % names,
+                'except Exception:',
+                '    raise LiveStatusQueryError(450, %(column)s)' % names,
+            ]
+        if operator == '=~':
+            test = '%(value)s.lower() == %(lower)s' % names
+            fallback = '%(default)s == %(ref)s' % names
+        elif operator in COMPARISONS:
+            names = dict(names, op=COMPARISONS[operator])
+            test = '%(value)s %(op)s %(ref)s' % names
+            fallback = '%(default)s %(op)s %(ref)s' % names
+        else:
+            raise ValueError("wrong operation %s" % operator)
+        if operator == '>=' and 'is_list' in names:
+            if names['is_list']:
+                body = ['r = %(ref)s in %(value)s' % names]
+            else:
+                body = ['r = %s' % test]
+        elif operator == '>=':
+            body = [
+                'if %(datatype)s == list:' % names,
+                '    r = %(ref)s in %(value)s' % names,
+                'else:',
+                '    r = %s' % test,
+            ]
+        else:
+            body = ['r = %s' % test]
+        lines = ['try:'] + indent(body) + ['except Exception:']
+        if check_attribute:
+            lines.extend(indent([
+                'if hasattr(item, %(attr)s):' % names,
+                '    r = %s' % fallback,
+                'else:',
+                '    raise LiveStatusQueryError(450, %(column)s)' % names,
+            ]))
+        else:
+            # objects of the table class always have the attribute
+            lines.append('    r = %s' % fallback)
+        return lines
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import heapq
+
+from shinken.util import get_obj_full_name
+
+"""
+The regenerator keeps, for each collection of items, the list of their
+ids in the order of their full names (_id_heap), the position of each id
+in it (_id_heap_position), and lookup tables from a name (of a contact,
+a group, a host...) to the ids of the items which have it, in the same
+order (_id_contact_heap, _id_by_host_name_heap...).
+
+Rebuilding all of these with each new configuration means computing and
+sorting the names of every item several times. Instead, they are updated
+with the items added to or removed from the collection since the last
+time. The lists are replaced, not modified in place, as queries may be
+walking through them meanwhile.
+
+With a new configuration, this is done in a ShadowCollection, so that the
+queries keep using the previous structures until all are updated.
+"""
+
+# The attributes of a collection which are the structures for the queries,
+# or needed to update them
+SHADOWED_ATTRIBUTES = ('_id_heap', '_id_heap_position', '_id_contact_heap', '_id_by_host_name_heap',
+                       '_id_by_service_name_heap', '_id_by_hostgroup_name_heap', '_id_by_servicegroup_name_heap',
+                       '_visibility', '_indexes', '_columns', '_state_counters',
+                       '_indexed_items', '_id_heap_keys', '_sort_keys', '_lookup_names', '_changed_ids',
+                       '_member_ids', '_groups_of_member', '_group_contacts')
+
+# Up to this number of added or removed items, the ids are inserted into
+# and deleted from _id_heap one by one. Above, they are merged with it.
+MERGE_THRESHOLD = 64
+
+
+def item_changes(collection):
+    """
+    The ids of the items added to and removed from collection since the
+    last call. An item replaced by another one with the same id is both.
+    """
+    indexed = getattr(collection, '_indexed_items', None) or {}
+    items = collection.items
+    removed = [id for id, item in indexed.iteritems() if items.get(id) is not item]
+    added = [id for id, item in items.iteritems() if indexed.get(id) is not item]
+    collection._indexed_items = dict(items)
+    return added, removed
+
+
+def forget_items(collection):
+    """Make the next update rebuild everything of collection from scratch"""
+    for attr in ('_indexed_items', '_id_heap_keys', '_sort_keys', '_lookup_names',
+                 '_member_ids', '_groups_of_member', '_group_contacts'):
+        if hasattr(collection, attr):
+            delattr(collection, attr)
+
+
+def update_id_heap(collection, added, removed):
+    """Update _id_heap and _id_heap_position of collection"""
+    if not hasattr(collection, '_id_heap_keys'):
+        collection._id_heap = []
+        collection._id_heap_keys = []
+        collection._sort_keys = {}
+    ids = list(collection._id_heap)
+    keys = list(collection._id_heap_keys)
+    sort_keys = collection._sort_keys
+    if len(removed) <= MERGE_THRESHOLD:
+        for id in removed:
+            pos = bisect.bisect_left(keys, sort_keys.pop(id))
+            del ids[pos]
+            del keys[pos]
+    else:
+        removed = set(removed)
+        for id in removed:
+            del sort_keys[id]
+        ids = [id for id in ids if id not in removed]
+        keys = [sort_keys[id] for id in ids]
+    for id in added:
+        sort_keys[id] = (get_obj_full_name(collection.items[id]), id)
+    if len(added) <= MERGE_THRESHOLD:
+        for id in added:
+            pos = bisect.bisect_left(keys, sort_keys[id])
+            ids.insert(pos, id)
+            keys.insert(pos, sort_keys[id])
+    else:
+        new_keys = sorted([sort_keys[id] for id in added])
+        keys = list(heapq.merge(keys, new_keys))
+        ids = [id for _, id in keys]
+    collection._id_heap_keys = keys
+    collection._id_heap = ids
+    collection._id_heap_position = dict([(id, pos) for (pos, id) in enumerate(ids)])
+
+
+def insert_by_position(ids, id, position):
+    """Insert id into the list ids, sorted by position"""
+    pos = position[id]
+    if not ids or position[ids[-1]] < pos:
+        ids.append(id)
+        return
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if position[ids[mid]] < pos:
+            lo = mid + 1
+        else:
+            hi = mid
+    ids.insert(lo, id)
+
+
+def update_lookups(collection, lookups, item_names, added, removed, visibilities=None):
+    """
+    Update the lookup tables of collection (the names of its attributes in
+    lookups, which tell whether each name has a list of ids or a unique
+    id), for the added and removed items. item_names(item) is the list of
+    (lookup, name) under which an item is found. visibilities maps lookups
+    to the LiveStatusVisibility which mirrors them, if any.
+    """
+    visibilities = visibilities or {}
+    if not hasattr(collection, '_lookup_names'):
+        collection._lookup_names = {}
+        for lookup in lookups:
+            setattr(collection, lookup, {})
+    lookup_names = collection._lookup_names
+    position = collection._id_heap_position
+    # the new lists of ids, replacing the old ones once complete
+    lists = {}
+
+    def ids_list(lookup, name):
+        ids = lists.get((lookup, name))
+        if ids is None:
+            ids = lists[(lookup, name)] = list(getattr(collection, lookup).get(name, ()))
+        return ids
+
+    for id in removed:
+        for lookup, name in lookup_names.pop(id, ()):
+            if lookups[lookup]:
+                if getattr(collection, lookup).get(name) == id:
+                    del getattr(collection, lookup)[name]
+            else:
+                ids_list(lookup, name).remove(id)
+            if lookup in visibilities:
+                visibilities[lookup].discard(name, id)
+    for visibility in visibilities.itervalues():
+        for id in removed:
+            visibility.remove_item(id)
+    for id in sorted(added, key=position.__getitem__):
+        names = lookup_names[id] = list(set(item_names(collection.items[id])))
+        for lookup, name in names:
+            if lookups[lookup]:
+                getattr(collection, lookup)[name] = id
+            else:
+                insert_by_position(ids_list(lookup, name), id, position)
+            if lookup in visibilities:
+                visibilities[lookup].add(name, id)
+    for (lookup, name), ids in lists.iteritems():
+        if ids:
+            getattr(collection, lookup)[name] = ids
+        else:
+            getattr(collection, lookup).pop(name, None)
+
+
+def group_contacts(member_ids, contacts_of, strict, everyone):
+    """
+    The contacts of a group: with strict, those of all of its members,
+    else those of any of them. contacts_of(id) are the contacts of the
+    member id. Each member counts for each of its contacts, so that this
+    costs the number of its memberships, and not contacts x members.
+    """
+    if strict and not member_ids:
+        return everyone
+    counts = {}
+    for id in member_ids:
+        for contact in contacts_of(id):
+            counts[contact] = counts.get(contact, 0) + 1
+    if strict:
+        return frozenset([contact for contact, count in counts.iteritems() if count == len(member_ids)])
+    return frozenset(counts)
+
+
+def update_group_contacts(groups, contacts_of, strict, everyone, changed_members, visibility):
+    """
+    Update the _id_contact_heap of the groups (the ids of the groups each
+    contact may see, see group_contacts) and their visibility, for the
+    groups which were added or removed, whose members changed, or which
+    have a member among changed_members (whose contacts may have changed).
+    The members and the contacts of each group are kept from the last time.
+    """
+    if not hasattr(groups, '_group_contacts'):
+        groups._member_ids = {}
+        groups._groups_of_member = {}
+        groups._group_contacts = {}
+        groups._id_contact_heap = {}
+    member_ids = groups._member_ids
+    groups_of_member = groups._groups_of_member
+    contacts = groups._group_contacts
+    # the groups to compute again
+    dirty = set([id for id in member_ids if id not in groups.items])
+    for id, group in groups.items.iteritems():
+        ids = frozenset([member.id for member in group.members])
+        if member_ids.get(id) != ids or (strict and not ids):
+            dirty.add(id)
+    for member in changed_members:
+        dirty.update(groups_of_member.get(member, ()))
+
+    heap = groups._id_contact_heap
+    position = groups._id_heap_position
+    lists = {}
+
+    def ids_list(contact):
+        ids = lists.get(contact)
+        if ids is None:
+            ids = lists[contact] = list(heap.get(contact, ()))
+        return ids
+
+    for id in sorted(dirty, key=lambda id: position.get(id, -1)):
+        group = groups.items.get(id)
+        old_ids = member_ids.pop(id, frozenset())
+        for member in old_ids:
+            groups_of_member[member].discard(id)
+            if not groups_of_member[member]:
+                del groups_of_member[member]
+        old = contacts.pop(id, frozenset())
+        new = frozenset()
+        if group is not None:
+            ids = member_ids[id] = frozenset([member.id for member in group.members])
+            for member in ids:
+                groups_of_member.setdefault(member, set()).add(id)
+            new = contacts[id] = group_contacts(ids, contacts_of, strict, everyone)
+        for contact in old - new:
+            ids_list(contact).remove(id)
+            visibility.discard(contact, id)
+        for contact in new - old:
+            insert_by_position(ids_list(contact), id, position)
+            visibility.add(contact, id)
+    for id in dirty:
+        if id not in groups.items:
+            visibility.remove_item(id)
+    for contact, ids in lists.iteritems():
+        if ids:
+            heap[contact] = ids
+        else:
+            heap.pop(contact, None)
+
+
+class ShadowCollection(object):
+    """
+    Stands for a collection while its structures are updated: it shares its
+    items, and has copies of its structures which can be modified without
+    the queries noticing. install() then puts them in place of those of the
+    collection with a single update of its attributes.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.items = collection.items
+        for attr in SHADOWED_ATTRIBUTES:
+            value = getattr(collection, attr, None)
+            if value is None:
+                continue
+            if attr == '_groups_of_member':
+                value = dict([(id, set(groups)) for id, groups in value.iteritems()])
+            elif hasattr(value, 'copy'):
+                # the dicts, and the visibility which copies its parts on write
+                value = value.copy()
+            elif isinstance(value, list):
+                value = list(value)
+            setattr(self, attr, value)
+
+    def install(self):
+        attributes = dict([(attr, getattr(self, attr)) for attr in SHADOWED_ATTRIBUTES if hasattr(self, attr)])
+        self.collection.__dict__.update(attributes)
+        for attr in SHADOWED_ATTRIBUTES:
+            if attr not in attributes and hasattr(self.collection, attr):
+                delattr(self.collection, attr)
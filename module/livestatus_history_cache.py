@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+import tempfile
+import threading
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from shinken.log import logger
+
+"""
+The log queries of a time interval which lies entirely in the past (see
+CACHE_IRREVERSIBLE_HISTORY) always get the same answer. Availability
+reports send such queries over months of logs, which are expensive to
+compute. Their formatted responses are kept in files, so that they are
+computed only once, even across restarts of the broker.
+"""
+
+# The memory the cached responses can use on disk unless history_cache_size says otherwise
+DEFAULT_HISTORY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# The seconds to wait after the end of a time interval before keeping the
+# response about it, unless history_cache_margin says otherwise. The logs
+# of its last moments may still be on their way to the logstore until then.
+DEFAULT_HISTORY_CACHE_MARGIN = 300
+
+SUFFIX = '.cache'
+
+
+class LiveStatusHistoryCache(object):
+    """
+    A directory of cached responses, keyed by query fingerprint (see
+    livestatus_query_plan), whose total size is bounded. Whenever it is
+    exceeded, the responses used least recently are deleted. The time of
+    the last use of a response is the modification time of its file.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_HISTORY_CACHE_MAX_BYTES, margin=DEFAULT_HISTORY_CACHE_MARGIN):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        # file name -> [size, time of last use]
+        self.entries = {}
+        self.size = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in os.listdir(path):
+            if not name.endswith(SUFFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            self.entries[name] = [stat.st_size, stat.st_mtime]
+            self.size += stat.st_size
+        logger.info("[Livestatus History Cache] %d cached responses (%d bytes) in %s",
+                    len(self.entries), self.size, path)
+
+    def keeps(self, metainfo):
+        """
+        Whether the response to a query of the past can be kept: its time
+        interval must have ended at least margin seconds ago, and it must
+        not involve the current groups of the hosts and services, which
+        change with the configuration.
+        """
+        if metainfo.chapter_end is None or metainfo.chapter_end > time.time() - self.margin:
+            return False
+        return not [c for c in metainfo.columns + metainfo.filter_columns if c.startswith('current_')]
+
+    def file_name(self, fingerprint):
+        if isinstance(fingerprint, unicode):
+            fingerprint = fingerprint.encode('utf-8')
+        return sha1(fingerprint).hexdigest() + SUFFIX
+
+    def get(self, fingerprint):
+        """The cached response of the query, or None"""
+        name = self.file_name(fingerprint)
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            path = os.path.join(self.path, name)
+            try:
+                f = open(path, 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                os.utime(path, None)
+            except (IOError, OSError), exp:
+                logger.warning("[Livestatus History Cache] Can't read %s: %s", path, exp)
+                self.forget(name)
+                self.misses += 1
+                return None
+            entry[1] = os.stat(path).st_mtime
+        # the fingerprint of the query is stored first, in case of a hash collision
+        if isinstance(fingerprint, unicode):
+            fingerprint = fingerprint.encode('utf-8')
+        header, _, response = data.partition('\0')
+        if header != fingerprint:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return response
+
+    def put(self, fingerprint, response):
+        if isinstance(fingerprint, unicode):
+            fingerprint = fingerprint.encode('utf-8')
+        size = len(fingerprint) + 1 + len(response)
+        if size > self.max_bytes:
+            return
+        name = self.file_name(fingerprint)
+        with self.lock:
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(fingerprint + '\0')
+                    f.write(response)
+                finally:
+                    f.close()
+                # the file appears complete or not at all
+                os.rename(tmp, os.path.join(self.path, name))
+            except (IOError, OSError), exp:
+                logger.warning("[Livestatus History Cache] Can't write %s: %s", name, exp)
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                return
+            self.forget(name)
+            self.entries[name] = [size, os.stat(os.path.join(self.path, name)).st_mtime]
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = min(self.entries, key=lambda n: self.entries[n][1])
+                self.remove(oldest)
+
+    def forget(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry[0]
+
+    def remove(self, name):
+        self.forget(name)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
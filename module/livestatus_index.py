@@ -0,0 +1,413 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+from shinken.log import logger
+
+
+"""
+Secondary indexes on the host and service collections.
+
+The hints of LiveStatusQueryMetainfo only narrow a scan for a few fixed
+query shapes (one host, one hostgroup...). A LiveStatusIndex maps the
+values of one column to the ids of the items having this value, so that
+a query with for example "Filter: state = 2" only has to look at the
+items in state 2. The indexes are built by the regenerator once all the
+objects are linked, and kept current when broks update the objects.
+
+An index only preselects candidates: the whole filter is still applied
+to them. So an index must never miss an item which the filter could
+accept, which is why items whose value can't be indexed are kept aside
+and always returned as candidates.
+"""
+
+# The columns indexed unless the indexed_columns parameter says otherwise.
+DEFAULT_INDEXED_COLUMNS = ('state', 'state_type', 'acknowledged',
+                           'scheduled_downtime_depth', 'check_command', 'contact_groups',
+                           'name', 'host_name', 'description', 'groups', 'host_groups')
+
+# The columns indexed_columns can name. Their values must only depend on
+# the item itself, or on what changes with a new configuration only: not
+# on the request (pnpgraph_present...), the time (in_check_period...) or
+# the status of other objects (host_state, num_services...).
+INDEXABLE_COLUMNS = DEFAULT_INDEXED_COLUMNS + (
+    'contacts', 'display_name', 'alias', 'address', 'has_been_checked', 'is_flapping',
+    'notifications_enabled', 'active_checks_enabled', 'accept_passive_checks', 'checks_enabled',
+    'last_hard_state', 'host_address', 'host_alias', 'host_display_name')
+
+# These are the collections of LiveStatusRegenerator which can be indexed
+INDEXED_TABLES = ('hosts', 'services')
+
+NOT_INDEXABLE = None
+EMPTY = frozenset()
+
+# Above this share of the collection, walking the candidate ids is
+# not worth it compared to a plain scan.
+FULL_SCAN_RATIO = 0.5
+# An And: child whose candidates are this much more numerous than the
+# candidates found so far is left to the filter.
+INTERSECT_RATIO = 8
+
+
+class LiveStatusIndex(object):
+    """
+    A hash index of the items of a collection by the value of one column.
+    A scalar column is looked up for "Filter: column = value", a list
+    column (contact_groups for example) for "Filter: column >= value".
+    """
+
+    def __init__(self, column, function):
+        self.column = column
+        self.function = function
+        self.multivalued = getattr(function, 'datatype', None) == list
+        self.operator = self.multivalued and '>=' or '='
+        self.postings = {}    # value -> set of item ids
+        self.unindexed = set()  # ids of the items without usable value
+        self.keys = {}        # item id -> the values it is indexed with
+
+    def __len__(self):
+        """The number of distinct values"""
+        return len(self.postings)
+
+    def item_keys(self, item):
+        """The values of item for this column, like a filter sees them"""
+        try:
+            value = self.function(item, None)
+        except Exception:
+            # the filters compare the default value in this case
+            try:
+                value = self.function.default
+            except AttributeError:
+                return NOT_INDEXABLE
+        if self.multivalued:
+            if not isinstance(value, (list, tuple, set, frozenset)):
+                return NOT_INDEXABLE
+            keys = tuple(value)
+        else:
+            keys = (value,)
+        try:
+            for key in keys:
+                hash(key)
+        except TypeError:
+            return NOT_INDEXABLE
+        return keys
+
+    def add(self, item_id, item):
+        keys = self.item_keys(item)
+        self.keys[item_id] = keys
+        if keys is NOT_INDEXABLE:
+            self.unindexed.add(item_id)
+        else:
+            for key in keys:
+                self.postings.setdefault(key, set()).add(item_id)
+
+    def remove(self, item_id):
+        keys = self.keys.pop(item_id, NOT_INDEXABLE)
+        if keys is NOT_INDEXABLE:
+            self.unindexed.discard(item_id)
+            return
+        for key in keys:
+            ids = self.postings.get(key)
+            if ids is not None:
+                ids.discard(item_id)
+                if not ids:
+                    del self.postings[key]
+
+    def update(self, item_id, item):
+        """Reindex an item after its attributes were changed"""
+        if item_id not in self.keys:
+            # not known when the index was built
+            return
+        if self.item_keys(item) == self.keys[item_id]:
+            return
+        self.remove(item_id)
+        self.add(item_id, item)
+
+    def supports(self, operator):
+        """Whether the index can find the items matching column operator value"""
+        return operator == self.operator or (operator == '!=' and not self.multivalued)
+
+    def matching(self, value):
+        """The ids of the items which have value. Not to be modified"""
+        try:
+            return self.postings.get(value, EMPTY)
+        except TypeError:
+            # an unhashable value can't be in the postings
+            return EMPTY
+
+    def lookup(self, value):
+        """A new set with the ids of the items which can have value"""
+        return self.matching(value) | self.unindexed
+
+    def cardinality(self, value):
+        """The (maximal) number of ids lookup(value) returns"""
+        return len(self.matching(value)) + len(self.unindexed)
+
+
+def indexable(column):
+    """Whether column is one of INDEXABLE_COLUMNS, else say it is ignored"""
+    if column in INDEXABLE_COLUMNS:
+        return True
+    logger.warning("[Livestatus Index] The column %s can't be indexed, ignored" % column)
+    return False
+
+
+class LiveStatusIndexRegistry(object):
+    """
+    The secondary indexes of the collections of a LiveStatusRegenerator.
+    The indexes of a collection are installed as its _indexes attribute,
+    a dict with the column names as keys.
+    """
+
+    def __init__(self, columns=DEFAULT_INDEXED_COLUMNS):
+        columns = [column for column in columns if indexable(column)]
+        self.columns = {}
+        for table in INDEXED_TABLES:
+            self.columns[table] = list(columns)
+        self.collections = {}
+
+    def register(self, table, column):
+        """Index one more column of a table. Effective with the next build"""
+        if indexable(column) and column not in self.columns[table]:
+            self.columns[table].append(column)
+
+    def build(self, table, collection, cls, owner=None):
+        """
+        (Re)build all the indexes of a collection. If it is the shadow of
+        another one (owner) while rebuilt, item_updated updates the indexes
+        of the owner.
+        """
+        indexes = {}
+        by_function = {}
+        for column in self.columns[table]:
+            function = getattr(getattr(cls, 'lsm_' + column, None), 'im_func', None)
+            if function is None:
+                logger.debug("[Livestatus Index] %s has no column %s, not indexed" % (table, column))
+                continue
+            if function in by_function:
+                # an alias (host_name and name of the hosts table for example)
+                indexes[column] = by_function[function]
+                continue
+            index = LiveStatusIndex(column, function)
+            for item_id, item in collection.items.iteritems():
+                index.add(item_id, item)
+            indexes[column] = by_function[function] = index
+        setattr(collection, '_indexes', indexes)
+        self.collections[cls] = collection if owner is None else owner
+
+    def item_updated(self, item):
+        """Keep the indexes current after a brok updated item"""
+        collection = self.collections.get(item.__class__)
+        if collection is None:
+            return
+        item_id = getattr(item, 'id', None)
+        for index in set(collection._indexes.itervalues()):
+            index.update(item_id, item)
+
+
+class IndexPlan(object):
+    """
+    A node of the plan for a filter tree. It knows two sets of ids:
+    upper(), the items which can match the node, and lower(), items which
+    surely match it (needed to negate a node). estimate is the expected
+    size of upper(), lower_estimate the one of lower(). describe() tells
+    how the node is answered, for the execution plan of the query.
+    """
+
+
+class IndexLookup(IndexPlan):
+    """A Filter: column operator value, answered by an index"""
+
+    def __init__(self, planner, index, operator, value):
+        self.planner = planner
+        self.index = index
+        self.operator = operator
+        self.value = value
+        matching = len(index.matching(value))
+        if operator == '!=':
+            self.estimate = planner.size - matching
+            self.lower_estimate = max(0, self.estimate - len(index.unindexed))
+        else:
+            self.estimate = matching + len(index.unindexed)
+            self.lower_estimate = matching
+
+    def upper(self):
+        if self.operator == '!=':
+            return self.planner.universe() - self.index.matching(self.value)
+        if self.index.unindexed:
+            return self.index.lookup(self.value)
+        return self.index.matching(self.value)
+
+    def lower(self):
+        if self.operator == '!=':
+            return self.planner.universe() - self.index.matching(self.value) - self.index.unindexed
+        return self.index.matching(self.value)
+
+    def describe(self):
+        return '%s %s %r (~%d)' % (self.index.column, self.operator, self.value, self.estimate)
+
+
+class IndexIntersection(IndexPlan):
+    """An And: node. Only the children worth it are intersected, and if
+    some children can't be planned, lower() is empty."""
+
+    def __init__(self, children, complete):
+        children.sort(key=lambda child: child.estimate)
+        self.children = [children[0]]
+        estimate = children[0].estimate
+        for child in children[1:]:
+            if child.estimate > INTERSECT_RATIO * estimate:
+                break
+            self.children.append(child)
+        self.complete = complete
+        self.estimate = estimate
+        if complete:
+            self.lower_estimate = min([child.lower_estimate for child in children])
+        else:
+            self.lower_estimate = 0
+        self.all_children = children
+
+    def upper(self):
+        ids = self.children[0].upper()
+        for child in self.children[1:]:
+            if not ids:
+                break
+            ids = ids & child.upper()
+        return ids
+
+    def lower(self):
+        if not self.complete:
+            return EMPTY
+        ids = self.all_children[0].lower()
+        for child in self.all_children[1:]:
+            if not ids:
+                break
+            ids = ids & child.lower()
+        return ids
+
+    def describe(self):
+        return 'and(%s)' % ', '.join([child.describe() for child in self.children])
+
+
+class IndexUnion(IndexPlan):
+    """An Or: node whose children all have a plan"""
+
+    def __init__(self, planner, children):
+        self.children = children
+        self.estimate = min(planner.size, sum([child.estimate for child in children]))
+        self.lower_estimate = max([child.lower_estimate for child in children])
+
+    def upper(self):
+        ids = set()
+        for child in self.children:
+            ids |= child.upper()
+        return ids
+
+    def lower(self):
+        ids = set()
+        for child in self.children:
+            ids |= child.lower()
+        return ids
+
+    def describe(self):
+        return 'or(%s)' % ', '.join([child.describe() for child in self.children])
+
+
+class IndexComplement(IndexPlan):
+    """A Negate: node"""
+
+    def __init__(self, planner, child):
+        self.planner = planner
+        self.child = child
+        self.estimate = planner.size - child.lower_estimate
+        self.lower_estimate = planner.size - child.estimate
+
+    def upper(self):
+        return self.planner.universe() - self.child.lower()
+
+    def lower(self):
+        return self.planner.universe() - self.child.upper()
+
+    def describe(self):
+        return 'not(%s)' % self.child.describe()
+
+
+class LiveStatusIndexPlanner(object):
+    """
+    Find the candidates of a filter tree (see build_filter_trees) in the
+    indexes of a collection. The estimates of the index cardinalities tell
+    which lookups are combined. The filter itself is still applied to the
+    candidates, so a part of the tree which is not planned only costs
+    its evaluation on them.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.indexes = getattr(collection, '_indexes', {})
+        self.size = len(collection._id_heap)
+        self._universe = None
+
+    def universe(self):
+        if self._universe is None:
+            self._universe = frozenset(self.collection._id_heap_position)
+        return self._universe
+
+    def plan(self, tree):
+        """The IndexPlan for tree, or None if it can match any item"""
+        kind = tree[0]
+        if kind == 'leaf':
+            operator, attribute, reference = tree[1:]
+            index = self.indexes.get(attribute)
+            if index is None or not index.supports(operator):
+                return None
+            return IndexLookup(self, index, operator, reference)
+        if kind == 'and':
+            children = [self.plan(child) for child in tree[1]]
+            planned = [child for child in children if child is not None]
+            if not planned:
+                return None
+            return IndexIntersection(planned, len(planned) == len(children))
+        if kind == 'or':
+            children = [self.plan(child) for child in tree[1]]
+            if None in children:
+                return None
+            return IndexUnion(self, children)
+        if kind == 'not':
+            child = self.plan(tree[1])
+            if child is None:
+                return None
+            return IndexComplement(self, child)
+        return None
+
+    def candidates(self, tree):
+        """
+        Returns the candidate ids (None for a scan of the whole collection)
+        and a description of the decision.
+        """
+        plan = self.plan(tree)
+        if plan is None:
+            return None, 'full scan of %d (no index)' % self.size
+        if plan.estimate > FULL_SCAN_RATIO * self.size:
+            return None, 'full scan of %d (%s)' % (self.size, plan.describe())
+        ids = plan.upper()
+        return ids, 'index %s: %d of %d' % (plan.describe(), len(ids), self.size)
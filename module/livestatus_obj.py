@@ -139,5 +139,5 @@ class LiveStatus(object):
         logger.debug("[Livestatus] Request duration %.4fs" % (time.time() - request.tic))
         return output, keepalive
 
-    def count_event(self, counter):
-        self.counters.increment(counter)
+    def count_event(self, counter, value=1):
+        self.counters.increment(counter, value)
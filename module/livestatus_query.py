@@ -32,7 +32,13 @@ from mapping import table_class_map, find_filter_converter, list_livestatus_attr
 from livestatus_response import LiveStatusResponse
 from livestatus_stack import LiveStatusStack
 from livestatus_constraints import LiveStatusConstraints
-from livestatus_query_metainfo import LiveStatusQueryMetainfo
+from livestatus_query_metainfo import LiveStatusQueryMetainfo, CACHE_ROWS, CACHE_IRREVERSIBLE_HISTORY
+from livestatus_query_plan import LiveStatusQueryPlan, normalize_query
+from livestatus_filter_compiler import LiveStatusFilterProgram
+from livestatus_index import LiveStatusIndexPlanner
+from livestatus_stats import LiveStatusStatsAccumulator
+from livestatus_cache_dependencies import query_dependencies
+from livestatus_regenerator import hinted_ids
 from livestatus_response import Separators
 from livestatus_query_error import LiveStatusQueryError
 
@@ -96,8 +102,26 @@ class LiveStatusQuery(object):
         # filter- and count-operations
         self.filter_stack = LiveStatusStack()
         self.stats_filter_stack = LiveStatusStack()
-        self.stats_postprocess_stack = LiveStatusStack()
         self.stats_query = False
+        # The operations for these stacks, and the aggregates of the Stats:
+        # lines (see statsify_result), recorded while parsing
+        self.stack_programs = {
+            'filter_stack': [],
+            'stats_filter_stack': [],
+            'stats_postprocess_stack': [],
+        }
+        # The compiled programs, shared with the query plan
+        self.compiled_filters = {}
+        # Records the parsing of this query, so it can be replayed
+        self.plan = None
+        # How the items were searched (see index_candidates)
+        self.execution_plan = None
+        # The entry of the query cache holding the result of this query
+        self.cached_response = None
+        # The normalized text of the query (see livestatus_query_plan)
+        self.fingerprint = None
+        # Whether the execution of the query failed
+        self.failed = False
 
         # When was this query launched?
         self.tic = time.time()
@@ -141,145 +165,251 @@ class LiveStatusQuery(object):
         """Parse the lines of a livestatus request.
 
         This function looks for keywords in input lines and
-        sets the attributes of the request object
+        sets the attributes of the request object.
+        If an identical query (apart from per-request headers like
+        Localtime:) was parsed before, its plan is replayed instead.
 
         """
-        for line in data.splitlines():
-            line = line.strip()
-            # Tools like NagVis send KEYWORK:option, and we prefer to have
-            # a space following the:
-            if ':' in line and not ' ' in line:
-                line = line.replace(':', ': ')
-            keyword = line.split(' ')[0].rstrip(':')
-            if keyword == 'GET':  # Get the name of the base table
-                _, self.table = self.split_command(line)
-                if self.table not in table_class_map.keys():
-                    raise LiveStatusQueryError(404, self.table)
-            elif keyword == 'Columns':  # Get the names of the desired columns
-                _, self.columns = self.split_option_with_columns(line)
-                self.response.columnheaders = 'off'
-            elif keyword == 'ResponseHeader':
-                _, responseheader = self.split_option(line)
-                self.response.responseheader = responseheader
-            elif keyword == 'OutputFormat':
-                _, outputformat = self.split_option(line)
-                self.response.outputformat = outputformat
-            elif keyword == 'KeepAlive':
-                _, keepalive = self.split_option(line)
-                self.response.keepalive = keepalive
-            elif keyword == 'ColumnHeaders':
-                _, columnheaders = self.split_option(line)
-                self.response.columnheaders = columnheaders
-            elif keyword == 'Limit':
-                _, self.limit = self.split_option(line)
-            elif keyword == 'AuthUser':
-                if self.table in ['hosts', 'hostgroups', 'services', 'servicegroups', 'hostsbygroup', 'servicesbygroup', 'servicesbyhostgroup']:
-                    _, self.authuser = self.split_option(line)
-                # else self.authuser stays None and will be ignored
-            elif keyword == 'Filter':
+        fingerprint, plan_lines, request_lines = normalize_query(data)
+        self.fingerprint = fingerprint
+        plan_cache = getattr(self.query_cache, 'plan_cache', None)
+        if plan_cache is not None:
+            plan = plan_cache.get(fingerprint)
+        else:
+            plan = None
+        if plan is not None:
+            self.counters.increment('plan_cache_hits')
+            plan.apply(self, data)
+        else:
+            self.counters.increment('plan_cache_misses')
+            self.plan = LiveStatusQueryPlan()
+            self.compiled_filters = self.plan.compiled_filters
+            for line in plan_lines:
+                self.parse_line(line)
+            self.metainfo = LiveStatusQueryMetainfo(data)
+            self.plan.freeze(self)
+            if plan_cache is not None:
+                plan_cache.put(fingerprint, self.plan)
+        for line in request_lines:
+            self.parse_line(line)
+        self.build_filter_stacks()
+
+    def parse_line(self, line):
+        """Parse one (normalized) line of a livestatus request."""
+        keyword = line.split(' ')[0].rstrip(':')
+        if keyword == 'GET':  # Get the name of the base table
+            _, self.table = self.split_command(line)
+            if self.table not in table_class_map.keys():
+                raise LiveStatusQueryError(404, self.table)
+        elif keyword == 'Columns':  # Get the names of the desired columns
+            _, self.columns = self.split_option_with_columns(line)
+            self.response.columnheaders = 'off'
+        elif keyword == 'ResponseHeader':
+            _, responseheader = self.split_option(line)
+            self.response.responseheader = responseheader
+        elif keyword == 'OutputFormat':
+            _, outputformat = self.split_option(line)
+            self.response.outputformat = outputformat
+        elif keyword == 'KeepAlive':
+            _, keepalive = self.split_option(line)
+            self.response.keepalive = keepalive
+        elif keyword == 'ColumnHeaders':
+            _, columnheaders = self.split_option(line)
+            self.response.columnheaders = columnheaders
+        elif keyword == 'Limit':
+            _, self.limit = self.split_option(line)
+        elif keyword == 'AuthUser':
+            if self.table in ['hosts', 'hostgroups', 'services', 'servicegroups', 'hostsbygroup', 'servicesbygroup', 'servicesbyhostgroup']:
+                _, self.authuser = self.split_option(line)
+            # else self.authuser stays None and will be ignored
+        elif keyword == 'Filter':
+            try:
+                _, attribute, operator, reference = self.split_option(line, 3)
+            except ValueError as err:
                 try:
-                    _, attribute, operator, reference = self.split_option(line, 3)
+                    _, attribute, operator, reference = self.split_option(line, 2) + ['']
                 except ValueError as err:
-                    try:
-                        _, attribute, operator, reference = self.split_option(line, 2) + ['']
-                    except ValueError as err:
-                        raise LiveStatusQueryError(452, 'invalid Filter header')
-                if operator in ['=', '>', '>=', '<', '<=', '=~', '~', '~~', '!=', '!>', '!>=', '!<', '!<=', '!=~', '!~', '!~~']:
-                    # Cut off the table name
-                    attribute = self.strip_table_from_column(attribute)
-                    # Some operators can simply be negated
-                    if operator in ['!>', '!>=', '!<', '!<=']:
-                        operator = {'!>': '<=', '!>=': '<', '!<': '>=', '!<=': '>'}[operator]
-                    # Put a function on top of the filter_stack which implements
-                    # the desired operation
-                    self.filtercolumns.append(attribute)
-                    self.prefiltercolumns.append(attribute)
-                    self.filter_stack.put_stack(self.make_filter(operator, attribute, reference))
-                    if self.table == 'log':
-                        self.db.add_filter(operator, attribute, reference)
-                else:
-                    logger.warning("[Livestatus Query] Illegal operation: %s" % str(operator))
-                    pass  # illegal operation
-            elif keyword == 'And':
-                _, andnum = self.split_option(line)
-                # Take the last andnum functions from the stack
-                # Construct a new function which makes a logical and
-                # Put the function back onto the stack
-                self.filter_stack.and_elements(andnum)
-                if self.table == 'log':
-                    self.db.add_filter_and(andnum)
-            elif keyword == 'Or':
-                _, ornum = self.split_option(line)
-                # Take the last ornum functions from the stack
-                # Construct a new function which makes a logical or
-                # Put the function back onto the stack
-                self.filter_stack.or_elements(ornum)
-                if self.table == 'log':
-                    self.db.add_filter_or(ornum)
-            elif keyword == 'Negate':
-                self.filter_stack.not_elements()
+                    raise LiveStatusQueryError(452, 'invalid Filter header')
+            if operator in ['=', '>', '>=', '<', '<=', '=~', '~', '~~', '!=', '!>', '!>=', '!<', '!<=', '!=~', '!~', '!~~']:
+                # Cut off the table name
+                attribute = self.strip_table_from_column(attribute)
+                # Some operators can simply be negated
+                if operator in ['!>', '!>=', '!<', '!<=']:
+                    operator = {'!>': '<=', '!>=': '<', '!<': '>=', '!<=': '>'}[operator]
+                # Put a function on top of the filter_stack which implements
+                # the desired operation
+                self.filtercolumns.append(attribute)
+                self.prefiltercolumns.append(attribute)
+                self.put_filter('filter_stack', operator, attribute, reference)
                 if self.table == 'log':
-                    self.db.add_filter_not()
-            elif keyword == 'StatsGroupBy':
-                _, stats_group_by = self.split_option_with_columns(line)
-                self.filtercolumns.extend(stats_group_by)
-                self.stats_group_by.extend(stats_group_by)
-                # Deprecated. If your query contains at least one Stats:-header
-                # then Columns: has the meaning of the old StatsGroupBy: header
-            elif keyword == 'Stats':
-                self.stats_query = True
-                try:
-                    _, attribute, operator, reference = self.split_option(line, 3)
-                    if attribute in ['sum', 'min', 'max', 'avg', 'std'] and reference.startswith('as '):
-                        attribute, operator = operator, attribute
-                        _, alias = reference.split(' ')
-                        self.aliases.append(alias)
-                    elif attribute in ['sum', 'min', 'max', 'avg', 'std'] and reference == '=':
-                        # Workaround for thruk-cmds like: Stats: sum latency =
-                        attribute, operator = operator, attribute
-                        reference = ''
-                except Exception:
-                    _, attribute, operator = self.split_option(line, 3)
-                    if attribute in ['sum', 'min', 'max', 'avg', 'std']:
-                        attribute, operator = operator, attribute
+                    self.db_call('add_filter', operator, attribute, reference)
+            else:
+                logger.warning("[Livestatus Query] Illegal operation: %s" % str(operator))
+                pass  # illegal operation
+        elif keyword == 'And':
+            _, andnum = self.split_option(line)
+            # Take the last andnum functions from the stack
+            # Construct a new function which makes a logical and
+            # Put the function back onto the stack
+            self.stack_operation('filter_stack', ('and', andnum))
+            if self.table == 'log':
+                self.db_call('add_filter_and', andnum)
+        elif keyword == 'Or':
+            _, ornum = self.split_option(line)
+            # Take the last ornum functions from the stack
+            # Construct a new function which makes a logical or
+            # Put the function back onto the stack
+            self.stack_operation('filter_stack', ('or', ornum))
+            if self.table == 'log':
+                self.db_call('add_filter_or', ornum)
+        elif keyword == 'Negate':
+            self.stack_operation('filter_stack', ('not',))
+            if self.table == 'log':
+                self.db_call('add_filter_not')
+        elif keyword == 'StatsGroupBy':
+            _, stats_group_by = self.split_option_with_columns(line)
+            self.filtercolumns.extend(stats_group_by)
+            self.stats_group_by.extend(stats_group_by)
+            # Deprecated. If your query contains at least one Stats:-header
+            # then Columns: has the meaning of the old StatsGroupBy: header
+        elif keyword == 'Stats':
+            self.stats_query = True
+            try:
+                _, attribute, operator, reference = self.split_option(line, 3)
+                if attribute in ['sum', 'min', 'max', 'avg', 'std'] and reference.startswith('as '):
+                    attribute, operator = operator, attribute
+                    _, alias = reference.split(' ')
+                    self.aliases.append(alias)
+                elif attribute in ['sum', 'min', 'max', 'avg', 'std'] and reference == '=':
+                    # Workaround for thruk-cmds like: Stats: sum latency =
+                    attribute, operator = operator, attribute
                     reference = ''
-                attribute = self.strip_table_from_column(attribute)
-                if operator in ['=', '>', '>=', '<', '<=', '=~', '~', '~~', '!=', '!>', '!>=', '!<', '!<=', '!=~', '!~', '!~~']:
-                    if operator in ['!>', '!>=', '!<', '!<=']:
-                        operator = {'!>': '<=', '!>=': '<', '!<': '>=', '!<=': '>'}[operator]
-                    self.filtercolumns.append(attribute)
-                    self.stats_columns.append(attribute)
-                    self.stats_filter_stack.put_stack(self.make_filter(operator, attribute, reference))
-                    self.stats_postprocess_stack.put_stack(self.make_filter('count', attribute, None))
-                elif operator in ['sum', 'min', 'max', 'avg', 'std']:
-                    self.stats_columns.append(attribute)
-                    self.stats_filter_stack.put_stack(self.make_filter('dummy', attribute, None))
-                    self.stats_postprocess_stack.put_stack(self.make_filter(operator, attribute, None))
-                else:
-                    logger.warning("[Livestatus Query] Illegal operation: %s" % str(operator))
-                    pass  # illegal operation
-            elif keyword == 'StatsAnd':
-                _, andnum = self.split_option(line)
-                self.stats_filter_stack.and_elements(andnum)
-            elif keyword == 'StatsOr':
-                _, ornum = self.split_option(line)
-                self.stats_filter_stack.or_elements(ornum)
-            elif keyword == 'Separators':
-                separators = map(lambda sep: chr(int(sep)), line.split(' ', 5)[1:])
-                self.response.separators = Separators(*separators)
-            elif keyword == 'Localtime':
-                _, self.client_localtime = self.split_option(line)
-            elif keyword == 'COMMAND':
-                _, self.extcmd = line.split(' ', 1)
+            except Exception:
+                _, attribute, operator = self.split_option(line, 3)
+                if attribute in ['sum', 'min', 'max', 'avg', 'std']:
+                    attribute, operator = operator, attribute
+                reference = ''
+            attribute = self.strip_table_from_column(attribute)
+            if operator in ['=', '>', '>=', '<', '<=', '=~', '~', '~~', '!=', '!>', '!>=', '!<', '!<=', '!=~', '!~', '!~~']:
+                if operator in ['!>', '!>=', '!<', '!<=']:
+                    operator = {'!>': '<=', '!>=': '<', '!<': '>=', '!<=': '>'}[operator]
+                self.filtercolumns.append(attribute)
+                self.stats_columns.append(attribute)
+                self.put_filter('stats_filter_stack', operator, attribute, reference)
+                self.put_filter('stats_postprocess_stack', 'count', attribute, None)
+            elif operator in ['sum', 'min', 'max', 'avg', 'std']:
+                self.stats_columns.append(attribute)
+                self.put_filter('stats_filter_stack', 'dummy', attribute, None)
+                self.put_filter('stats_postprocess_stack', operator, attribute, None)
             else:
-                # This line is not valid or not implemented
-                logger.error("[Livestatus Query] Received a line of input which i can't handle: '%s'" % line)
-                pass
-        self.metainfo = LiveStatusQueryMetainfo(data)
+                logger.warning("[Livestatus Query] Illegal operation: %s" % str(operator))
+                pass  # illegal operation
+        elif keyword == 'StatsAnd':
+            _, andnum = self.split_option(line)
+            self.stack_operation('stats_filter_stack', ('and', andnum))
+        elif keyword == 'StatsOr':
+            _, ornum = self.split_option(line)
+            self.stack_operation('stats_filter_stack', ('or', ornum))
+        elif keyword == 'Separators':
+            separators = map(lambda sep: chr(int(sep)), line.split(' ', 5)[1:])
+            self.response.separators = Separators(*separators)
+        elif keyword == 'Localtime':
+            _, self.client_localtime = self.split_option(line)
+        elif keyword == 'COMMAND':
+            _, self.extcmd = line.split(' ', 1)
+        else:
+            # This line is not valid or not implemented
+            logger.error("[Livestatus Query] Received a line of input which i can't handle: '%s'" % line)
+            pass
+
+    def put_filter(self, stack_name, operator, attribute, reference):
+        """Put a filter function on top of one of the filter stacks"""
+        if reference is not None:
+            reference = self.convert_reference(attribute, reference)
+        self.stack_operation(stack_name, ('put', operator, attribute, reference))
+
+    def stack_operation(self, stack_name, operation):
+        """Record an operation for one of the filter stacks.
+        The stacks are filled once the whole query is parsed."""
+        self.stack_programs[stack_name].append(operation)
+
+    def build_filter_stacks(self):
+        """Fill the filter stacks from the recorded operations.
+
+        The Filter: and Stats: conditions are compiled into one function per
+        stack element (see LiveStatusFilterProgram). The Filter: elements are
+        anded at once. The programs which can't be compiled are built with the
+        closures of make_converted_filter. The operations for the Stats:
+        postprocessors only describe the aggregates (see statsify_result).
+        """
+        for stack_name in ('filter_stack', 'stats_filter_stack'):
+            stack = getattr(self, stack_name)
+            program = self.stack_programs[stack_name]
+            conjoin = stack_name == 'filter_stack'
+            compiled = None
+            if program:
+                compiled = self.compiled_filters.get(stack_name)
+                if compiled is None:
+                    compiled = LiveStatusFilterProgram(self.table, program, conjoin)
+                    self.compiled_filters[stack_name] = compiled
+            if compiled is not None and compiled.factory is not None:
+                for filter_func in compiled.make_filters(self):
+                    stack.put_stack(filter_func)
+            else:
+                for operation in program:
+                    self.run_stack_operation(stack_name, operation)
+                if conjoin:
+                    stack.and_elements(stack.qsize())
+
+    def run_stack_operation(self, stack_name, operation):
+        stack = getattr(self, stack_name)
+        op = operation[0]
+        if op == 'put':
+            stack.put_stack(self.make_converted_filter(*operation[1:]))
+        elif op == 'and':
+            stack.and_elements(operation[1])
+        elif op == 'or':
+            stack.or_elements(operation[1])
+        elif op == 'not':
+            stack.not_elements()
+
+    def db_call(self, method, *args):
+        """Pass a filter to the log db and record it in the plan"""
+        if self.plan is not None:
+            self.plan.record_db_call(method, *args)
+        getattr(self.db, method)(*args)
 
     def process_query(self):
+        history = getattr(self.query_cache, 'history', None)
+        if history is None or self.metainfo.cache_category != CACHE_IRREVERSIBLE_HISTORY or \
+                not history.keeps(self.metainfo):
+            history = None
+        else:
+            output = history.get(self.fingerprint)
+            if output is not None:
+                # This report of the past was already computed, maybe
+                # before the last restart
+                self.response.output.append(output)
+                self.counters.increment('history_cache_hits')
+                return self.response.respond()
         result = self.launch_query()
-        self.response.format_live_data(result, self.columns, self.aliases)
+        cached = self.cached_response
+        if cached is not None and 'output' in cached:
+            # The same query was already answered with the same result
+            self.response.output.append(cached['output'])
+            self.counters.increment('output_cache_hits')
+        else:
+            self.response.format_live_data(result, self.columns, self.aliases)
+            keep_output = cached is not None and self.query_cache.cache_outputs
+            keep_history = history is not None and not self.failed
+            if keep_output or keep_history:
+                output = self.response.output.join()
+                self.response.output.clean()
+                self.response.output.append(output)
+                if keep_output:
+                    self.query_cache.cache_output(self.metainfo, cached, output)
+                if keep_history:
+                    history.put(self.fingerprint, output)
         return self.response.respond()
 
     def launch_query(self):
@@ -294,12 +424,60 @@ class LiveStatusQuery(object):
 
         # Ask the cache if this request was already answered under the same
         # circumstances. (And f not, whether this query is cacheable at all)
-        cacheable, cache_hit, cached_response = self.query_cache.get_cached_query(self.metainfo)
+        stamp = None
+        if self.query_cache.enabled:
+            stamp = self.row_stamp()
+        cacheable, cache_hit, cached_response = self.query_cache.get_cached_query(self.metainfo, stamp)
         if cache_hit:
+            self.cached_response = cached_response
             self.columns = cached_response['columns']
             self.response.columnheaders = cached_response['columnheaders']
             return cached_response['result']
 
+        # Wait for an identical query which is already being executed
+        coalescer = getattr(self.query_cache, 'coalescer', None)
+        if coalescer is None or not self.fingerprint:
+            return self.execute_query(cacheable, stamp)
+        leader, flight = coalescer.join(self.fingerprint)
+        if not leader:
+            shared = flight.wait()
+            if shared is None:
+                # The execution failed, try again
+                return self.execute_query(cacheable, stamp)
+            self.counters.increment('coalesced_queries')
+            self.execution_plan = 'coalesced'
+            self.columns = shared['columns']
+            self.response.columnheaders = shared['columnheaders']
+            self.stats_query = shared['stats_query']
+            self.pnp_path_readable = shared['pnp_path_readable']
+            return shared['result']
+        shared = None
+        try:
+            result = self.execute_query(cacheable, stamp)
+            if coalescer.close(self.fingerprint, flight) and not self.failed:
+                # the waiting threads need a result they can iterate too
+                if not isinstance(result, list):
+                    result = list(result)
+                shared = {
+                    'result': result,
+                    'columns': self.columns,
+                    'columnheaders': self.response.columnheaders,
+                    'stats_query': self.stats_query,
+                    'pnp_path_readable': getattr(self, 'pnp_path_readable', False),
+                }
+            return result
+        finally:
+            coalescer.close(self.fingerprint, flight)
+            flight.land(shared)
+
+    def execute_query(self, cacheable, stamp):
+        """Compute the result of the query, and put it in the cache if it
+        is cacheable."""
+        started = time.time()
+        dependencies = None
+        if cacheable and stamp is None:
+            dependencies = query_dependencies(self)
+
         # Make columns unique
         self.filtercolumns = list(set(self.filtercolumns))
         self.prefiltercolumns = list(set(self.prefiltercolumns))
@@ -332,6 +510,7 @@ class LiveStatusQuery(object):
             # Remember the number of stats filters. We need these numbers as columns later.
             # But we need to ask now, because get_live_data() will empty the stack
             num_stats_filters = self.stats_filter_stack.qsize()
+            counted = False
             if self.table == 'log':
                 result = self.get_live_data_log(cs)
             else:
@@ -341,9 +520,12 @@ class LiveStatusQuery(object):
                     self.pnp_path_readable = True
                 else:
                     self.pnp_path_readable = False
-                # Apply the filters on the broker's host/service/etc elements
-
-                result = self.get_live_data(cs)
+                # Stats: which only count states are read from the state counters
+                result = self.count_from_state_counters()
+                counted = result is not None
+                if not counted:
+                    # Apply the filters on the broker's host/service/etc elements
+                    result = self.get_live_data(cs)
 
             if self.stats_query:
                 self.columns = range(num_stats_filters)
@@ -355,7 +537,7 @@ class LiveStatusQuery(object):
                 else:
                     self.response.columnheaders = 'on'
 
-            if self.stats_query:
+            if self.stats_query and not counted:
                 result = self.statsify_result(result)
                 # statsify_result returns a dict with column numbers as keys
             elif self.table == 'columns':
@@ -368,27 +550,51 @@ class LiveStatusQuery(object):
             logger.error("[Livestatus Query] Error: %s" % e)
             traceback.print_exc(32)
             result = []
+            self.failed = True
 
-        if cacheable and not cache_hit:
+        if cacheable and not self.failed:
             # We cannot cache generators, so we must first read them into a list
             result = [r for r in result]
             # Especially for stats requests also the columns and headers
             # are modified, so we need to save them too.
-            self.query_cache.cache_query(self.metainfo, {
+            self.cached_response = {
                 'result': result,
                 'columns': self.columns,
                 'columnheaders': self.response.columnheaders,
-            })
+                'stamp': stamp,
+            }
+            self.query_cache.cache_query(self.metainfo, self.cached_response,
+                                         time.time() - started, dependencies)
 
         return result
 
+    def row_stamp(self):
+        """
+        The versions of the objects a row query can return (see
+        LiveStatusRegenerator.bump_versions), or only the generation of its
+        table if the hints don't preselect them. None if the query isn't a
+        cacheable row query.
+        """
+        if self.metainfo.cache_category != CACHE_ROWS:
+            return None
+        collection = getattr(self.datamgr.rg, self.table)
+        ids = hinted_ids(collection, self.metainfo.query_hints)
+        if ids is None:
+            return getattr(collection, '_generation', 0)
+        items = collection.items
+        return tuple([(id, getattr(items[id], '_version', 0)) for id in ids if id in items])
+
     def get_hosts_or_services_livedata(self, cs):
         # Get an iterator which will return the list of elements belonging to a specific table.
         # Depending on the hints in the query's metainfo, the list can be only a subset.
         self.metainfo.query_hints["qclass"] = self.__class__.__name__
-        items = getattr(self.datamgr.rg, self.table).__itersorted__(self.metainfo.query_hints)
-        # Pass the elements through more generators if necessary.
+        collection = getattr(self.datamgr.rg, self.table)
+        candidate_ids, exact = None, False
         if not cs.without_filter:
+            candidate_ids, exact = self.index_candidates(collection)
+        items = collection.__itersorted__(self.metainfo.query_hints, candidate_ids)
+        # Pass the elements through more generators if necessary.
+        if not cs.without_filter and not exact:
             items = gen_filtered(items, cs.filter_func)
         if self.limit:
             items = gen_limit(items, self.limit)
@@ -398,6 +604,63 @@ class LiveStatusQuery(object):
         #  pool = multiprocessing.Pool(processes=4)
         #  return pool.map(cs.filter_func, getattr(self.datamgr.rg, self.table).__itersorted__())
 
+    def index_candidates(self, collection):
+        """The ids of the items which the Filter: statements can accept,
+        if the indexes or the columnar mirror of the collection make it
+        worth it. Else None. The second value returned tells if all these
+        items surely match, so that the filter needn't be applied anymore.
+        The decision is recorded in self.execution_plan."""
+        compiled = self.compiled_filters.get('filter_stack')
+        if not hasattr(collection, '_indexes') or compiled is None or len(compiled.trees) != 1:
+            self.execution_plan = 'full scan'
+            return None, False
+        tree = compiled.trees[0]
+        column_ids, exact = None, False
+        columns = getattr(collection, '_columns', None)
+        if columns is not None:
+            column_ids, exact = columns.candidates(tree)
+        if exact:
+            self.execution_plan = 'columns: %d of %d' % (len(column_ids), columns.size)
+            candidate_ids = column_ids
+        else:
+            candidate_ids, self.execution_plan = LiveStatusIndexPlanner(collection).candidates(tree)
+            if column_ids is not None:
+                if candidate_ids is None:
+                    candidate_ids = column_ids
+                else:
+                    candidate_ids = candidate_ids & set(column_ids)
+                self.execution_plan += ', columns: %d candidates' % len(candidate_ids)
+        logger.debug("[Livestatus Query] Execution plan: %s" % self.execution_plan)
+        return candidate_ids, exact
+
+    def count_from_state_counters(self):
+        """The result of a Stats: query which only counts hosts or services
+        by their states, computed from the state counters of the collection
+        (see livestatus_state_counters). None if they can't answer it."""
+        if not self.stats_query or self.stats_group_by or self.stack_programs['filter_stack'] \
+                or self.authuser or self.limit:
+            return None
+        counters = getattr(getattr(self.datamgr.rg, self.table, None), '_state_counters', None)
+        compiled = self.compiled_filters.get('stats_filter_stack')
+        if counters is None or compiled is None:
+            return None
+        trees = compiled.trees
+        postprocessors = [operation for operation in self.stack_programs['stats_postprocess_stack']
+                          if operation[0] == 'put']
+        # paired like in statsify_result
+        for operation in postprocessors[len(postprocessors) - len(trees):]:
+            if operation[1] != 'count':
+                return None
+        for tree in trees:
+            if not counters.supports(tree):
+                return None
+        resultdict = {}
+        for stats_number, tree in enumerate(trees):
+            resultdict[stats_number] = counters.count(tree)
+        self.execution_plan = 'state counters: %d combinations' % len(counters.counts)
+        logger.debug("[Livestatus Query] Execution plan: %s" % self.execution_plan)
+        return [resultdict]
+
     def get_hosts_livedata(self, cs):
         return self.get_hosts_or_services_livedata(cs)
 
@@ -631,99 +894,105 @@ class LiveStatusQuery(object):
         stats_group_by is ["service_description", "host_name"]
         filtresult is a list of elements which have, among others, service_description and host_name attributes
 
-        Step 1:
-        groupedresult is a dict where the keys are unique combinations of the stats_group_by attributes
-                                where the values are arrays of elements which have those attributes in common
-        Example:
-            groupedresult[("host1","svc1")] = { host_name: "host1", service_description: "svc1", state: 2, in_downtime: 0 }
-            groupedresult[("host1","svc2")] = { host_name: "host1", service_description: "svc2", state: 0, in_downtime: 0 }
-            groupedresult[("host1","svc2")] = { host_name: "host1", service_description: "svc2", state: 1, in_downtime: 1 }
+        The rows are walked once. Each row updates, for each Stats: statement
+        whose filter it matches, the accumulator of its aggregate (count, sum,
+        min, max, avg or std), in the accumulators of its group, which is the
+        unique combination of its stats_group_by attributes.
+        Only the accumulators are kept: O(groups * Stats: statements).
 
         resultdict is a dict where the keys are unique combinations of the stats_group_by attributes
                             where the values are dicts
         resultdict values are dicts where the keys are attribute names from stats_group_by
                                    where the values are attribute values
-        Example:
-            resultdict[("host1","svc1")] = { host_name: "host1", service_description: "svc1" }
-            resultdict[("host1","svc2")] = { host_name: "host1", service_description: "svc2" }
-        These attributes are later used as output columns
-
-        Step 2:
-        Run the filters (1 filter for each Stats: statement) and the postprocessors (default: len)
-        The filters are numbered. After each run, add the result to resultdictay as <filterno>: <result>
+                                   and where the keys are the numbers of the Stats: statements
+                                   where the values are the aggregates
         Example for Stats: state = 0\nStats: state = 1\nStats: state = 2\nStats: state = 3\n
             resultdict[("host1","svc1")] = { host_name: "host1", service_description: "svc1", 0: 0, 1: 0, 2: 1, 3: 0 }
             resultdict[("host1","svc2")] = { host_name: "host1", service_description: "svc2", 0: 1, 1: 1, 2: 0, 3: 0 }
+        The attributes are later used as output columns
 
-        Step 3:
-        Create the final result array from resultdict
+        The final result array is created from resultdict
 
         """
-        result = []
-        resultdict = {}
+        # The number of Stats: statements
+        # For each statement there is one function on the stack
+        maxidx = self.stats_filter_stack.qsize()
+        # Each of them is paired with the aggregate of the Stats: statement
+        # which was put last on the stack, like the Stats: postprocessors of
+        # a Lifo would be.
+        postprocessors = [operation for operation in self.stack_programs['stats_postprocess_stack']
+                          if operation[0] == 'put']
+        filters = [None] * maxidx
+        aggregates = [None] * maxidx
+        for i in range(maxidx):
+            # Stats:-statements were put on a Lifo, so we need to reverse the number
+            stats_number = maxidx - i - 1
+            filters[stats_number] = self.stats_filter_stack.get()
+            _, operator, attribute, _ = postprocessors[len(postprocessors) - 1 - i]
+            aggregates[stats_number] = (operator, 'lsm_' + attribute)
+
+        def accumulators():
+            return [LiveStatusStatsAccumulator(operator) for operator, _ in aggregates]
+
+        def accumulate(values, elem):
+            for accumulator, filtfunc, (operator, attribute) in zip(values, filters, aggregates):
+                if filtfunc(elem):
+                    if operator == 'count':
+                        accumulator.count += 1
+                    else:
+                        accumulator.add(float(getattr(elem, attribute)(self)))
+
+        # One pass over filtresult, which can be a generator
         if self.stats_group_by:
             # stats_group_by is a list in newer implementations
             if isinstance(self.stats_group_by, list):
                 self.stats_group_by = tuple(self.stats_group_by)
             else:
                 self.stats_group_by = tuple([self.stats_group_by])
-            # Break up filtresult and prepare resultdict
-            # rseultarr is not a simple array (for a single result line)
-            # It is a dict with the statsgroupyby: as key
-            groupedresult = {}
+            # The accumulators of each unique combination of stats_group_by values
+            groups = {}
             for elem in filtresult:
                 # Make a tuple consisting of the stats_group_by values
                 stats_group_by_values = tuple([getattr(elem, 'lsm_'+c)(self) for c in self.stats_group_by])
-                if not stats_group_by_values in groupedresult:
-                    groupedresult[stats_group_by_values] = []
-                groupedresult[stats_group_by_values].append(elem)
-            for group in groupedresult:
+                values = groups.get(stats_group_by_values)
+                if values is None:
+                    values = groups[stats_group_by_values] = accumulators()
+                accumulate(values, elem)
+            resultdict = {}
+            for group in groups:
                 # All possible combinations of stats_group_by values. group is a tuple
                 resultdict[group] = dict(zip(self.stats_group_by, group))
-
-        # The number of Stats: statements
-        # For each statement there is one function on the stack
-        maxidx = self.stats_filter_stack.qsize()
-        for i in range(maxidx):
-            # Stats:-statements were put on a Lifo, so we need to reverse the number
-            #stats_number = str(maxidx - i - 1)
-            stats_number = maxidx - i - 1
-            # First, get a filter for the attributes mentioned in Stats: statements
-            filtfunc = self.stats_filter_stack.get()
-            # Then, postprocess (sum, max, min,...) the results
-            postprocess = self.stats_postprocess_stack.get()
-            if self.stats_group_by:
-                # Calc statistics over _all_ elements of groups
-                # which share the same stats_filter_by
-                for group in groupedresult:
-                    resultdict[group][stats_number] = postprocess(filter(filtfunc, groupedresult[group]))
-            else:
-                # Calc statistics over _all_ elements of filtresult
-                if isinstance(filtresult, list):
-                    resultdict[stats_number] = postprocess(filter(filtfunc, filtresult))
-                else:
-                    # it's a generator
-                    filtresult = list(filtresult)
-                    resultdict[stats_number] = postprocess(filter(filtfunc, filtresult))
-        if self.stats_group_by:
+                for stats_number, accumulator in enumerate(groups[group]):
+                    resultdict[group][stats_number] = accumulator.result()
+            result = []
             for group in resultdict:
                 result.append(resultdict[group])
         else:
+            values = accumulators()
+            for elem in filtresult:
+                accumulate(values, elem)
+            resultdict = {}
+            for stats_number, accumulator in enumerate(values):
+                resultdict[stats_number] = accumulator.result()
             # Without StatsGroupBy: we have only one line
             result = [resultdict]
         return result
 
-    def make_filter(self, operator, attribute, reference):
-        if reference is not None:
-            # Reference is now datatype string. The referring object attribute on the other hand
-            # may be an integer. (current_attempt for example)
-            # So for the filter to work correctly (the two values compared must be
-            # of the same type), we need to convert the reference to the desired type
-            converter = find_filter_converter(self.table, 'lsm_'+attribute)
-            if converter:
-                reference = converter(reference)
-            if isinstance(reference, str):
-                reference = reference.decode('utf8','ignore')
+    def convert_reference(self, attribute, reference):
+        # Reference is now datatype string. The referring object attribute on the other hand
+        # may be an integer. (current_attempt for example)
+        # So for the filter to work correctly (the two values compared must be
+        # of the same type), we need to convert the reference to the desired type
+        converter = find_filter_converter(self.table, 'lsm_'+attribute)
+        if converter:
+            reference = converter(reference)
+        if isinstance(reference, str):
+            reference = reference.decode('utf8','ignore')
+        return reference
+
+    def make_converted_filter(self, operator, attribute, reference):
+        """The filter closure of operator on attribute, whose reference
+        was already converted with convert_reference"""
         attribute = 'lsm_' + attribute
 
         # The filters are closures.
@@ -820,33 +1089,6 @@ class LiveStatusQuery(object):
         def dummy_filter(item):
             return True
 
-        def count_postproc(item):
-            return len(item)
-
-        def extract_postproc(item):
-            return [float(obj[attribute]) for obj in item]
-
-        def sum_postproc(item):
-            return sum(float(getattr(obj, attribute)(self)) for obj in item)
-
-        def max_postproc(item):
-            if item != []:
-                return max(float(getattr(obj, attribute)(self)) for obj in item)
-            return 0
-
-        def min_postproc(item):
-            if item != []:
-                return min(float(getattr(obj, attribute)(self)) for obj in item)
-            return 0
-
-        def avg_postproc(item):
-            if item != []:
-                return sum(float(getattr(obj, attribute)(self)) for obj in item)
-            return 0
-
-        def std_postproc(item):
-            return 0
-
         if operator == '=':
             return eq_filter
         elif operator == '~':
@@ -873,21 +1115,5 @@ class LiveStatusQuery(object):
             return not_match_nocase_filter
         elif operator == 'dummy':
             return dummy_filter
-        elif operator == 'sum':
-            return sum_postproc
-        elif operator == 'max':
-            return max_postproc
-        elif operator == 'min':
-            return min_postproc
-        elif operator == 'avg':
-            return avg_postproc
-        elif operator == 'std':
-            return std_postproc
-        elif operator == 'count':
-            # postprocess for stats
-            return count_postproc
-        elif operator == 'extract':
-            # postprocess for max,min,...
-            return extract_postproc
         else:
             raise "wrong operation", operator
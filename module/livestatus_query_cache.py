@@ -23,144 +23,541 @@
 # along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from heapq import nsmallest
-from operator import itemgetter
+import sys
+import time
+import threading
+
 from livestatus_query_metainfo import (
-    CACHE_IMPOSSIBLE, CACHE_GLOBAL_STATS, CACHE_GLOBAL_STATS_WITH_STATETYPE, CACHE_SERVICE_STATS
+    CACHE_IMPOSSIBLE, CACHE_PROGRAM_STATIC, CACHE_GLOBAL_STATS, CACHE_GLOBAL_STATS_WITH_STATETYPE,
+    CACHE_HOST_STATS, CACHE_SERVICE_STATS, CACHE_IRREVERSIBLE_HISTORY, CACHE_ROWS
 )
-from counter import Counter
+from livestatus_query_plan import LiveStatusQueryPlanCache
+from livestatus_query_coalescer import LiveStatusQueryCoalescer
+from livestatus_cache_dependencies import object_table, changed_attributes
 from shinken.log import logger
 
+# The names of the categories of queries in the query_cache_ttl parameter
+CACHE_CATEGORY_NAMES = {
+    'program_static': CACHE_PROGRAM_STATIC,
+    'global_stats': CACHE_GLOBAL_STATS,
+    'global_stats_with_statetype': CACHE_GLOBAL_STATS_WITH_STATETYPE,
+    'host_stats': CACHE_HOST_STATS,
+    'service_stats': CACHE_SERVICE_STATS,
+    'irreversible_history': CACHE_IRREVERSIBLE_HISTORY,
+    'rows': CACHE_ROWS,
+}
+
+# The memory the cached results can use unless query_cache_memory says otherwise
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# The number of independently locked parts of the query cache
+DEFAULT_CACHE_STRIPES = 8
+
+REFERENCE_SIZE = sys.getsizeof(None)
+
+
+def estimate_size(value):
+    """
+    A rough estimation of the memory held by a cached result. The objects
+    other than the builtin containers and scalars belong to the regenerator,
+    so they only count as a reference.
+    """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum([estimate_size(v) for v in value])
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum([estimate_size(k) + estimate_size(v) for k, v in value.iteritems()])
+    if value is None or isinstance(value, (basestring, int, long, float)):
+        return sys.getsizeof(value)
+    return REFERENCE_SIZE
+
 
 class LFUCacheMiss(Exception):
     pass
 
 
+class _Budget(object):
+    """A memory budget shared by several LFU, with its own lock"""
+
+    def __init__(self, max_bytes):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.used = 0
+
+    def add(self, size):
+        with self.lock:
+            self.used += size
+
+    def exceeded(self):
+        return self.max_bytes is not None and self.used > self.max_bytes
+
+
+class _Entry(object):
+    __slots__ = ('key', 'value', 'size', 'expires', 'tag', 'bucket', 'prev', 'next')
+
+
+class _Bucket(object):
+    """The entries which were read the same number of times, oldest first"""
+    __slots__ = ('count', 'prev', 'next', 'root')
+
+    def __init__(self, count):
+        self.count = count
+        root = self.root = _Entry()
+        root.prev = root.next = root
+
+    def empty(self):
+        return self.root.next is self.root
+
+    def append(self, entry):
+        root = self.root
+        last = root.prev
+        entry.prev, entry.next = last, root
+        last.next = root.prev = entry
+        entry.bucket = self
+
+    def remove(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+
 class LFU(object):
     """
-    This class implements a dictionary which has a limited number of elements.
-    Whenever the maximum number of elements is reached during a write operation
-    the element which was read least times is deleted.
-    It was inspired by
-    http://code.activestate.com/recipes/498245-lru-and-lfu-cache-decorators/
-    but LFU is much more simpler.
+    This class implements a dictionary whose values have a limited total
+    size. Whenever the size is exceeded during a write operation, the
+    element which was read least times (and least recently among them) is
+    deleted. All the operations are O(1): the elements are kept in buckets
+    of the same read count, and the buckets are kept in increasing count
+    order (see http://dhruvbird.com/lfu.pdf).
+    Elements can expire after a time to live, and be tagged, so that all
+    the elements with a tag can be deleted at once. on_remove is called
+    with the key of each element deleted, except by clear().
+    With a budget, the size of the elements is also counted in it, and
+    elements are evicted while it is exceeded too.
     """
 
-    def __init__(self, maxsize=100):
-        self.storage = {}
+    def __init__(self, maxbytes=DEFAULT_CACHE_MAX_BYTES, maxsize=None, on_remove=None, budget=None):
+        self.maxbytes = maxbytes
         self.maxsize = maxsize
-        self.hits = self.misses = 0
-        self.use_count = Counter()           # times each key has been accessed
+        self.on_remove = on_remove
+        self.budget = budget
+        self.size = 0
+        self.clear()
 
     def clear(self):
-        self.storage = {}
-        self.use_count = Counter()
-        self.hits = self.misses = 0
+        if self.budget is not None:
+            self.budget.add(-self.size)
+        self.entries = {}
+        self.tags = {}
+        self.buckets = _Bucket(0)
+        self.buckets.prev = self.buckets.next = self.buckets
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
 
     def get(self, key):
-        self.use_count[key] += 1
-        try:
-            result = self.storage[key]
-            logger.info("[Livestatus Broker Query Cache] cache HIT")
-            self.hits += 1
-        except KeyError:
-            result = []
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires is not None and entry.expires <= time.time():
+            self.remove(key)
+            entry = None
+        if entry is None:
             self.misses += 1
             raise LFUCacheMiss
-        return result
+        logger.info("[Livestatus Broker Query Cache] cache HIT")
+        self.hits += 1
+        self.move(entry, self.next_bucket(entry.bucket))
+        return entry.value
+
+    def put(self, key, data, size=None, ttl=None, tag=None):
+        """Store data, unless it is bigger than the whole cache.
+        Returns whether it was stored."""
+        if size is None:
+            size = estimate_size(data)
+        self.remove(key)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return False
+        entry = _Entry()
+        entry.key, entry.value, entry.size, entry.tag = key, data, size, tag
+        entry.expires = ttl and time.time() + ttl or None
+        first = self.buckets.next
+        if first.count != 1:
+            first = self.insert_bucket(self.buckets, 1)
+        first.append(entry)
+        self.entries[key] = entry
+        self.grow(size)
+        if tag is not None:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > 1 and self.over_limits():
+            self.evict(entry)
+        return True
+
+    def grow(self, size):
+        self.size += size
+        if self.budget is not None:
+            self.budget.add(size)
+
+    def over_limits(self):
+        return (self.maxbytes is not None and self.size > self.maxbytes) or \
+            (self.budget is not None and self.budget.exceeded()) or \
+            (self.maxsize is not None and len(self.entries) > self.maxsize)
+
+    def resize(self, key, size):
+        """Change the size of the element key, which grew or shrank
+        since it was put. Returns whether it is still stored."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if self.maxbytes is not None and size > self.maxbytes:
+            self.remove(key)
+            return False
+        self.grow(size - entry.size)
+        entry.size = size
+        while len(self.entries) > 1 and self.over_limits():
+            self.evict(entry)
+        return True
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.grow(-entry.size)
+        if entry.tag is not None:
+            keys = self.tags[entry.tag]
+            keys.discard(key)
+            if not keys:
+                del self.tags[entry.tag]
+        bucket = entry.bucket
+        bucket.remove(entry)
+        if bucket.empty():
+            self.unlink_bucket(bucket)
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    def remove_tag(self, tag):
+        """Delete all the elements put with tag"""
+        for key in list(self.tags.get(tag, ())):
+            self.remove(key)
+
+    def evict(self, keep=None):
+        """Delete the least frequently used element other than keep"""
+        bucket = self.buckets.next
+        victim = bucket.root.next
+        if victim is keep:
+            victim = victim.next
+            if victim is bucket.root:
+                victim = bucket.next.root.next
+        self.remove(victim.key)
+        self.evictions += 1
+
+    def next_bucket(self, bucket):
+        following = bucket.next
+        if following.count != bucket.count + 1:
+            following = self.insert_bucket(bucket, bucket.count + 1)
+        return following
 
-    def put(self, key, data):
-        self.storage[key] = data
-        if len(self.storage) > self.maxsize:
-            for key, _ in nsmallest(self.maxsize // 10,
-                                    self.use_count.iteritems(),
-                                    key=itemgetter(1)):
-                del self.storage[key], self.use_count[key]
-        pass
+    def move(self, entry, bucket):
+        old = entry.bucket
+        old.remove(entry)
+        bucket.append(entry)
+        if old.empty():
+            self.unlink_bucket(old)
+
+    def insert_bucket(self, previous, count):
+        bucket = _Bucket(count)
+        bucket.prev, bucket.next = previous, previous.next
+        previous.next.prev = bucket
+        previous.next = bucket
+        return bucket
+
+    def unlink_bucket(self, bucket):
+        bucket.prev.next = bucket.next
+        bucket.next.prev = bucket.prev
 
     def __str__(self):
         text = 'LFU-------------------\n'
         try:
-            text += 'hit rate %.2f%%\n' % (100 * self.hits / (self.hits + self.misses))
+            text += 'hit rate %.2f%%\n' % (100.0 * self.hits / (self.hits + self.misses))
         except ZeroDivisionError:
             text += 'hit rate 0%\n'
-        for k in self.storage:
-            text += 'key %10s (%d used)\n' % (str(k), self.use_count[k])
+        text += '%d bytes in %d entries\n' % (self.size, len(self.entries))
+        for k, entry in self.entries.iteritems():
+            text += 'key %10s (%d used, %d bytes)\n' % (str(k), entry.bucket.count - 1, entry.size)
         return text
 
 
+class _Stripe(object):
+    """
+    A part of the query cache: the results whose keys hash to it, with
+    their dependencies, and the lock which protects them.
+    """
+
+    def __init__(self, max_bytes, budget=None):
+        self.lock = threading.Lock()
+        self.cache = LFU(max_bytes, on_remove=self.forget_dependencies, budget=budget)
+        # the dependencies of each cached result
+        self.dependencies = {}
+        # the cached results depending on (table, attribute), attribute None
+        # meaning any attribute
+        self.dependents = {}
+
+    def clear(self):
+        self.cache.clear()
+        self.dependencies = {}
+        self.dependents = {}
+
+    def add_dependencies(self, key, dependencies):
+        self.dependencies[key] = dependencies
+        for table, attributes, ids in dependencies:
+            for attribute in attributes or (None,):
+                self.dependents.setdefault((table, attribute), set()).add(key)
+
+    def forget_dependencies(self, key):
+        for table, attributes, ids in self.dependencies.pop(key, ()):
+            for attribute in attributes or (None,):
+                keys = self.dependents.get((table, attribute))
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.dependents[(table, attribute)]
+
+    def invalidate_dependents(self, table, obj_id, changed):
+        keys = set()
+        for attribute in list(changed) + [None]:
+            keys.update(self.dependents.get((table, attribute), ()))
+        for key in keys:
+            for dep_table, attributes, ids in self.dependencies.get(key, ()):
+                if dep_table == table and (ids is None or obj_id in ids) and \
+                        (attributes is None or not attributes.isdisjoint(changed)):
+                    logger.debug("[Livestatus Broker Query Cache] Invalidated by a change of %s: %s" % (table, str(key)))
+                    self.cache.remove(key)
+                    break
+
+    def invalidate_objects(self, table, obj_ids):
+        """Throw away the cached results which depend on any attribute of
+        any of the objects obj_ids of table, or on which objects it has."""
+        keys = set()
+        for (dep_table, attribute), dependents in self.dependents.iteritems():
+            if dep_table == table:
+                keys.update(dependents)
+        for key in keys:
+            for dep_table, attributes, ids in self.dependencies.get(key, ()):
+                if dep_table == table and (ids is None or not ids.isdisjoint(obj_ids)):
+                    self.cache.remove(key)
+                    break
+
+
 class LiveStatusQueryCache(object):
     """
     A class describing a collection of livestatus query caches.
-    As we have several categories of queries, we also have several caches.
-    The validity of each of it can be influenced by different changes through
-    update broks.
+    As we have several categories of queries, the cached results are tagged
+    with their category. The validity of each of it can be influenced by
+    different changes through update broks.
+    All the categories share one memory budget (max_bytes). The results of
+    a category can have a time to live (ttls, with the names of
+    CACHE_CATEGORY_NAMES as keys), and only the results which took more than
+    min_compute_time seconds to compute are worth caching.
+    The results put with their dependencies (see livestatus_cache_dependencies)
+    are only invalidated by the changes of the objects and attributes they
+    depend on. The others by the changes which concern their whole category.
+    With cache_outputs, the formatted response is kept with the result, so
+    that a hit doesn't need to encode it again.
+
+    The client threads and the brok thread use the cache concurrently. The
+    results are spread by key over several stripes, each with its own lock.
+    An invalidation locks one stripe after the other, so a reader only ever
+    waits for the operations on the stripe of its own query. The stripes
+    count the size of their results in the shared budget: when a new result
+    exceeds it, the stripe of this result evicts its least frequently used
+    ones first, then the other stripes do, one after the other.
     """
 
-    def __init__(self):
-        self.categories = []
-        # cache_GLOBAL_STATS
-        self.categories.append(LFU())
-        # cache_GLOBAL_STATS_WITH_STATEtype
-        self.categories.append(LFU())
-        self.categories.append(LFU())
-        self.categories.append(LFU())
-        self.categories.append(LFU())
-        self.categories.append(LFU())
-        self.categories.append(LFU())
+    def __init__(self, plan_cache_size=512, max_bytes=DEFAULT_CACHE_MAX_BYTES, ttls=None, min_compute_time=0,
+                 cache_outputs=False, coalesce=True, history=None, stripes=DEFAULT_CACHE_STRIPES):
+        # The plans of the parsed queries. They don't depend on the
+        # live data, so they are kept even if the query cache is disabled.
+        self.plan_cache = LiveStatusQueryPlanCache(plan_cache_size)
+        # The queries being executed, which identical ones can wait for.
+        # Also used when the query cache is disabled.
+        self.coalescer = coalesce and LiveStatusQueryCoalescer() or None
+        # The on-disk cache of the responses to the log queries of the
+        # past (see livestatus_history_cache), if any
+        self.history = history
+        self.budget = _Budget(max_bytes)
+        self.stripes = [_Stripe(max_bytes, self.budget) for _ in range(max(1, stripes))]
+        self.ttls = {}
+        for name, ttl in (ttls or {}).iteritems():
+            if name in CACHE_CATEGORY_NAMES:
+                self.ttls[CACHE_CATEGORY_NAMES[name]] = ttl
+            else:
+                logger.warning("[Livestatus Broker Query Cache] Unknown category of queries: %s" % name)
+        self.min_compute_time = min_compute_time
+        # whether the formatted responses are cached along with the results
+        self.cache_outputs = cache_outputs
+        self.rejected = 0
+        # the results found outdated by their stamp
+        self.outdated = 0
         self.enabled = True
 
     def disable(self):
         self.enabled = False
 
+    def stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def __len__(self):
+        return sum([len(stripe.cache) for stripe in self.stripes])
+
+    def __contains__(self, key):
+        return key in self.stripe(key).cache
+
+    @property
+    def size(self):
+        return sum([stripe.cache.size for stripe in self.stripes])
+
+    @property
+    def hits(self):
+        return sum([stripe.cache.hits for stripe in self.stripes])
+
+    @property
+    def misses(self):
+        return sum([stripe.cache.misses for stripe in self.stripes])
+
+    @property
+    def evictions(self):
+        return sum([stripe.cache.evictions for stripe in self.stripes])
+
     def invalidate_category(self, category):
         """
         Throw away all cached results of a certain class.
         For example, if there is a state change, we must recalculate
         the data for the tactical overview.
         """
-        try:
-            logger.debug("[Livestatus Broker Query Cache] I wipe sub-cache: %s" % str(category))
-            self.categories[category].clear()
-        except Exception:
-            pass
+        logger.debug("[Livestatus Broker Query Cache] I wipe sub-cache: %s" % str(category))
+        for stripe in self.stripes:
+            with stripe.lock:
+                stripe.cache.remove_tag(category)
+                stripe.cache.remove_tag((category, 'tracked'))
+
+    def invalidate_untracked(self, category):
+        """Like invalidate_category, for the results cached without
+        their dependencies only."""
+        for stripe in self.stripes:
+            with stripe.lock:
+                stripe.cache.remove_tag(category)
 
     def wipeout(self):
         if not self.enabled:
             return
-        for cat in range(len(self.categories)):
-            self.categories[cat].clear()
+        for stripe in self.stripes:
+            with stripe.lock:
+                stripe.clear()
 
-    def get_cached_query(self, query):
+    def invalidate_reloaded(self, changes):
         """
-        query is only the metainfo part of the original query
+        After a new configuration, throw away the cached results which
+        depend on the objects added, removed or replaced (changes has their
+        ids by table), and all those cached without their dependencies,
+        except the ones of the history which is what it was.
         """
         if not self.enabled:
+            return
+        for stripe in self.stripes:
+            with stripe.lock:
+                for table, obj_ids in changes.iteritems():
+                    if obj_ids:
+                        stripe.invalidate_objects(table, obj_ids)
+                for category in CACHE_CATEGORY_NAMES.itervalues():
+                    if category != CACHE_IRREVERSIBLE_HISTORY:
+                        stripe.cache.remove_tag(category)
+
+    def invalidate_dependents(self, table, obj_id, changed):
+        """Throw away the cached results which depend on the changed
+        attributes of the object obj_id of table."""
+        for stripe in self.stripes:
+            with stripe.lock:
+                stripe.invalidate_dependents(table, obj_id, changed)
+
+    def get_cached_query(self, query, stamp=None):
+        """
+        query is only the metainfo part of the original query.
+        If stamp is given, a cached result computed for another one
+        is outdated.
+        """
+        if not self.enabled or query.cache_category == CACHE_IMPOSSIBLE:
             return (False, False, [])
         logger.debug("[Livestatus Broker Query Cache] I search the cache "
                      "for categories %s with key %s and data %s",
                      str(query.cache_category), str(query.key), str(query.data))
+        key = (query.cache_category, query.key)
+        stripe = self.stripe(key)
         try:
-            return (
-                query.cache_category != CACHE_IMPOSSIBLE,
-                True,
-                self.categories[query.cache_category].get(query.key)
-            )
+            with stripe.lock:
+                cached = stripe.cache.get(key)
+                if stamp is not None and cached.get('stamp') != stamp:
+                    self.outdated += 1
+                    stripe.cache.hits -= 1
+                    stripe.cache.misses += 1
+                    stripe.cache.remove(key)
+                    return (True, False, [])
+                return (True, True, cached)
         except LFUCacheMiss:
-            return (
-                query.cache_category != CACHE_IMPOSSIBLE,
-                False,
-                []
-            )
+            return (True, False, [])
 
-    def cache_query(self, query, result):
-        """Puts the result of a livestatus query (metainfo) into the cache."""
+    def cache_query(self, query, result, compute_time=None, dependencies=None):
+        """Puts the result of a livestatus query (metainfo) into the cache,
+        if it took long enough to compute (compute_time, in seconds)."""
 
         if not self.enabled:
             return
+        if compute_time is not None and compute_time < self.min_compute_time:
+            self.rejected += 1
+            return
         logger.info("[Livestatus Broker Query Cache] I put in the cache for %s with key %s",
                     str(query.cache_category), str(query.key))
-        self.categories[query.cache_category].put(query.key, result)
+        key = (query.cache_category, query.key)
+        size = estimate_size(result)
+        tag = query.cache_category
+        if dependencies is not None:
+            tag = (tag, 'tracked')
+        stripe = self.stripe(key)
+        with stripe.lock:
+            if not stripe.cache.put(key, result, size, self.ttls.get(query.cache_category), tag):
+                return
+            if dependencies is not None:
+                stripe.add_dependencies(key, dependencies)
+        self.make_room(stripe)
+
+    def make_room(self, stripe):
+        """Evict results from the stripes other than stripe while the
+        memory budget is exceeded, holding one lock at a time."""
+        for other in self.stripes:
+            if not self.budget.exceeded():
+                return
+            if other is stripe:
+                continue
+            with other.lock:
+                while other.cache.entries and self.budget.exceeded():
+                    other.cache.evict()
+
+    def cache_output(self, query, cached_response, output):
+        """Add the formatted response of a query to its cached result
+        cached_response, if this one is still in the cache. The output
+        is thus thrown away together with the result."""
+        if not self.enabled or not self.cache_outputs:
+            return
+        key = (query.cache_category, query.key)
+        size = estimate_size(output)
+        stripe = self.stripe(key)
+        with stripe.lock:
+            entry = stripe.cache.entries.get(key)
+            if entry is None or entry.value is not cached_response:
+                return
+            cached_response['output'] = output
+            stripe.cache.resize(key, entry.size + size)
+        self.make_room(stripe)
 
     def impact_assessment(self, brok, obj):
         """
@@ -169,16 +566,22 @@ class LiveStatusQueryCache(object):
         """
         if not self.enabled:
             return
+        table = object_table(obj)
+        if table is not None:
+            changed = changed_attributes(brok, obj)
+            if changed:
+                self.invalidate_dependents(table, obj.id, changed)
+        # The results without dependencies are invalidated by category
         try:
             if brok.data['state_id'] != obj.state_id:
                 logger.info("[Livestatus Broker Query Cache] Detected statechange: %s", str(obj))
-                self.invalidate_category(CACHE_GLOBAL_STATS)
-                self.invalidate_category(CACHE_SERVICE_STATS)
+                self.invalidate_untracked(CACHE_GLOBAL_STATS)
+                self.invalidate_untracked(CACHE_SERVICE_STATS)
             if brok.data['state_type_id'] != obj.state_type_id:
                 logger.info("[Livestatus Broker Query Cache] Detected statetypechange: %s",
                             str(obj))
-                self.invalidate_category(CACHE_GLOBAL_STATS_WITH_STATETYPE)
-                self.invalidate_category(CACHE_SERVICE_STATS)
+                self.invalidate_untracked(CACHE_GLOBAL_STATS_WITH_STATETYPE)
+                self.invalidate_untracked(CACHE_SERVICE_STATS)
             logger.debug("[Livestatus Broker Query Cache] Obj State id: %d and State type id: %d, "
                          "Data state id: %d abd state type id: %d",
                          obj.state_id, obj.state_type_id,
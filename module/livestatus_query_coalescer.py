@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+
+"""
+When many clients show the same dashboard, identical queries arrive at
+the same time on different threads. The first one is executed, and the
+others wait for it and share its result instead of computing it again.
+Queries are identical if their fingerprints (see livestatus_query_plan)
+are, so that the queries of different AuthUser: are never merged.
+"""
+
+
+class _Flight(object):
+    """The execution of a query, which other threads can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.waiters = 0
+
+    def wait(self):
+        self.done.wait()
+        return self.value
+
+    def land(self, value):
+        self.value = value
+        self.done.set()
+
+
+class LiveStatusQueryCoalescer(object):
+    """
+    The registry of the queries being executed, keyed by fingerprint.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def join(self, key):
+        """
+        Returns (True, flight) if there is no execution of key yet: the
+        caller executes it and lands the flight (see close). Otherwise
+        (False, flight) for the running execution, to wait for.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                return False, flight
+            flight = self.flights[key] = _Flight()
+            return True, flight
+
+    def close(self, key, flight):
+        """
+        Stop the threads from joining flight.
+        Returns the number of threads waiting for it.
+        """
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            return flight.waiters
@@ -63,6 +63,12 @@ applies to queries which want to read log data from a time in the past.
 If the columns are not of any type which can change later, this query
 can be cached forever.
 
+- CACHE_ROWS
+applies to the ordinary row queries of the hosts, services and group tables.
+never invalidated: a cached result is valid as long as the versions of its
+objects (or the generation of its table, see livestatus_regenerator) are the
+same as when it was computed.
+
 """
 CACHE_IMPOSSIBLE = 0
 CACHE_PROGRAM_STATIC = 1
@@ -71,6 +77,16 @@ CACHE_GLOBAL_STATS_WITH_STATETYPE = 3
 CACHE_HOST_STATS = 4
 CACHE_SERVICE_STATS = 5
 CACHE_IRREVERSIBLE_HISTORY = 6
+CACHE_ROWS = 7
+
+# The tables whose objects carry a version
+VERSIONED_TABLES = ['hosts', 'services', 'hostgroups', 'servicegroups']
+
+# The columns whose value changes with time only, or with files appearing
+# on disk, without any update of their object
+TIME_DEPENDENT_COLUMNS = ['in_check_period', 'in_notification_period',
+                          'host_in_check_period', 'host_in_notification_period',
+                          'pnpgraph_present', 'host_pnpgraph_present', 'service_pnpgraph_present']
 
 """
 Sometimes it is possible to see from the list of filters that this query's purpose
@@ -158,6 +174,8 @@ class LiveStatusQueryMetainfo(object):
         self.stats_columns = [f[1] for f in self.structured_data if f[0] == 'Stats']
         self.filter_columns = [f[1] for f in self.structured_data if f[0] == 'Filter']
         self.columns = [x for f in self.structured_data if f[0] == 'Columns' for x in f[1]]
+        # the upper time limit of the logs asked for, see is_a_closed_chapter
+        self.chapter_end = None
         self.categorize()
 
     def __str__(self):
@@ -315,6 +333,7 @@ class LiveStatusQueryMetainfo(object):
             limits = sorted([(f[2], int(f[3])) for f in self.structured_data if f[0] == 'Filter' and f[1] == 'time'], key=lambda x: x[1])
 
             if len(limits) == 2 and limits[1][1] <= int(time.time()) and limits[0][0].startswith('>') and limits[1][0].startswith('<'):
+                self.chapter_end = limits[1][1]
                 if has_not_more_than(self.columns, logline_elements):
                     return True
         return False
@@ -339,6 +358,9 @@ class LiveStatusQueryMetainfo(object):
             self.cache_category = CACHE_IRREVERSIBLE_HISTORY
         elif self.table == 'services' and not self.is_stats and has_not_more_than(self.columns, ['host_name', 'description', 'state', 'state_type']):
             self.cache_category = CACHE_SERVICE_STATS
+        elif self.table in VERSIONED_TABLES and not self.is_stats and self.columns and \
+                not set([self.strip_table_from_column(c) for c in self.columns] + self.filter_columns).intersection(TIME_DEPENDENT_COLUMNS):
+            self.cache_category = CACHE_ROWS
         else:
             pass
             logger.debug("[Livestatus Query Metainfo] I cannot cache this %s" % str(self))
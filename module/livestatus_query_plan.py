@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+
+from livestatus_query_metainfo import LiveStatusQueryMetainfo
+
+"""
+Dashboards send the same few hundred query shapes over and over, often
+varying only in their Localtime: header. Parsing such a query (regexes,
+reference conversions, the metainfo analysis) gives the same result
+each time. A LiveStatusQueryPlan keeps this result, so that the next
+identical query only has to replay it.
+"""
+
+# Headers which don't change the meaning of a query. They are left out of
+# the plan fingerprint and parsed again with each request.
+PER_REQUEST_KEYWORDS = ('Localtime', 'KeepAlive', 'ResponseHeader')
+
+
+def normalize_query(data):
+    """
+    Split the lines of a query.
+    Returns the fingerprint of the query (its normalized text without the
+    per-request headers), the lines which make up the fingerprint, and the
+    per-request lines.
+    """
+    plan_lines = []
+    request_lines = []
+    for line in data.splitlines():
+        line = line.strip()
+        # Tools like NagVis send KEYWORK:option, and we prefer to have
+        # a space following the:
+        if ':' in line and not ' ' in line:
+            line = line.replace(':', ': ')
+        keyword = line.split(' ')[0].rstrip(':')
+        if keyword in PER_REQUEST_KEYWORDS:
+            request_lines.append(line)
+        else:
+            plan_lines.append(line)
+    return '\n'.join(plan_lines), plan_lines, request_lines
+
+
+class LiveStatusQueryPlan(object):
+    """
+    The request independent outcome of LiveStatusQuery.parse_input.
+
+    The filter functions can't be shared between queries, because they are
+    bound to their query. So instead of the filter functions, the plan
+    keeps the operations for the filter stacks (with the already converted
+    references) and their compiled form, from which each new query
+    builds its own functions.
+    """
+
+    query_attributes = ('table', 'columns', 'filtercolumns', 'prefiltercolumns',
+                        'stats_group_by', 'stats_columns', 'aliases', 'limit',
+                        'authuser', 'stats_query', 'extcmd')
+    response_attributes = ('outputformat', 'columnheaders', 'separators')
+
+    def __init__(self):
+        self.programs = {
+            'filter_stack': [],
+            'stats_filter_stack': [],
+            'stats_postprocess_stack': [],
+        }
+        self.compiled_filters = {}
+        self.db_calls = []
+        self.attributes = {}
+        self.response_values = {}
+        self.metainfo = None
+
+    def record_db_call(self, method, *args):
+        self.db_calls.append((method, args))
+
+    def freeze(self, query):
+        """Take a snapshot of the attributes of a freshly parsed query"""
+        for attr in self.query_attributes:
+            self.attributes[attr] = getattr(query, attr)
+        for attr in self.response_attributes:
+            self.response_values[attr] = getattr(query.response, attr)
+        for stack_name, program in query.stack_programs.iteritems():
+            # operations are tuples (op, args...). See LiveStatusQuery.run_stack_operation
+            self.programs[stack_name] = list(program)
+        if query.table != 'log':
+            # whether a log query is "a closed chapter" depends on the current time
+            self.metainfo = query.metainfo
+
+    def apply(self, query, data):
+        """Give query the state it would have after parsing the planned lines"""
+        for attr, value in self.attributes.iteritems():
+            if isinstance(value, list):
+                value = list(value)
+            setattr(query, attr, value)
+        for attr, value in self.response_values.iteritems():
+            setattr(query.response, attr, value)
+        for stack_name, program in self.programs.iteritems():
+            query.stack_programs[stack_name] = list(program)
+        query.compiled_filters = self.compiled_filters
+        for method, args in self.db_calls:
+            getattr(query.db, method)(*args)
+        if self.metainfo is None:
+            query.metainfo = LiveStatusQueryMetainfo(data)
+        else:
+            query.metainfo = self.metainfo
+
+
+class _Link(object):
+    __slots__ = ('prev', 'next', 'key', 'value')
+
+
+class LiveStatusQueryPlanCache(object):
+    """
+    A thread safe LRU of query plans, keyed by query fingerprint.
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.links = {}
+            root = self.root = _Link()
+            root.prev = root.next = root
+            root.key = root.value = None
+
+    def __len__(self):
+        return len(self.links)
+
+    def get(self, key):
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                return None
+            # move the link to the most recently used end
+            link.prev.next = link.next
+            link.next.prev = link.prev
+            root = self.root
+            last = root.prev
+            last.next = root.prev = link
+            link.prev = last
+            link.next = root
+            return link.value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if key in self.links:
+                self.links[key].value = value
+                return
+            root = self.root
+            last = root.prev
+            link = _Link()
+            link.prev, link.next, link.key, link.value = last, root, key, value
+            last.next = root.prev = link
+            self.links[key] = link
+            while len(self.links) > self.maxsize:
+                oldest = root.next
+                root.next = oldest.next
+                oldest.next.prev = root
+                del self.links[oldest.key]
@@ -26,110 +26,158 @@ import types
 #import time
 from shinken.objects import Contact
 from shinken.objects import NotificationWay
+from shinken.objects.host import Host
+from shinken.objects.service import Service
+from shinken.objects.hostgroup import Hostgroup
+from shinken.objects.servicegroup import Servicegroup
 from shinken.misc.regenerator import Regenerator
 from shinken.util import safe_print, get_obj_full_name
 from shinken.log import logger
+from livestatus_index import LiveStatusIndexRegistry, DEFAULT_INDEXED_COLUMNS
+from livestatus_columns import LiveStatusColumnStore, DEFAULT_COLUMNAR_COLUMNS
+from livestatus_state_counters import LiveStatusStateCounters, LiveStatusStates
+from livestatus_heaps import item_changes, forget_items, update_id_heap, update_lookups, update_group_contacts, ShadowCollection
+from livestatus_visibility import LiveStatusVisibility, DEFAULT_BITMAP_THRESHOLD
 from livestatus_query_metainfo import HINT_NONE, HINT_HOST, HINT_HOSTS, HINT_SERVICES_BY_HOST, HINT_SERVICE, HINT_SERVICES_BY_HOSTS, HINT_SERVICES, HINT_HOSTS_BY_GROUP, HINT_SERVICES_BY_GROUP, HINT_SERVICES_BY_HOSTGROUP
 
 
-def itersorted(self, hints=None):
-    preselected_ids = []
-    preselection = False
-    if hints is not None:
-        logger.debug("[Livestatus Regenerator] Hint is %s" % hints["target"])
-    if hints is None:
-        # return all items
-        hints = {}
-    elif hints['target'] == HINT_HOST:
+def hinted_ids(self, hints):
+    """The ids of the items which the hints of a query (see
+    livestatus_query_metainfo) preselect, or None if they don't."""
+    target = hints.get('target')
+    if target == HINT_HOST:
         try:
-            preselected_ids = [self._id_by_host_name_heap[hints['host_name']]]
-            preselection = True
+            return [self._id_by_host_name_heap[hints['host_name']]]
         except Exception, exp:
             # This host is unknown
             pass
-    elif hints['target'] == HINT_HOSTS:
+    elif target == HINT_HOSTS:
         try:
-            preselected_ids = [self._id_by_host_name_heap[h] for h in hints['host_name'] if h in self._id_by_host_name_heap]
-            preselection = True
+            return [self._id_by_host_name_heap[h] for h in hints['host_name'] if h in self._id_by_host_name_heap]
         except Exception, exp:
             # This host is unknown
             pass
-    elif hints['target'] == HINT_HOSTS_BY_GROUP:
+    elif target == HINT_HOSTS_BY_GROUP:
         try:
-            preselected_ids = self._id_by_hostgroup_name_heap[hints['hostgroup_name']]
-            preselection = True
+            return self._id_by_hostgroup_name_heap[hints['hostgroup_name']]
         except Exception, exp:
             # This service is unknown
             pass
-    elif hints['target'] == HINT_SERVICES_BY_HOST:
+    elif target == HINT_SERVICES_BY_HOST:
         try:
-            preselected_ids = self._id_by_host_name_heap[hints['host_name']]
-            preselection = True
+            return self._id_by_host_name_heap[hints['host_name']]
         except Exception, exp:
             # This service is unknown
             pass
-    elif hints['target'] == HINT_SERVICE:
+    elif target == HINT_SERVICE:
         try:
-            preselected_ids = [self._id_by_service_name_heap[hints['host_name'] + '/' + hints['service_description']]]
-            preselection = True
+            return [self._id_by_service_name_heap[hints['host_name'] + '/' + hints['service_description']]]
         except Exception:
             pass
-    elif hints['target'] == HINT_SERVICES:
+    elif target == HINT_SERVICES:
         try:
-            preselected_ids = [self._id_by_service_name_heap[host_name + '/' + service_description] for host_name, service_description in hints['host_names_service_descriptions'] if host_name + '/' + service_description in self._id_by_service_name_heap]
-            preselection = True
+            return [self._id_by_service_name_heap[host_name + '/' + service_description] for host_name, service_description in hints['host_names_service_descriptions'] if host_name + '/' + service_description in self._id_by_service_name_heap]
         except Exception, exp:
             logger.error("[Livestatus Regenerator] Hint_services exception: %s" % exp)
             pass
-    elif hints['target'] == HINT_SERVICES_BY_HOSTS:
+    elif target == HINT_SERVICES_BY_HOSTS:
         try:
-            preselected_ids = [id for h in hints['host_name'] if h in self._id_by_host_name_heap for id in self._id_by_host_name_heap[h]]
-            preselection = True
+            return [id for h in hints['host_name'] if h in self._id_by_host_name_heap for id in self._id_by_host_name_heap[h]]
         except Exception:
             pass
-    elif hints['target'] == HINT_SERVICES_BY_GROUP:
+    elif target == HINT_SERVICES_BY_GROUP:
         try:
-            preselected_ids = self._id_by_servicegroup_name_heap[hints['servicegroup_name']]
-            preselection = True
+            return self._id_by_servicegroup_name_heap[hints['servicegroup_name']]
         except Exception, exp:
             # This service is unknown
             pass
-    elif hints['target'] == HINT_SERVICES_BY_HOSTGROUP:
+    elif target == HINT_SERVICES_BY_HOSTGROUP:
         try:
-            preselected_ids = self._id_by_hostgroup_name_heap[hints['hostgroup_name']]
-            preselection = True
+            return self._id_by_hostgroup_name_heap[hints['hostgroup_name']]
         except Exception, exp:
             # This service is unknown
             pass
+    return None
+
+
+def itersorted(self, hints=None, candidate_ids=None):
+    preselected_ids = []
+    preselection = False
+    if hints is not None:
+        logger.debug("[Livestatus Regenerator] Hint is %s" % hints["target"])
+    if hints is None:
+        # return all items
+        hints = {}
+    else:
+        preselected_ids = hinted_ids(self, hints)
+        preselection = preselected_ids is not None
+        if not preselection:
+            preselected_ids = []
     if 'authuser' in hints:
+        # the ids of the items the contact sees, sorted, and as a set or
+        # bitmap (see livestatus_visibility)
+        try:
+            visible_ids = self._id_contact_heap[hints['authuser']]
+            visible = self._visibility.get(hints['authuser'])
+        except Exception:
+            visible = None
+        if visible is None:
+            # this hints['authuser'] was not in self._id_contact_heap
+            # we do nothing, so the caller gets an empty list
+            return
+    if candidate_ids is not None:
+        # ids found in the indexes (see livestatus_index), or a list
+        # of ids already in sorted order (see livestatus_columns)
         if preselection:
-            try:
-                for id in [pid for pid in preselected_ids if pid in self._id_contact_heap[hints['authuser']]]:
-                    yield self.items[id]
-            except Exception:
-                # this hints['authuser'] was not in self._id_contact_heap
-                # we do nothing, so the caller gets an empty list
-                pass
+            if isinstance(candidate_ids, list):
+                candidate_ids = set(candidate_ids)
+            preselected_ids = [id for id in preselected_ids if id in candidate_ids]
+        elif isinstance(candidate_ids, list):
+            preselected_ids = candidate_ids
+        elif 'authuser' in hints and len(visible_ids) <= 8 * len(candidate_ids):
+            # rather than sorting the candidates, pick them from the
+            # visible ids, which are already sorted
+            preselected_ids = [id for id in visible_ids if id in candidate_ids]
         else:
-            try:
-                for id in self._id_contact_heap[hints['authuser']]:
-                    yield self.items[id]
-            except Exception:
-                pass
-    else:
+            preselected_ids = sorted(candidate_ids, key=self._id_heap_position.__getitem__)
+        preselection = True
+    if 'authuser' in hints:
         if preselection:
-            for id in preselected_ids:
-                yield self.items[id]
+            ids = [id for id in preselected_ids if id in visible]
         else:
-            for id in self._id_heap:
-                yield self.items[id]
+            ids = visible_ids
+    elif preselection:
+        ids = preselected_ids
+    else:
+        ids = self._id_heap
+    # During a reload, the ids may still be those of the previous
+    # configuration (see LiveStatusRegenerator.all_done_linking)
+    items = self.items
+    for id in ids:
+        item = items.get(id)
+        if item is not None:
+            yield item
+
+
+# The collections with sorted ids and lookup tables (see livestatus_heaps)
+HEAP_COLLECTIONS = ('hosts', 'services', 'hostgroups', 'servicegroups', 'contacts',
+                    'contactgroups', 'commands', 'timeperiods')
 
 
 class LiveStatusRegenerator(Regenerator):
-    def __init__(self, service_authorization_strict=False, group_authorization_strict=True):
+    def __init__(self, service_authorization_strict=False, group_authorization_strict=True,
+                 indexed_columns=DEFAULT_INDEXED_COLUMNS, columnar_columns=DEFAULT_COLUMNAR_COLUMNS,
+                 heap_consistency_check=False, bitmap_threshold=DEFAULT_BITMAP_THRESHOLD):
         super(LiveStatusRegenerator, self).__init__()
         self.service_authorization_strict = service_authorization_strict
         self.group_authorization_strict = group_authorization_strict
+        self.indexes = LiveStatusIndexRegistry(indexed_columns)
+        self.columnar_columns = columnar_columns
+        # Check the incrementally updated sorted ids against a full rebuild
+        self.heap_consistency_check = heap_consistency_check
+        # Above this number of visible items, those of a contact are
+        # kept in a bitmap (see livestatus_visibility)
+        self.bitmap_threshold = bitmap_threshold
 
     def all_done_linking(self, inst_id):
         """In addition to the original all_done_linking our items will get sorted"""
@@ -138,26 +186,28 @@ class LiveStatusRegenerator(Regenerator):
         # because it's not need :)
         super(LiveStatusRegenerator, self).all_done_linking(inst_id)
 
-        # now sort the item collections by name
-        safe_print("SORTING HOSTS AND SERVICES")
-        # First install a new attribute _id_heap, which holds the
-        # item ids in sorted order
-        setattr(self.services, '_id_heap', self.services.items.keys())
-        self.services._id_heap.sort(key=lambda x: get_obj_full_name(self.services.items[x]))
-        setattr(self.hosts, '_id_heap', self.hosts.items.keys())
-        self.hosts._id_heap.sort(key=lambda x: get_obj_full_name(self.hosts.items[x]))
-        setattr(self.contacts, '_id_heap', self.contacts.items.keys())
-        self.contacts._id_heap.sort(key=lambda x: get_obj_full_name(self.contacts.items[x]))
-        setattr(self.servicegroups, '_id_heap', self.servicegroups.items.keys())
-        self.servicegroups._id_heap.sort(key=lambda x: get_obj_full_name(self.servicegroups.items[x]))
-        setattr(self.hostgroups, '_id_heap', self.hostgroups.items.keys())
-        self.hostgroups._id_heap.sort(key=lambda x: get_obj_full_name(self.hostgroups.items[x]))
-        setattr(self.contactgroups, '_id_heap', self.contactgroups.items.keys())
-        self.contactgroups._id_heap.sort(key=lambda x: get_obj_full_name(self.contactgroups.items[x]))
-        setattr(self.commands, '_id_heap', self.commands.items.keys())
-        self.commands._id_heap.sort(key=lambda x: get_obj_full_name(self.commands.items[x]))
-        setattr(self.timeperiods, '_id_heap', self.timeperiods.items.keys())
-        self.timeperiods._id_heap.sort(key=lambda x: get_obj_full_name(self.timeperiods.items[x]))
+        # now bring the sorted ids of the item collections, their lookup
+        # tables and indexes up to date. This is done aside, in shadows of
+        # the collections, the queries meanwhile still using the previous
+        # ones. Then they are installed at once.
+        safe_print("UPDATING THE SORTED INDEXES OF HOSTS AND SERVICES")
+        shadows = dict([(name, ShadowCollection(collection)) for name, collection in self.heap_collections().iteritems()])
+        if self.update_heaps(shadows):
+            self.build_group_contact_heaps(shadows)
+        if self.heap_consistency_check:
+            self.verify_heaps(shadows)
+        hosts, services = shadows['hosts'], shadows['services']
+        # And the secondary indexes
+        self.indexes.build('hosts', hosts, Host, self.hosts)
+        self.indexes.build('services', services, Service, self.services)
+        # And the columnar mirror of their status
+        setattr(hosts, '_columns', LiveStatusColumnStore(hosts, Host, self.columnar_columns))
+        setattr(services, '_columns', LiveStatusColumnStore(services, Service, self.columnar_columns))
+        # And the counters of their states
+        setattr(hosts, '_state_counters', LiveStatusStateCounters(hosts, Host))
+        setattr(services, '_state_counters', LiveStatusStateCounters(services, Service))
+        for shadow in shadows.itervalues():
+            shadow.install()
         # Then install a method for accessing the lists' elements in sorted order
         setattr(self.services, '__itersorted__', types.MethodType(itersorted, self.services))
         setattr(self.hosts, '__itersorted__', types.MethodType(itersorted, self.hosts))
@@ -167,117 +217,174 @@ class LiveStatusRegenerator(Regenerator):
         setattr(self.contactgroups, '__itersorted__', types.MethodType(itersorted, self.contactgroups))
         setattr(self.commands, '__itersorted__', types.MethodType(itersorted, self.commands))
         setattr(self.timeperiods, '__itersorted__', types.MethodType(itersorted, self.timeperiods))
+        # And the numbers of services of each host, and of members of
+        # each group, in each state
+        for host in self.hosts:
+            host._service_states = LiveStatusStates(host.services)
+        for hostgroup in self.hostgroups:
+            hostgroup._member_states = LiveStatusStates(hostgroup.members)
+            hostgroup._service_states = LiveStatusStates([s for h in hostgroup.members for s in h.services])
+        for servicegroup in self.servicegroups:
+            servicegroup._member_states = LiveStatusStates(servicegroup.members)
 
-        # Speedup authUser requests by populating _id_contact_heap with contact-names as key and
-        # an array with the associated host and service ids
-        setattr(self.hosts, '_id_contact_heap', dict())
-        setattr(self.services, '_id_contact_heap', dict())
-        setattr(self.hostgroups, '_id_contact_heap', dict())
-        setattr(self.servicegroups, '_id_contact_heap', dict())
+        # Throw away the cached results which depend on the objects which
+        # are new or gone, and those whose dependencies are unknown
+        changes = {}
+        for table in ('hosts', 'services', 'hostgroups', 'servicegroups'):
+            collection = getattr(self, table)
+            changes[table] = collection._changed_ids
+            if collection._changed_ids:
+                collection._generation = getattr(collection, '_generation', 0) + 1
+        self.cache.invalidate_reloaded(changes)
 
-        [self.hosts._id_contact_heap.setdefault(get_obj_full_name(c), []).append(k) for (k, v) in self.hosts.items.iteritems() for c in v.contacts]
-        for c in self.hosts._id_contact_heap.keys():
-            self.hosts._id_contact_heap[c].sort(key=lambda x: get_obj_full_name(self.hosts.items[x]))
+    def host_lookup_names(self, host):
+        names = [('_id_by_host_name_heap', get_obj_full_name(host))]
+        names.extend([('_id_contact_heap', get_obj_full_name(c)) for c in host.contacts])
+        names.extend([('_id_by_hostgroup_name_heap', get_obj_full_name(hg)) for hg in host.hostgroups])
+        return names
 
+    def service_lookup_names(self, service):
+        names = [('_id_by_service_name_heap', get_obj_full_name(service)),
+                 ('_id_by_host_name_heap', get_obj_full_name(service.host))]
         # strict: one must be an explicitly contact of a service in order to see it.
-        if self.service_authorization_strict:
-            [self.services._id_contact_heap.setdefault(get_obj_full_name(c), []).append(k) for (k, v) in self.services.items.iteritems() for c in v.contacts]
-        else:
-            # 1. every host contact automatically becomes a service contact
-            [self.services._id_contact_heap.setdefault(get_obj_full_name(c), []).append(k) for (k, v) in self.services.items.iteritems() for c in v.host.contacts]
-            # 2. explicit service contacts
-            [self.services._id_contact_heap.setdefault(get_obj_full_name(c), []).append(k) for (k, v) in self.services.items.iteritems() for c in v.contacts]
+        # loose: every host contact automatically becomes a service contact
         # services without contacts inherit the host's contacts (no matter of strict or loose)
-        [self.services._id_contact_heap.setdefault(get_obj_full_name(c), []).append(k) for (k, v) in self.services.items.iteritems() if not v.contacts for c in v.host.contacts]
-        for c in self.services._id_contact_heap.keys():
-            # remove duplicates
-            self.services._id_contact_heap[c] = list(set(self.services._id_contact_heap[c]))
-            self.services._id_contact_heap[c].sort(key=lambda x: get_obj_full_name(self.services.items[x]))
-
-
-        if self.group_authorization_strict:
-            for c in self.hosts._id_contact_heap.keys():
-                # only host contacts can be hostgroup-contacts at all
-                # now, which hosts does the contact know?
-                contact_host_ids = set([h for h in self.hosts._id_contact_heap[c]])
-                for (k, v) in self.hostgroups.items.iteritems():
-                    # now look if c is contact of all v.members
-                    # we already know the hosts for which c is a contact
-                    # self.hosts._id_contact_heap[c] is [(hostname, id), (hostname, id)
-                    hostgroup_host_ids = set([h.id for h in v.members])
-                    # if all of the hostgroup_host_ids are in contact_host_ids
-                    # then the hostgroup belongs to the contact
-                    if hostgroup_host_ids <= contact_host_ids:
-                        self.hostgroups._id_contact_heap.setdefault(c, []).append(v.id)
-            for c in self.services._id_contact_heap.keys():
-                # only service contacts can be servicegroup-contacts at all
-                # now, which service does the contact know?
-                contact_service_ids = set([h for h in self.services._id_contact_heap[c]])
-                for (k, v) in self.servicegroups.items.iteritems():
-                    # now look if c is contact of all v.members
-                    # we already know the services for which c is a contact
-                    # self.services._id_contact_heap[c] is [(svcdesc, id), (svcdesc, id)
-                    servicegroup_service_ids = set([h.id for h in v.members])
-                    # if all of the servicegroup_service_ids are in contact_service_ids
-                    # then the servicegroup belongs to the contact
-                    # print "%-10s %-15s %s <= %s" % (c, v.get_name(), servicegroup_service_ids, contact_service_ids)
-                    if servicegroup_service_ids <= contact_service_ids:
-                        self.servicegroups._id_contact_heap.setdefault(c, []).append(v.id)
-        else:
-            # loose: a contact of a member becomes contact of the whole group
-            [self.hostgroups._id_contact_heap.setdefault(get_obj_full_name(c), []).append(k) for (k, v) in self.hostgroups.items.iteritems() for h in v.members for c in h.contacts]
-            [self.servicegroups._id_contact_heap.setdefault(get_obj_full_name(c), []).append(k) for (k, v) in self.servicegroups.items.iteritems() for s in v.members for c in s.contacts] # todo: look at mk-livestatus. what about service's host contacts?
-        for c in self.hostgroups._id_contact_heap.keys():
-            # remove duplicates
-            self.hostgroups._id_contact_heap[c] = list(set(self.hostgroups._id_contact_heap[c]))
-            self.hostgroups._id_contact_heap[c].sort(key=lambda x: get_obj_full_name(self.hostgroups.items[x]))
-        for c in self.servicegroups._id_contact_heap.keys():
-            # remove duplicates
-            self.servicegroups._id_contact_heap[c] = list(set(self.servicegroups._id_contact_heap[c]))
-            self.servicegroups._id_contact_heap[c].sort(key=lambda x: get_obj_full_name(self.servicegroups.items[x]))
-
-        # Add another helper structure which allows direct lookup by name
+        contacts = list(service.contacts)
+        if not self.service_authorization_strict or not service.contacts:
+            contacts.extend(service.host.contacts)
+        names.extend([('_id_contact_heap', get_obj_full_name(c)) for c in contacts])
+        names.extend([('_id_by_servicegroup_name_heap', get_obj_full_name(sg)) for sg in service.servicegroups])
+        names.extend([('_id_by_hostgroup_name_heap', get_obj_full_name(hg)) for hg in service.host.hostgroups])
+        return names
+
+    def heap_collections(self):
+        return dict([(name, getattr(self, name)) for name in HEAP_COLLECTIONS])
+
+    def update_heaps(self, collections=None):
+        """
+        Update the ids of each collection sorted by name (_id_heap) and the
+        lookup tables from a name to ids (see livestatus_heaps) with the
+        items added or removed since the last time.
+        collections are the ones to update, by name, or their shadows.
+        Returns whether there were changes among the hosts, services
+        and their groups.
+        """
+        collections = collections or self.heap_collections()
         # For hosts: _id_by_host_name_heap = {'name1':id1, 'name2': id2,...}
         # For services: _id_by_host_name_heap = {'name1':[id1, id2,...], 'name2': [id6, id7,...],...} = hostname maps to list of service_ids
         # For services: _id_by_service_name_heap = {'name1':id1, 'name2': id6,...} = full_service_description maps to service_id
-        setattr(self.hosts, '_id_by_host_name_heap', dict([(get_obj_full_name(v), k) for (k, v) in self.hosts.items.iteritems()]))
-        setattr(self.services, '_id_by_service_name_heap', dict([(get_obj_full_name(v), k) for (k, v) in self.services.items.iteritems()]))
-        setattr(self.services, '_id_by_host_name_heap', dict())
-        [self.services._id_by_host_name_heap.setdefault(get_obj_full_name(v.host), []).append(k) for (k, v) in self.services.items.iteritems()]
-        logger.debug("[Livestatus Regenerator] Id by Hostname heap: %s" % str(self.services._id_by_host_name_heap))
-        for hn in self.services._id_by_host_name_heap.keys():
-            self.services._id_by_host_name_heap[hn].sort(key=lambda x: get_obj_full_name(self.services[x]))
-
-        # Add another helper structure which allows direct lookup by name
         # For hostgroups: _id_by_hostgroup_name_heap = {'name1':id1, 'name2': id2,...}
         # For servicegroups: _id_by_servicegroup_name_heap = {'name1':id1, 'name2': id2,...}
-        setattr(self.hostgroups, '_id_by_hostgroup_name_heap', dict([(get_obj_full_name(v), k) for (k, v) in self.hostgroups.items.iteritems()]))
-        setattr(self.servicegroups, '_id_by_servicegroup_name_heap', dict([(get_obj_full_name(v), k) for (k, v) in self.servicegroups.items.iteritems()]))
-
-        # For hosts: key is a hostgroup_name, value is an array with all host_ids of the hosts in this group
-        setattr(self.hosts, '_id_by_hostgroup_name_heap', dict())
-        [self.hosts._id_by_hostgroup_name_heap.setdefault(get_obj_full_name(hg), []).append(k) for (k, v) in self.hosts.items.iteritems() for hg in v.hostgroups]
-        for hg in self.hosts._id_by_hostgroup_name_heap.keys():
-            self.hosts._id_by_hostgroup_name_heap[hg].sort(key=lambda x: get_obj_full_name(self.hosts.items[x]))
-        # For services: key is a servicegroup_name, value is an array with all service_ids of the services in this group
-        setattr(self.services, '_id_by_servicegroup_name_heap', dict())
-        [self.services._id_by_servicegroup_name_heap.setdefault(get_obj_full_name(sg), []).append(k) for (k, v) in self.services.items.iteritems() for sg in v.servicegroups]
-        for sg in self.services._id_by_servicegroup_name_heap.keys():
-            self.services._id_by_servicegroup_name_heap[sg].sort(key=lambda x: get_obj_full_name(self.services[x]))
-        # For services: key is a hostgroup_name, value is an array with all service_ids of the hosts in this group
-        setattr(self.services, '_id_by_hostgroup_name_heap', dict())
-        [self.services._id_by_hostgroup_name_heap.setdefault(get_obj_full_name(hg), []).append(k) for (k, v) in self.services.items.iteritems() for hg in v.host.hostgroups]
-        for hg in self.services._id_by_hostgroup_name_heap.keys():
-            self.services._id_by_hostgroup_name_heap[hg].sort(key=lambda x: get_obj_full_name(self.services[x]))
-
-
-        # print self.services._id_by_host_name_heap
-        for hn in self.services._id_by_host_name_heap.keys():
-            self.services._id_by_host_name_heap[hn].sort(key=lambda x: get_obj_full_name(self.services[x]))
-
-
-        # Everything is new now. We should clean the cache
-        self.cache.wipeout()
+        # For hosts and services: _id_contact_heap and _id_by_hostgroup_name_heap,
+        # for services _id_by_servicegroup_name_heap, map a name to a list of ids
+        # The values tell if the names map to a unique id
+        lookups = [
+            (collections['hosts'],
+             {'_id_by_host_name_heap': True, '_id_contact_heap': False, '_id_by_hostgroup_name_heap': False},
+             self.host_lookup_names),
+            (collections['services'],
+             {'_id_by_service_name_heap': True, '_id_by_host_name_heap': False, '_id_contact_heap': False,
+              '_id_by_servicegroup_name_heap': False, '_id_by_hostgroup_name_heap': False},
+             self.service_lookup_names),
+            (collections['hostgroups'], {'_id_by_hostgroup_name_heap': True},
+             lambda hg: [('_id_by_hostgroup_name_heap', get_obj_full_name(hg))]),
+            (collections['servicegroups'], {'_id_by_servicegroup_name_heap': True},
+             lambda sg: [('_id_by_servicegroup_name_heap', get_obj_full_name(sg))]),
+            (collections['contacts'], {}, None),
+            (collections['contactgroups'], {}, None),
+            (collections['commands'], {}, None),
+            (collections['timeperiods'], {}, None),
+        ]
+        # The contacts of the items depend on the authorization settings,
+        # so everything is rebuilt when they change
+        settings = (self.service_authorization_strict, self.group_authorization_strict)
+        if getattr(self, '_heap_settings', settings) != settings:
+            for collection, tables, item_names in lookups:
+                forget_items(collection)
+        self._heap_settings = settings
+        changed = False
+        for collection, tables, item_names in lookups:
+            added, removed = item_changes(collection)
+            # the groups of these items may have other contacts now
+            collection._changed_ids = set(added + removed)
+            if not added and not removed and hasattr(collection, '_id_heap'):
+                continue
+            update_id_heap(collection, added, removed)
+            if tables:
+                visibilities = {}
+                if '_id_contact_heap' in tables:
+                    if not hasattr(collection, '_visibility') or not hasattr(collection, '_lookup_names'):
+                        collection._visibility = LiveStatusVisibility(self.bitmap_threshold)
+                    visibilities['_id_contact_heap'] = collection._visibility
+                update_lookups(collection, tables, item_names, added, removed, visibilities)
+                changed = True
+        return changed
+
+    def verify_heaps(self, collections=None):
+        """
+        Check the incrementally updated sorted ids and lookup tables
+        against a full rebuild, which replaces them.
+        Returns the names of the structures which were wrong.
+        """
+        collections = collections or self.heap_collections()
+        structures = [(name, attr) for name in HEAP_COLLECTIONS
+                      for attr in ('_id_heap', '_id_heap_position', '_id_contact_heap', '_id_by_host_name_heap',
+                                   '_id_by_service_name_heap', '_id_by_hostgroup_name_heap',
+                                   '_id_by_servicegroup_name_heap', '_visibility')]
+
+        def content(collection, attr):
+            value = getattr(collection, attr, None)
+            if isinstance(value, LiveStatusVisibility):
+                return dict([(c, set(visible)) for c, visible in value.contacts.iteritems()])
+            return value
+
+        before = {}
+        for name, attr in structures:
+            before[(name, attr)] = content(collections[name], attr)
+        for collection in collections.itervalues():
+            forget_items(collection)
+            if hasattr(collection, '_visibility'):
+                del collection._visibility
+        self.update_heaps(collections)
+        self.build_group_contact_heaps(collections)
+        wrong = [name + '.' + attr for name, attr in structures
+                 if before[(name, attr)] != content(collections[name], attr)]
+        if wrong:
+            logger.error("[Livestatus Regenerator] Rebuilt inconsistent indexes: %s" % ', '.join(wrong))
+        return wrong
+
+    def build_group_contact_heaps(self, collections=None):
+        """
+        Speedup authUser requests on the group tables by populating their
+        _id_contact_heap with contact-names as key and an array with the
+        associated group ids (see update_group_contacts).
+        strict: one must be a contact of all the members of a group (as in
+        the _id_contact_heap of the hosts and services) in order to see it.
+        loose: a contact of a member becomes contact of the whole group
+        """
+        collections = collections or self.heap_collections()
+        for groups, members in ((collections['hostgroups'], collections['hosts']),
+                                (collections['servicegroups'], collections['services'])):
+            if not hasattr(groups, '_visibility') or not hasattr(groups, '_group_contacts'):
+                groups._visibility = LiveStatusVisibility(self.bitmap_threshold)
+            if self.group_authorization_strict:
+                # the empty groups belong to everyone
+                everyone = frozenset(members._id_contact_heap)
+                lookup_names = members._lookup_names
+
+                def contacts_of(id, lookup_names=lookup_names):
+                    return [name for lookup, name in lookup_names.get(id, ()) if lookup == '_id_contact_heap']
+            else:
+                everyone = frozenset()
+                items = members.items
+
+                # todo: look at mk-livestatus. what about service's host contacts?
+                def contacts_of(id, items=items):
+                    if id not in items:
+                        return ()
+                    return set([get_obj_full_name(c) for c in items[id].contacts])
+            update_group_contacts(groups, contacts_of, self.group_authorization_strict, everyone,
+                                  getattr(members, '_changed_ids', ()), groups._visibility)
 
     def manage_initial_contact_status_brok(self, b):
         """overwrite it, because the original method deletes some values"""
@@ -323,6 +430,56 @@ class LiveStatusRegenerator(Regenerator):
 
         c.notificationways = new_notifways
 
+    def update_element(self, e, data):
+        super(LiveStatusRegenerator, self).update_element(e, data)
+        self.indexes.item_updated(e)
+        self.bump_versions(e)
+        if isinstance(e, Host):
+            collection = self.hosts
+            aggregates = [getattr(hg, '_member_states', None) for hg in getattr(e, 'hostgroups', [])]
+        elif isinstance(e, Service):
+            collection = self.services
+            host = getattr(e, 'host', None)
+            aggregates = [getattr(host, '_service_states', None)]
+            aggregates.extend([getattr(hg, '_service_states', None) for hg in getattr(host, 'hostgroups', [])])
+            aggregates.extend([getattr(sg, '_member_states', None) for sg in getattr(e, 'servicegroups', [])])
+        else:
+            return
+        for mirror in ('_columns', '_state_counters'):
+            aggregates.append(getattr(collection, mirror, None))
+        for aggregate in aggregates:
+            if aggregate is not None:
+                aggregate.item_updated(e)
+
+    def bump_versions(self, e):
+        """
+        Increment the version of e and of the objects whose columns show
+        some of its attributes, and the generation of their tables.
+        A cached row query stays valid while these don't move.
+        """
+        if isinstance(e, Host):
+            touched = [(e, self.hosts)]
+            touched.extend([(hg, self.hostgroups) for hg in getattr(e, 'hostgroups', [])])
+            touched.extend([(s, self.services) for s in getattr(e, 'services', [])])
+        elif isinstance(e, Service):
+            touched = [(e, self.services)]
+            host = getattr(e, 'host', None)
+            if host is not None:
+                touched.append((host, self.hosts))
+                # the rows of its siblings show aggregates over them (host_num_services...)
+                touched.extend([(s, self.services) for s in getattr(host, 'services', []) if s is not e])
+                touched.extend([(hg, self.hostgroups) for hg in getattr(host, 'hostgroups', [])])
+            touched.extend([(sg, self.servicegroups) for sg in getattr(e, 'servicegroups', [])])
+        else:
+            return
+        for item, collection in touched:
+            # Before all_done_linking, the groups of the items of the
+            # initial broks are still the strings of their names
+            if not isinstance(item, (Host, Service, Hostgroup, Servicegroup)):
+                continue
+            item._version = getattr(item, '_version', 0) + 1
+            collection._generation = getattr(collection, '_generation', 0) + 1
+
     def register_cache(self, cache):
         self.cache = cache
 
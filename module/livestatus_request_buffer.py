@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+try:
+    memoryview
+except NameError:  # python 2.6
+    memoryview = None
+
+#############################################################################
+
+RECV_SIZE = 8192
+
+_LF = ord(b'\n')
+_CR = ord(b'\r')
+
+#############################################################################
+
+
+class LiveStatusRequestBuffer(object):
+    ''' The input buffer of a livestatus client connection.
+
+    Data is received directly into one preallocated bytearray, and the
+    search for the end of a request (an empty line: `\\n\\n´ or
+    `\\r\\n\\r\\n´) resumes where the previous one stopped, so that each
+    received byte is scanned only once whatever the request size.
+    Several (pipelined) requests can be pending in the buffer.
+    '''
+    def __init__(self, size=2 * RECV_SIZE):
+        self.buf = bytearray(size)
+        self.start = 0  # begin of the data not yet returned as request
+        self.end = 0    # end of the received data
+        self.scan = 0   # where to resume the search of a request end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        self.start = self.end = self.scan = 0
+
+    def _reserve(self, size):
+        ''' Make sure there is room for `size´ more bytes after self.end.
+        The pending data is moved to the front of the buffer only when
+        needed, and the buffer grows only if that is still not enough. '''
+        if self.end + size <= len(self.buf):
+            return
+        if self.start:
+            pending = self.end - self.start
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.scan -= self.start
+            self.start, self.end = 0, pending
+        missing = self.end + size - len(self.buf)
+        if missing > 0:
+            self.buf.extend(bytearray(max(missing, len(self.buf))))
+
+    def feed(self, data):
+        ''' Append `data´ to the buffer. '''
+        size = len(data)
+        self._reserve(size)
+        self.buf[self.end:self.end + size] = data
+        self.end += size
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        ''' Receive at most `size´ bytes from `sock´ directly into the buffer.
+        :return: the number of bytes received.
+        '''
+        if memoryview is None:
+            data = sock.recv(size)
+            self.feed(data)
+            return len(data)
+        self._reserve(size)
+        view = memoryview(self.buf)[self.end:self.end + size]
+        try:
+            received = sock.recv_into(view, size)
+        finally:
+            # release the export of the bytearray, else it can't be resized anymore
+            del view
+        self.end += received
+        return received
+
+    def get_request(self):
+        ''' :return: the next fully received request, with its ending empty line,
+        or None if none is yet fully available.
+        '''
+        buf, end = self.buf, self.end
+        pos = self.scan
+        while True:
+            idx = buf.find(b'\n', pos, end)
+            if idx < 0:
+                self.scan = end
+                return None
+            if idx + 1 >= end:
+                break  # can't decide yet
+            nxt = buf[idx + 1]
+            if nxt == _LF:
+                return self._pop_request(idx + 2)
+            if nxt == _CR and idx > self.start and buf[idx - 1] == _CR:
+                if idx + 2 >= end:
+                    break
+                if buf[idx + 2] == _LF:
+                    return self._pop_request(idx + 3)
+            pos = idx + 1
+        # the end of the request could be just beyond what we have received:
+        self.scan = idx
+        return None
+
+    def get_unterminated_request(self):
+        ''' :return: all the pending data if it ends with a `\\n´, else None. '''
+        if self.end > self.start and self.buf[self.end - 1] == _LF:
+            return self._pop_request(self.end)
+        return None
+
+    def _pop_request(self, request_end):
+        request = bytes(self.buf[self.start:request_end])
+        if request_end == self.end:
+            self.clear()
+        else:
+            self.start = self.scan = request_end
+        return request
@@ -27,6 +27,7 @@ from types import GeneratorType
 from collections import namedtuple
 
 import csv
+import tempfile
 from StringIO import StringIO
 
 try:
@@ -54,6 +55,21 @@ from livestatus_query_error import LiveStatusQueryError
 Separators = namedtuple('Separators',
                         ('line', 'field', 'list', 'pipe')) # pipe is used within livestatus_broker.mapping 
 
+# Size of the chunks read back from a spooled response
+SPOOL_CHUNK_SIZE = 65536
+
+
+def iter_spool(spool, chunk_size=SPOOL_CHUNK_SIZE):
+    ''' Yield the content of `spool` by chunks, then close it. '''
+    try:
+        while True:
+            data = spool.read(chunk_size)
+            if not data:
+                return
+            yield data
+    finally:
+        spool.close()
+
 
 class LiveStatusListResponse(list):
     ''' A class to be able to recognize list of data/bytes to be sent vs plain data/bytes. '''
@@ -90,6 +106,35 @@ generator value at its index in this list.
                 tot += len(value)
         return tot
 
+    def has_generators(self):
+        ''' :return: True if this instance, or one of its sub-LiveStatusListResponse, contains generators. '''
+        for value in super(LiveStatusListResponse, self).__iter__():
+            if isinstance(value, GeneratorType):
+                return True
+            if isinstance(value, LiveStatusListResponse) and value.has_generators():
+                return True
+        return False
+
+    def spool(self, max_size):
+        '''Exhaust this instance into a temporary file, which is kept in memory
+until it grows over max_size bytes. Unicode data is utf-8 encoded.
+        :return: The temporary file, rewound, and the number of bytes written to it.
+        '''
+        spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+        length = 0
+        for data in self:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            spool.write(data)
+            length += len(data)
+        spool.seek(0)
+        return spool, length
+
+    def join(self):
+        '''Exhaust this instance into one string. Unicode data is utf-8 encoded.'''
+        return b''.join([data.encode('utf-8') if isinstance(data, unicode) else data
+                         for data in self])
+
     def clean(self):
         idx = len(self) - 1
         while idx >= 0:
@@ -112,6 +157,10 @@ class LiveStatusResponse:
 
     separators = Separators('\n', ';', ',', '|')
 
+    # For fixed16 responses built from generators: the size in bytes above
+    # which the response is spooled to disk while its length is computed.
+    spool_threshold = 4 * 1024 * 1024
+
     def __init__(self, responseheader='off', outputformat='csv', keepalive='off', columnheaders='off', separators=separators):
         self.responseheader = responseheader
         self.outputformat = outputformat
@@ -144,7 +193,15 @@ class LiveStatusResponse:
 
     def respond(self):
         if self.responseheader == 'fixed16':
-            responselength = 1 + self.get_response_len() # 1 for the final '\n'
+            if self.output.has_generators():
+                # The length must be known before the first byte is sent,
+                # but we don't want to hold the whole generated data in memory:
+                spool, responselength = self.output.spool(self.spool_threshold)
+                self.output.clean()
+                self.output.append(iter_spool(spool))
+            else:
+                responselength = self.get_response_len()
+            responselength += 1 # 1 for the final '\n'
             self.output.insert(0, '%3d %11d\n' % (self.statuscode, responselength))
         self.output.append('\n')
         return self.output, self.keepalive
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import operator
+
+from shinken.log import logger
+
+from livestatus_columns import is_number
+
+"""
+Live counters of the hosts and services by their state.
+
+The tactical overviews of the web interfaces ask for counts like
+"Stats: state = 2\nStats: acknowledged = 0\nStatsAnd: 2" over all the
+services, which means a scan of every service each time. A
+LiveStatusStateCounters counts the items of a collection by the values
+of a few status columns, and is kept up to date from the previous and new
+values of each updated item. A Stats: query which only counts, without
+Filter: nor authentication, on those columns only, is answered by
+evaluating its Stats: conditions once per distinct combination of values.
+"""
+
+# scheduled_downtime_depth is kept as it is, not as an "in downtime" flag,
+# so that any comparison of it can be answered
+STATE_COUNTER_COLUMNS = ('state', 'state_type', 'acknowledged', 'scheduled_downtime_depth', 'has_been_checked')
+
+COMPARATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+
+class LiveStatusStateCounters(object):
+    """
+    The number of items of a host or service collection for each
+    combination of values of the STATE_COUNTER_COLUMNS.
+    """
+
+    def __init__(self, collection, cls, columns=STATE_COUNTER_COLUMNS):
+        self.columns = {}
+        self.functions = []
+        for column in columns:
+            function = getattr(getattr(cls, 'lsm_' + column, None), 'im_func', None)
+            if function is None:
+                logger.debug("[Livestatus State Counters] %s has no column %s" % (cls.__name__, column))
+                continue
+            self.columns[column] = len(self.functions)
+            self.functions.append(function)
+        self.keys = {}
+        self.counts = {}
+        for item in collection.items.itervalues():
+            self.item_updated(item)
+
+    def item_key(self, item):
+        key = []
+        for function in self.functions:
+            try:
+                key.append(function(item, None))
+            except Exception:
+                # the filters compare the default value in this case
+                key.append(getattr(function, 'default', None))
+        return tuple(key)
+
+    def item_updated(self, item):
+        item_id = getattr(item, 'id', None)
+        if item_id is None:
+            return
+        key = self.item_key(item)
+        old = self.keys.get(item_id)
+        if old == key:
+            return
+        if old is not None:
+            if self.counts[old] == 1:
+                del self.counts[old]
+            else:
+                self.counts[old] -= 1
+        self.keys[item_id] = key
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def supports(self, tree):
+        """Whether tree only compares the counted columns with numbers"""
+        kind = tree[0]
+        if kind == 'true':
+            return True
+        if kind == 'leaf':
+            op, column, reference = tree[1:]
+            return column in self.columns and op in COMPARATORS and is_number(reference)
+        if kind == 'not':
+            return self.supports(tree[1])
+        if kind in ('and', 'or'):
+            for child in tree[1]:
+                if not self.supports(child):
+                    return False
+            return True
+        return False
+
+    def matches(self, tree, key):
+        kind = tree[0]
+        if kind == 'leaf':
+            op, column, reference = tree[1:]
+            return COMPARATORS[op](key[self.columns[column]], reference)
+        if kind == 'and':
+            for child in tree[1]:
+                if not self.matches(child, key):
+                    return False
+            return True
+        if kind == 'or':
+            for child in tree[1]:
+                if self.matches(child, key):
+                    return True
+            return False
+        if kind == 'not':
+            return not self.matches(tree[1], key)
+        return True
+
+    def count(self, tree):
+        """The number of items matching tree, which must be supported"""
+        total = 0
+        for key, number in self.counts.items():
+            if self.matches(tree, key):
+                total += number
+        return total
+
+
+class LiveStatusStates(object):
+    """
+    The number of items in each state, soft and hard, and of the pending
+    ones: the services of a host for its num_services_* and worst_service_*
+    columns, the members of a host or service group and the services of
+    the members of a host group for theirs. The regenerator keeps them in
+    the _service_states of the hosts and host groups and in the
+    _member_states of the groups, and updates them with the status of the
+    items.
+    """
+
+    def __init__(self, items):
+        self.keys = {}
+        self.soft = {}
+        self.hard = {}
+        self.pending = 0
+        for item in items:
+            self.item_updated(item)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def item_updated(self, item):
+        key = (item.state_id, item.state_type_id == 1, item.has_been_checked == 0)
+        old = self.keys.get(item.id)
+        if old == key:
+            return
+        if old is not None:
+            self.count(old, -1)
+        self.keys[item.id] = key
+        self.count(key, 1)
+
+    def count(self, key, number):
+        state, hard, pending = key
+        self.add(self.soft, state, number)
+        if hard:
+            self.add(self.hard, state, number)
+        if pending:
+            self.pending += number
+
+    def add(self, counts, state, number):
+        number += counts.get(state, 0)
+        if number:
+            counts[state] = number
+        else:
+            del counts[state]
+
+    def num_soft(self, state):
+        return self.soft.get(state, 0)
+
+    def num_hard(self, state):
+        return self.hard.get(state, 0)
+
+    def soft_states(self):
+        """The states of the items, each one once"""
+        return sorted(self.soft)
+
+    def hard_states(self):
+        """The hard states of the items, each one once"""
+        return sorted(self.hard)
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import math
+
+"""
+The aggregates of the Stats: statements are computed in one pass over the
+rows: each row updates an accumulator per Stats: statement (and per group
+with StatsGroupBy:), and only the accumulators are kept.
+"""
+
+
+class LiveStatusStatsAccumulator(object):
+    """
+    The running state of one Stats: aggregate. operator is one of count,
+    sum, min, max, avg and std. std is the sample standard deviation,
+    like mk-livestatus computes it.
+    """
+
+    __slots__ = ('operator', 'count', 'sum', 'sumq', 'min', 'max')
+
+    def __init__(self, operator):
+        self.operator = operator
+        self.count = 0
+        self.sum = 0
+        self.sumq = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.operator == 'std':
+            self.sumq += value * value
+        elif self.operator == 'min':
+            if self.min is None or value < self.min:
+                self.min = value
+        elif self.operator == 'max':
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def result(self):
+        operator = self.operator
+        if operator == 'count':
+            return self.count
+        if operator == 'sum':
+            return self.sum
+        if self.count == 0:
+            return 0
+        if operator == 'min':
+            return self.min
+        if operator == 'max':
+            return self.max
+        if operator == 'avg':
+            return self.sum / self.count
+        if operator == 'std':
+            if self.count < 2:
+                return 0.0
+            variance = (self.sumq - self.sum * self.sum / self.count) / (self.count - 1)
+            return math.sqrt(max(variance, 0.0))
+        raise ValueError("wrong stats operation %s" % operator)
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS for A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Which items of a collection each contact may see, for the AuthUser: header.
+
+The regenerator keeps the ids of the items of each contact in sorted lists
+(_id_contact_heap), which are fine to walk through, but not to test: a
+query whose items are preselected by its hints or by an index must check
+each of them against the list of its AuthUser:.
+
+A LiveStatusVisibility holds the same ids for each contact as a set or,
+for the contacts which see more than bitmap_threshold items, as a bitmap
+over slots given to the items of the collection. Both answer `id in
+visible` at once, the bitmap in a fraction of the memory of a set. They
+are updated with the items and contacts, like the lists.
+"""
+
+DEFAULT_BITMAP_THRESHOLD = 1024
+
+
+class VisibilityBitmap(object):
+    """The ids of the items a contact sees, as the bits of their slots"""
+
+    def __init__(self, visibility, ids=()):
+        self.slots = visibility.slots
+        self.slot_ids = visibility.slot_ids
+        self.bits = bytearray()
+        self.count = 0
+        for id in ids:
+            self.add(id)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        slot = self.slots.get(id)
+        if slot is None or slot >> 3 >= len(self.bits):
+            return False
+        return self.bits[slot >> 3] & (1 << (slot & 7)) != 0
+
+    def __iter__(self):
+        for byte, value in enumerate(self.bits):
+            if value:
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield self.slot_ids[(byte << 3) | bit]
+
+    def add(self, id):
+        slot = self.slots[id]
+        byte, mask = slot >> 3, 1 << (slot & 7)
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(byte + 1 - len(self.bits)))
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def discard(self, id):
+        slot = self.slots.get(id)
+        if slot is None or slot >> 3 >= len(self.bits):
+            return
+        byte, mask = slot >> 3, 1 << (slot & 7)
+        if self.bits[byte] & mask:
+            self.bits[byte] &= ~mask
+            self.count -= 1
+
+
+class LiveStatusVisibility(object):
+    """The items of a collection visible to each contact"""
+
+    def __init__(self, bitmap_threshold=DEFAULT_BITMAP_THRESHOLD):
+        self.bitmap_threshold = bitmap_threshold
+        # the slot of each item in the bitmaps, and the item of each slot
+        self.slots = {}
+        self.slot_ids = []
+        self.free_slots = []
+        # contact name -> set or VisibilityBitmap
+        self.contacts = {}
+        # the contacts whose set or bitmap is shared with another copy
+        self.shared = set()
+
+    def copy(self):
+        """A copy which shares the sets and bitmaps until it modifies them"""
+        other = LiveStatusVisibility(self.bitmap_threshold)
+        other.slots = dict(self.slots)
+        other.slot_ids = list(self.slot_ids)
+        other.free_slots = list(self.free_slots)
+        other.contacts = dict(self.contacts)
+        other.shared = set(self.contacts)
+        self.shared = set(self.contacts)
+        return other
+
+    def own(self, contact):
+        """The set or bitmap of contact, which this copy alone may modify"""
+        visible = self.contacts.get(contact)
+        if visible is not None and contact in self.shared:
+            self.shared.discard(contact)
+            if isinstance(visible, VisibilityBitmap):
+                visible = VisibilityBitmap(self, visible)
+            else:
+                visible = set(visible)
+            self.contacts[contact] = visible
+        return visible
+
+    def get(self, contact):
+        return self.contacts.get(contact)
+
+    def add(self, contact, id):
+        if id not in self.slots:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.slot_ids[slot] = id
+            else:
+                slot = len(self.slot_ids)
+                self.slot_ids.append(id)
+            self.slots[id] = slot
+        visible = self.own(contact)
+        if visible is None:
+            visible = self.contacts[contact] = set()
+        visible.add(id)
+        if isinstance(visible, set) and len(visible) > self.bitmap_threshold:
+            self.contacts[contact] = VisibilityBitmap(self, visible)
+
+    def discard(self, contact, id):
+        visible = self.own(contact)
+        if visible is None:
+            return
+        visible.discard(id)
+        if not visible:
+            del self.contacts[contact]
+        elif isinstance(visible, VisibilityBitmap) and len(visible) < self.bitmap_threshold // 2:
+            self.contacts[contact] = set(visible)
+
+    def remove_item(self, id):
+        """Release the slot of an item which is gone from the collection"""
+        slot = self.slots.get(id)
+        if slot is None:
+            return
+        # the contacts should not see it anymore, but its slot may be reused
+        for contact, visible in self.contacts.items():
+            if isinstance(visible, VisibilityBitmap) and id in visible:
+                self.own(contact).discard(id)
+        del self.slots[id]
+        self.slot_ids[slot] = None
+        self.free_slots.append(slot)
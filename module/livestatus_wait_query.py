@@ -74,10 +74,10 @@ class LiveStatusWaitQuery(LiveStatusQuery):
                         host_name, service_description = item.split(' ', 1)
                     self.filtercolumns.append('host_name')
                     self.prefiltercolumns.append('host_name')
-                    self.filter_stack.put(self.make_filter('=', 'host_name', host_name))
+                    self.put_filter('filter_stack', '=', 'host_name', host_name)
                     self.filtercolumns.append('description')
                     self.prefiltercolumns.append('description')
-                    self.filter_stack.put(self.make_filter('=', 'description', service_description))
+                    self.put_filter('filter_stack', '=', 'description', service_description)
                     # A WaitQuery works like an ordinary Query. But if
                     # we already know which object we're watching for
                     # changes, instead of scanning the entire list and
@@ -89,13 +89,13 @@ class LiveStatusWaitQuery(LiveStatusQuery):
                     attribute = self.strip_table_from_column('name')
                     self.filtercolumns.append('name')
                     self.prefiltercolumns.append('name')
-                    self.filter_stack.put(self.make_filter('=', 'name', item))
+                    self.put_filter('filter_stack', '=', 'name', item)
                     metafilter += "Filter: host_name = %s\n" % (item,)
                 else:
                     attribute = self.strip_table_from_column('name')
                     self.filtercolumns.append('name')
                     self.prefiltercolumns.append('name')
-                    self.filter_stack.put(self.make_filter('=', 'name', item))
+                    self.put_filter('filter_stack', '=', 'name', item)
                     # For the other tables this works like an ordinary query.
                     # In the future there might be more lookup-tables
             elif keyword == 'WaitTrigger':
@@ -121,7 +121,7 @@ class LiveStatusWaitQuery(LiveStatusQuery):
                     # the desired operation
                     self.filtercolumns.append(attribute)
                     self.prefiltercolumns.append(attribute)
-                    self.filter_stack.put(self.make_filter(operator, attribute, reference))
+                    self.put_filter('filter_stack', operator, attribute, reference)
                     if self.table == 'log':
                         self.db.add_filter(operator, attribute, reference)
                 else:
@@ -132,7 +132,7 @@ class LiveStatusWaitQuery(LiveStatusQuery):
                 # Take the last andnum functions from the stack
                 # Construct a new function which makes a logical and
                 # Put the function back onto the stack
-                self.filter_stack.and_elements(andnum)
+                self.stack_operation('filter_stack', ('and', andnum))
                 if self.table == 'log':
                     self.db.add_filter_and(andnum)
             elif keyword == 'WaitConditionOr':
@@ -140,7 +140,7 @@ class LiveStatusWaitQuery(LiveStatusQuery):
                 # Take the last ornum functions from the stack
                 # Construct a new function which makes a logical or
                 # Put the function back onto the stack
-                self.filter_stack.or_elements(ornum)
+                self.stack_operation('filter_stack', ('or', ornum))
                 if self.table == 'log':
                     self.db.add_filter_or(ornum)
             elif keyword == 'WaitTimeout':
@@ -156,7 +156,7 @@ class LiveStatusWaitQuery(LiveStatusQuery):
         self.prefiltercolumns = list(set(self.prefiltercolumns))
 
         # Make one big filter where the single filters are anded
-        self.filter_stack.and_elements(self.filter_stack.qsize())
+        self.build_filter_stacks()
 
         # if self.table == 'log':
         #    self.sql_filter_stack.and_elements(self.sql_filter_stack.qsize())
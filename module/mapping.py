@@ -49,6 +49,7 @@ from shinken.receiverlink import ReceiverLink
 from shinken.pollerlink import PollerLink
 
 from shinken.log import logger
+from livestatus_state_counters import LiveStatusStates
 from log_line import LOGCLASS_INFO, LOGCLASS_ALERT, LOGCLASS_PROGRAM, LOGCLASS_NOTIFICATION, LOGCLASS_PASSIVECHECK, LOGCLASS_COMMAND, LOGCLASS_STATE, LOGCLASS_INVALID, LOGCLASS_ALL, LOGOBJECT_INFO, LOGOBJECT_HOST, LOGOBJECT_SERVICE, LOGOBJECT_CONTACT, Logline, LoglineWrongFormat
 from shinken.misc.common import DICT_MODATTR
 
@@ -102,6 +103,31 @@ def worst_service_state(state_1, state_2):
     return state_2
 
 
+def service_states(host):
+    """The numbers of services of host in each state. They are kept up to
+    date by the regenerator, or counted if they aren't (yet)."""
+    states = getattr(host, '_service_states', None)
+    if states is None or len(states) != len(host.services):
+        states = LiveStatusStates(host.services)
+    return states
+
+
+def member_states(group):
+    """The numbers of members of a host or service group in each state"""
+    states = getattr(group, '_member_states', None)
+    if states is None or len(states) != len(group.members):
+        states = LiveStatusStates(group.members)
+    return states
+
+
+def hostgroup_service_states(group):
+    """The numbers of services of the members of a host group in each state"""
+    states = getattr(group, '_service_states', None)
+    if states is None or len(states) != sum([len(x.services) for x in group.members]):
+        states = LiveStatusStates([y for x in group.members for y in x.services])
+    return states
+
+
 def find_pnp_perfdata_xml(name, request):
     """Check if a pnp xml file exists for a given host or service name."""
     if request.pnp_path_readable:
@@ -566,39 +592,39 @@ livestatus_attribute_map = {
         },
         'num_services_crit': {
             'description': 'The number of the host\'s services with the soft state CRIT',
-            'function': lambda item, req: len([x for x in item.services if x.state_id == 2]),
+            'function': lambda item, req: service_states(item).num_soft(2),
         },
         'num_services_hard_crit': {
             'description': 'The number of the host\'s services with the hard state CRIT',
-            'function': lambda item, req: len([x for x in item.services if x.state_id == 2 and x.state_type_id == 1]),
+            'function': lambda item, req: service_states(item).num_hard(2),
         },
         'num_services_hard_ok': {
             'description': 'The number of the host\'s services with the hard state OK',
-            'function': lambda item, req: len([x for x in item.services if x.state_id == 0 and x.state_type_id == 1]),
+            'function': lambda item, req: service_states(item).num_hard(0),
         },
         'num_services_hard_unknown': {
             'description': 'The number of the host\'s services with the hard state UNKNOWN',
-            'function': lambda item, req: len([x for x in item.services if x.state_id == 3 and x.state_type_id == 1]),
+            'function': lambda item, req: service_states(item).num_hard(3),
         },
         'num_services_hard_warn': {
             'description': 'The number of the host\'s services with the hard state WARN',
-            'function': lambda item, req: len([x for x in item.services if x.state_id == 1 and x.state_type_id == 1]),
+            'function': lambda item, req: service_states(item).num_hard(1),
         },
         'num_services_ok': {
             'description': 'The number of the host\'s services with the soft state OK',
-            'function': lambda item, req: len([x for x in item.services if x.state_id == 0]),
+            'function': lambda item, req: service_states(item).num_soft(0),
         },
         'num_services_pending': {
             'description': 'The number of the host\'s services which have not been checked yet (pending)',
-            'function': lambda item, req: len([x for x in item.services if x.has_been_checked == 0]),
+            'function': lambda item, req: service_states(item).pending,
         },
         'num_services_unknown': {
             'description': 'The number of the host\'s services with the soft state UNKNOWN',
-            'function': lambda item, req: len([x for x in item.services if x.state_id == 3]),
+            'function': lambda item, req: service_states(item).num_soft(3),
         },
         'num_services_warn': {
             'description': 'The number of the host\'s services with the soft state WARN',
-            'function': lambda item, req: len([x for x in item.services if x.state_id == 1]),
+            'function': lambda item, req: service_states(item).num_soft(1),
         },
         'obsess_over_host': {
             'description': 'The current obsess_over_host setting... (0/1)',
@@ -709,12 +735,12 @@ livestatus_attribute_map = {
         },
         'worst_service_hard_state': {
             'description': 'The worst hard state of all of the host\'s services (OK <= WARN <= UNKNOWN <= CRIT)',
-            'function': lambda item, req: reduce(worst_service_state, (x.state_id for x in item.services if x.state_type_id == 1), 0),
+            'function': lambda item, req: reduce(worst_service_state, service_states(item).hard_states(), 0),
             'datatype': int,
         },
         'worst_service_state': {
             'description': 'The worst soft state of all of the host\'s services (OK <= WARN <= UNKNOWN <= CRIT)',
-            'function': lambda item, req: reduce(worst_service_state, (x.state_id for x in item.services), 0),
+            'function': lambda item, req: reduce(worst_service_state, service_states(item).soft_states(), 0),
             'datatype': int,
         },
         'x_3d': {
@@ -1514,19 +1540,19 @@ livestatus_attribute_map = {
         },
         'num_hosts_down': {
             'description': 'The number of hosts in the group that are down',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 1]),
+            'function': lambda item, req: member_states(item).num_soft(1),
         },
         'num_hosts_pending': {
             'description': 'The number of hosts in the group that are pending',
-            'function': lambda item, req: len([x for x in item.members if x.has_been_checked == 0]),
+            'function': lambda item, req: member_states(item).pending,
         },
         'num_hosts_unreach': {
             'description': 'The number of hosts in the group that are unreachable',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 2]),
+            'function': lambda item, req: member_states(item).num_soft(2),
         },
         'num_hosts_up': {
             'description': 'The number of hosts in the group that are up',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 0]),
+            'function': lambda item, req: member_states(item).num_soft(0),
         },
         'num_services': {
             'description': 'The total number of services of hosts in this group',
@@ -1534,53 +1560,53 @@ livestatus_attribute_map = {
         },
         'num_services_crit': {
             'description': 'The total number of services with the state CRIT of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.state_id == 2]),
+            'function': lambda item, req: hostgroup_service_states(item).num_soft(2),
         },
         'num_services_hard_crit': {
             'description': 'The total number of services with the state CRIT of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.state_id == 2 and y.state_type_id == 1]),
+            'function': lambda item, req: hostgroup_service_states(item).num_hard(2),
         },
         'num_services_hard_ok': {
             'description': 'The total number of services with the state OK of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.state_id == 0 and y.state_type_id == 1]),
+            'function': lambda item, req: hostgroup_service_states(item).num_hard(0),
         },
         'num_services_hard_unknown': {
             'description': 'The total number of services with the state UNKNOWN of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.state_id == 3 and y.state_type_id == 1]),
+            'function': lambda item, req: hostgroup_service_states(item).num_hard(3),
         },
         'num_services_hard_warn': {
             'description': 'The total number of services with the state WARN of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.state_id == 2 and y.state_type_id == 1]),
+            'function': lambda item, req: hostgroup_service_states(item).num_hard(1),
         },
         'num_services_ok': {
             'description': 'The total number of services with the state OK of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.state_id == 0]),
+            'function': lambda item, req: hostgroup_service_states(item).num_soft(0),
         },
         'num_services_pending': {
             'description': 'The total number of services with the state Pending of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.has_been_checked == 0]),
+            'function': lambda item, req: hostgroup_service_states(item).pending,
         },
         'num_services_unknown': {
             'description': 'The total number of services with the state UNKNOWN of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.state_id == 3]),
+            'function': lambda item, req: hostgroup_service_states(item).num_soft(3),
         },
         'num_services_warn': {
             'description': 'The total number of services with the state WARN of hosts in this group',
-            'function': lambda item, req: len([y for x in item.members for y in x.services if y.state_id == 1]),
+            'function': lambda item, req: hostgroup_service_states(item).num_soft(1),
         },
         'worst_host_state': {
             'description': 'The worst state of all of the groups\' hosts (UP <= UNREACHABLE <= DOWN)',
-            'function': lambda item, req: reduce(worst_host_state, (x.state_id for x in item.members if x.state_type_id == 1), 0),
+            'function': lambda item, req: reduce(worst_host_state, member_states(item).hard_states(), 0),
             'datatype': int,
         },
         'worst_service_hard_state': {
             'description': 'The worst state of all services that belong to a host of this group (OK <= WARN <= UNKNOWN <= CRIT)',
-            'function': lambda item, req: reduce(worst_service_state, (y.state_id for x in item.members for y in x.services if y.state_type_id == 1), 0),
+            'function': lambda item, req: reduce(worst_service_state, hostgroup_service_states(item).hard_states(), 0),
             'datatype': int,
         },
         'worst_service_state': {
             'description': 'The worst state of all services that belong to a host of this group (OK <= WARN <= UNKNOWN <= CRIT)',
-            'function': lambda item, req: reduce(worst_service_state, (y.state_id for x in item.members for y in x.services), 0),
+            'function': lambda item, req: reduce(worst_service_state, hostgroup_service_states(item).soft_states(), 0),
             'datatype': int,
         },
     },
@@ -1622,52 +1648,52 @@ livestatus_attribute_map = {
         },
         'num_services_crit': {
             'description': 'The number of services in the group that are CRIT',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 2]),
+            'function': lambda item, req: member_states(item).num_soft(2),
             'datatype': int,
         },
         'num_services_hard_crit': {
             'description': 'The number of services in the group that are CRIT',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 2 and x.state_type_id == 1]),
+            'function': lambda item, req: member_states(item).num_hard(2),
             'datatype': int,
         },
         'num_services_hard_ok': {
             'description': 'The number of services in the group that are OK',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 0 and x.state_type_id == 1]),
+            'function': lambda item, req: member_states(item).num_hard(0),
             'datatype': int,
         },
         'num_services_hard_unknown': {
             'description': 'The number of services in the group that are UNKNOWN',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 3 and x.state_type_id == 1]),
+            'function': lambda item, req: member_states(item).num_hard(3),
             'datatype': int,
         },
         'num_services_hard_warn': {
             'description': 'The number of services in the group that are WARN',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 1 and x.state_type_id == 1]),
+            'function': lambda item, req: member_states(item).num_hard(1),
             'datatype': int,
         },
         'num_services_ok': {
             'description': 'The number of services in the group that are OK',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 0]),
+            'function': lambda item, req: member_states(item).num_soft(0),
             'datatype': int,
         },
         'num_services_pending': {
             'description': 'The number of services in the group that are PENDING',
-            'function': lambda item, req: len([x for x in item.members if x.has_been_checked == 0]),
+            'function': lambda item, req: member_states(item).pending,
             'datatype': int,
         },
         'num_services_unknown': {
             'description': 'The number of services in the group that are UNKNOWN',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 3]),
+            'function': lambda item, req: member_states(item).num_soft(3),
             'datatype': int,
         },
         'num_services_warn': {
             'description': 'The number of services in the group that are WARN',
-            'function': lambda item, req: len([x for x in item.members if x.state_id == 1]),
+            'function': lambda item, req: member_states(item).num_soft(1),
             'datatype': int,
         },
         'worst_service_state': {
             'description': 'The worst soft state of all of the groups services (OK <= WARN <= UNKNOWN <= CRIT)',
-            'function': lambda item, req: reduce(worst_service_state, (x.state_id for x in item.members), 0),
+            'function': lambda item, req: reduce(worst_service_state, member_states(item).soft_states(), 0),
             'datatype': int,
         },
     },
@@ -3465,6 +3491,16 @@ livestatus_attribute_map = {
             'function': lambda item, req: item.passive_service_checks_enabled,
             'datatype': bool,
         },
+        'broks_applied': {
+            'description': 'The number of broks applied to the status data, once the superseded status updates of each batch are dropped',
+            'function': lambda item, req: req.counters.count('broks_applied'),
+            'datatype': int,
+        },
+        'broks_received': {
+            'description': 'The number of broks received from the broker',
+            'function': lambda item, req: req.counters.count('broks_received'),
+            'datatype': int,
+        },
         'cached_log_messages': {
             'description': 'The current number of log messages MK Livestatus keeps in memory',
             'function': lambda item, req: 0,  # REPAIRME
@@ -3490,6 +3526,11 @@ livestatus_attribute_map = {
             'function': lambda item, req: item.check_service_freshness,
             'datatype': bool,
         },
+        'coalesced_queries': {
+            'description': 'The number of queries answered with the result of an identical concurrent query',
+            'function': lambda item, req: req.counters.count('coalesced_queries'),
+            'datatype': int,
+        },
         'connections': {
             'description': 'The number of client connections to Livestatus since program start',
             'function': lambda item, req: 0,  # REPAIRME
@@ -3565,6 +3606,11 @@ livestatus_attribute_map = {
             'function': lambda item, req: 0,  # REPAIRME
             'datatype': float,
         },
+        'history_cache_hits': {
+            'description': 'The number of log queries answered from the on-disk cache of reports of the past',
+            'function': lambda item, req: req.counters.count('history_cache_hits'),
+            'datatype': int,
+        },
         'interval_length': {
             'description': 'The default interval length from nagios.cfg',
             'function': lambda item, req: item.interval_length,
@@ -3619,6 +3665,36 @@ livestatus_attribute_map = {
             'function': lambda item, req: item.obsess_over_services,
             'datatype': bool,
         },
+        'output_bytes': {
+            'description': 'The number of bytes sent to Livestatus clients since program start',
+            'function': lambda item, req: req.counters.count('output_bytes'),
+            'datatype': int,
+        },
+        'output_bytes_per_syscall': {
+            'description': 'The average number of bytes sent to Livestatus clients per send system call',
+            'function': lambda item, req: req.counters.count('output_bytes') / float(max(1, req.counters.count('output_syscalls'))),
+            'datatype': float,
+        },
+        'output_cache_hits': {
+            'description': 'The number of responses sent as formatted in the query cache',
+            'function': lambda item, req: req.counters.count('output_cache_hits'),
+            'datatype': int,
+        },
+        'output_syscalls': {
+            'description': 'The number of send system calls made to Livestatus clients since program start',
+            'function': lambda item, req: req.counters.count('output_syscalls'),
+            'datatype': int,
+        },
+        'plan_cache_hits': {
+            'description': 'The number of queries whose parsing was found in the query plan cache',
+            'function': lambda item, req: req.counters.count('plan_cache_hits'),
+            'datatype': int,
+        },
+        'plan_cache_misses': {
+            'description': 'The number of queries which had to be parsed from scratch',
+            'function': lambda item, req: req.counters.count('plan_cache_misses'),
+            'datatype': int,
+        },
         'process_performance_data': {
             'description': 'Whether processing of performance data is activated in general (0/1)',
             'function': lambda item, req: item.process_performance_data,
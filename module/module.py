@@ -70,9 +70,16 @@ from shinken.misc.datamanager import datamgr
 
 # Local import
 from .livestatus_obj import LiveStatus
+from .livestatus_response import LiveStatusResponse
 from .livestatus_regenerator import LiveStatusRegenerator
-from .livestatus_query_cache import LiveStatusQueryCache
+from .livestatus_index import DEFAULT_INDEXED_COLUMNS
+from .livestatus_columns import DEFAULT_COLUMNAR_COLUMNS
+from .livestatus_visibility import DEFAULT_BITMAP_THRESHOLD
+from .livestatus_brok_coalescer import coalesce_broks
+from .livestatus_query_cache import LiveStatusQueryCache, DEFAULT_CACHE_MAX_BYTES, DEFAULT_CACHE_STRIPES
+from .livestatus_history_cache import LiveStatusHistoryCache, DEFAULT_HISTORY_CACHE_MAX_BYTES, DEFAULT_HISTORY_CACHE_MARGIN
 from .livestatus_client_thread import LiveStatusClientThread
+from .livestatus_event_server import LiveStatusEventServer
 
 # actually "sub-"imported by logstore_sqlite or some others
 # until they are corrected to import from the good place we need them here:
@@ -127,6 +134,30 @@ class LiveStatus_broker(BaseModule, Daemon):
         self.debug = getattr(modconf, 'debug', None)
         self.debug_queries = (getattr(modconf, 'debug_queries', '0') == '1')
         self.use_query_cache = (getattr(modconf, 'query_cache', '0') == '1')
+        self.query_plan_cache_size = int(getattr(modconf, 'query_plan_cache_size', '512'))
+        # The memory for the cached results, in MB
+        self.query_cache_max_bytes = int(float(getattr(modconf, 'query_cache_memory', DEFAULT_CACHE_MAX_BYTES / 1048576)) * 1048576)
+        # The results which took less seconds to compute aren't cached
+        self.query_cache_min_time = float(getattr(modconf, 'query_cache_min_time', '0'))
+        # The time to live of the cached results of some categories of queries, like global_stats=60
+        self.query_cache_ttls = {}
+        for ttl in [c.strip() for c in getattr(modconf, 'query_cache_ttl', '').split(',') if c.strip()]:
+            name, _, seconds = ttl.partition('=')
+            self.query_cache_ttls[name.strip()] = float(seconds)
+        # The number of independently locked parts of the query cache
+        self.query_cache_stripes = int(getattr(modconf, 'query_cache_stripes', DEFAULT_CACHE_STRIPES))
+        # Keep the formatted responses along with the cached results
+        self.query_cache_output = (getattr(modconf, 'query_cache_output', '0') == '1')
+        # Let identical concurrent queries share one execution
+        self.query_coalescing = (getattr(modconf, 'query_coalescing', '1') == '1')
+        # The directory of the cached responses to the log queries of the past
+        self.history_cache_path = getattr(modconf, 'history_cache_path', '')
+        # Its size on disk, in MB
+        self.history_cache_max_bytes = int(float(getattr(modconf, 'history_cache_size', DEFAULT_HISTORY_CACHE_MAX_BYTES / 1048576)) * 1048576)
+        # and the seconds after which a past time range is known to have all its logs
+        self.history_cache_margin = int(getattr(modconf, 'history_cache_margin', DEFAULT_HISTORY_CACHE_MARGIN))
+        LiveStatusResponse.spool_threshold = int(getattr(modconf, 'response_spool_threshold',
+                                                         LiveStatusResponse.spool_threshold))
         if getattr(modconf, 'service_authorization', 'loose') == 'strict':
             self.service_authorization_strict = True
         else:
@@ -135,6 +166,17 @@ class LiveStatus_broker(BaseModule, Daemon):
             self.group_authorization_strict = True
         else:
             self.group_authorization_strict = False
+        # Columns of the hosts and services tables with a secondary index
+        self.indexed_columns = [c.strip() for c in getattr(modconf, 'indexed_columns', ','.join(DEFAULT_INDEXED_COLUMNS)).split(',') if c.strip()]
+        # and with a columnar mirror
+        self.columnar_columns = [c.strip() for c in getattr(modconf, 'columnar_columns', ','.join(DEFAULT_COLUMNAR_COLUMNS)).split(',') if c.strip()]
+        # Check the incrementally maintained sorted ids against a full rebuild
+        self.heap_consistency_check = (getattr(modconf, 'heap_consistency_check', '0') == '1')
+        # Above this number of visible hosts, services or groups, those of a
+        # contact are kept in a bitmap for the AuthUser: lookups
+        self.visibility_bitmap_threshold = int(getattr(modconf, 'visibility_bitmap_threshold', DEFAULT_BITMAP_THRESHOLD))
+        # Only apply the last of the status updates of an object in a batch of broks
+        self.brok_coalescing = (getattr(modconf, 'brok_coalescing', '1') == '1')
 
         #  This is an "artificial" module which is used when an old-style
         #  shinken-specific.cfg without a separate logstore-module is found.
@@ -148,14 +190,29 @@ class LiveStatus_broker(BaseModule, Daemon):
         }
         # We need to have our regenerator now because it will need to load
         # data from scheduler before main() if in scheduler of course
-        self.rg = LiveStatusRegenerator(self.service_authorization_strict, self.group_authorization_strict)
+        self.rg = LiveStatusRegenerator(self.service_authorization_strict, self.group_authorization_strict,
+                                        self.indexed_columns, self.columnar_columns,
+                                        self.heap_consistency_check, self.visibility_bitmap_threshold)
 
         self.client_connections = {}  # keys will be socket of client,
         # values are LiveStatusClientThread instances
 
+        # 'thread': one thread per client connection,
+        # 'eventloop': one I/O loop for all the connections + a pool of workers
+        self.server_mode = getattr(modconf, 'server_mode', 'thread')
+        if self.server_mode not in ('thread', 'eventloop'):
+            logger.warning("[Livestatus Broker] Unknown server_mode '%s', using 'thread'" % self.server_mode)
+            self.server_mode = 'thread'
+        self.server_workers = int(getattr(modconf, 'server_workers', '8'))
+
         self.db = None
         self.listeners = []
-        self._listening_thread = threading.Thread(target=self._listening_thread_run)
+        if self.server_mode == 'eventloop':
+            self.event_server = LiveStatusEventServer(self, self.server_workers)
+            self._listening_thread = threading.Thread(target=self.event_server.run)
+        else:
+            self.event_server = None
+            self._listening_thread = threading.Thread(target=self._listening_thread_run)
 
     def add_compatibility_sqlite_module(self):
         if len([m for m in self.modules_manager.instances if m.properties['type'].startswith('logstore_')]) == 0:
@@ -233,7 +290,17 @@ class LiveStatus_broker(BaseModule, Daemon):
         self.add_compatibility_sqlite_module()
         self.datamgr = datamgr
         datamgr.load(self.rg)
-        self.query_cache = LiveStatusQueryCache()
+        history_cache = None
+        if self.history_cache_path:
+            try:
+                history_cache = LiveStatusHistoryCache(self.history_cache_path, self.history_cache_max_bytes,
+                                                       self.history_cache_margin)
+            except (IOError, OSError), exp:
+                logger.error("[Livestatus Broker] Can't use the history cache in %s: %s", self.history_cache_path, exp)
+        self.query_cache = LiveStatusQueryCache(self.query_plan_cache_size, self.query_cache_max_bytes,
+                                                self.query_cache_ttls, self.query_cache_min_time,
+                                                self.query_cache_output, self.query_coalescing,
+                                                history_cache, self.query_cache_stripes)
         if not self.use_query_cache:
             self.query_cache.disable()
         self.rg.register_cache(self.query_cache)
@@ -350,6 +417,19 @@ class LiveStatus_broker(BaseModule, Daemon):
             self.listeners.append(sock)
             logger.info("[Livestatus Broker] listening on unix socket: %s" % str(self.socket))
 
+    def accept_client(self, listener):
+        """Accept a new connection on `listener`.
+        Returns (None, None) if the client is not allowed to connect."""
+        sock, address = listener.accept()
+        if isinstance(address, tuple):
+            client_ip, _ = address
+            if self.allowed_hosts and client_ip not in self.allowed_hosts:
+                logger.warning("[Livestatus Broker] Connection attempt from illegal ip address %s" % str(client_ip))
+                full_safe_close(sock)
+                return None, None
+        self.livestatus.count_event('connections')
+        return sock, address
+
     def _listening_thread_run(self):
         while not self.interrupted:
             # Check for pending livestatus new connection..
@@ -360,17 +440,11 @@ class LiveStatus_broker(BaseModule, Daemon):
 
             for s in inputready:
                 # handle the server socket
-                sock, address = s.accept()
-                if isinstance(address, tuple):
-                    client_ip, _ = address
-                    if self.allowed_hosts and client_ip not in self.allowed_hosts:
-                        logger.warning("[Livestatus Broker] Connection attempt from illegal ip address %s" % str(client_ip))
-                        full_safe_close(sock)
-                        continue
-
+                sock, address = self.accept_client(s)
+                if sock is None:
+                    continue
                 new_client = self.client_connections[sock] = LiveStatusClientThread(sock, address, self)
                 new_client.start()
-                self.livestatus.count_event('connections')
             # end for s in inputready:
 
             # At the end of this loop we probably will discard connections
@@ -415,7 +489,16 @@ class LiveStatus_broker(BaseModule, Daemon):
             else:
                 for b in l:
                     b.prepare()  # Un-serialize the brok data
-                    self.rg.manage_brok(b)
+                # The regenerator can skip the superseded status updates,
+                # the other modules (the logstore...) still get every brok
+                applied = coalesce_broks(l) if self.brok_coalescing else l
+                self.livestatus.counters.increment('broks_received', len(l))
+                self.livestatus.counters.increment('broks_applied', len(applied))
+                # as before, each brok goes to the regenerator, then to the modules
+                applied_ids = set([id(b) for b in applied])
+                for b in l:
+                    if id(b) in applied_ids:
+                        self.rg.manage_brok(b)
                     for mod in self.modules_manager.get_internal_instances():
                         try:
                             mod.manage_brok(b)
@@ -45,6 +45,12 @@ from shinken.brokerlink import BrokerLink
 
 from shinken_modules import TestConfig
 from shinken_modules import LiveStatusClientThread
+from livestatus.livestatus_client_thread import OUTPUT_BUFFER_SIZE
+from livestatus.livestatus_response import LiveStatusListResponse, LiveStatusResponse
+from livestatus.livestatus_query import LiveStatusQuery
+from livestatus.livestatus_query_error import LiveStatusQueryError
+from livestatus.livestatus_brok_coalescer import coalesce_broks
+from livestatus.livestatus_index import LiveStatusIndexRegistry
 
 from mock_livestatus import mock_livestatus_handle_request
 
@@ -79,10 +85,515 @@ class TestConfigSmall(LiveStatusTest):
     def test_get_request_encoding(self):
         self.print_header()
         lqt = LiveStatusClientThread(None, None, self.livestatus_broker)
-        lqt.buffer_list = [b'testééé\n\n']
+        lqt.request_buffer.feed(b'testééé\n\n')
         output = lqt.get_request()
         self.assertEqual(b"testééé\n\n", output)
 
+    def test_get_request_pipelined(self):
+        self.print_header()
+        lqt = LiveStatusClientThread(None, None, self.livestatus_broker)
+        lqt.request_buffer.feed(b'GET hosts\r\nColumns: name\r\n\r\nGET serv')
+        self.assertEqual(b'GET hosts\r\nColumns: name\r\n\r\n', lqt.get_request())
+        self.assertEqual(None, lqt.get_request())
+        # the end of the request is split between two receptions:
+        lqt.request_buffer.feed(b'ices\n')
+        self.assertEqual(None, lqt.get_request())
+        lqt.request_buffer.feed(b'\nGET contacts\n\n')
+        self.assertEqual(b'GET services\n\n', lqt.get_request())
+        self.assertEqual(b'GET contacts\n\n', lqt.get_request())
+        self.assertEqual(None, lqt.get_request())
+        self.assertEqual(0, len(lqt.request_buffer))
+        self.assertEqual(3, lqt.requests_received)
+
+    def test_get_request_large(self):
+        self.print_header()
+        lqt = LiveStatusClientThread(None, None, self.livestatus_broker)
+        request = b'GET services\n' + b'Filter: host_name = test_host_0\nOr: 1\n' * 5000
+        # feed it by small chunks, so that the buffer has to grow:
+        for idx in range(0, len(request), 1000):
+            lqt.request_buffer.feed(request[idx:idx + 1000])
+            self.assertEqual(None, lqt.get_request())
+        lqt.request_buffer.feed(b'\n')
+        self.assertEqual(request + b'\n', lqt.get_request())
+
+    def test_send_response_coalesced(self):
+        self.print_header()
+        lqt = LiveStatusClientThread(None, None, self.livestatus_broker)
+        sent = []
+        lqt._send_data = sent.append
+        response = LiveStatusListResponse([b'a' * 1000 for _ in range(200)])
+        lqt.send_response(response)
+        self.assertEqual(b'a' * 200000, b''.join(sent))
+        # each send moves a big enough chunk, but the last one:
+        self.assertEqual(4, len(sent))
+        for data in sent[:-1]:
+            self.assertTrue(len(data) >= OUTPUT_BUFFER_SIZE)
+
+    def test_fixed16_spooled(self):
+        self.print_header()
+        self.update_broker()
+        request = """GET services
+Columns: host_name description state plugin_output
+OutputFormat: json
+ResponseHeader: fixed16
+"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        # force the response to be spooled on disk:
+        old_threshold = LiveStatusResponse.spool_threshold
+        LiveStatusResponse.spool_threshold = 16
+        try:
+            spooled_response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        finally:
+            LiveStatusResponse.spool_threshold = old_threshold
+        self.assertEqual(response, spooled_response)
+        header, body = spooled_response.split('\n', 1)
+        self.assertEqual('200', header.split()[0])
+        self.assertEqual(len(body), int(header.split()[1]))
+
+    def test_query_plan_cache(self):
+        self.print_header()
+        self.update_broker()
+        request = """GET services
+Columns: host_name description state
+Filter: host_name = test_host_0
+Filter: state = 0
+Filter: state = 1
+Or: 2
+OutputFormat: csv
+Localtime: %d
+"""
+        counters = self.livestatus_broker.livestatus.counters
+        misses = counters.count('plan_cache_misses')
+        hits = counters.count('plan_cache_hits')
+        response1, keepalive = self.livestatus_broker.livestatus.handle_request(request % 1300000000)
+        response2, keepalive = self.livestatus_broker.livestatus.handle_request(request % 1300000010)
+        print response1
+        self.assertEqual(response1, response2)
+        self.assertEqual(misses + 1, counters.count('plan_cache_misses'))
+        self.assertEqual(hits + 1, counters.count('plan_cache_hits'))
+
+        # a different filter is a different plan
+        response3, keepalive = self.livestatus_broker.livestatus.handle_request(
+            request.replace('state = 1', 'state = 2') % 1300000020)
+        self.assertEqual(misses + 2, counters.count('plan_cache_misses'))
+
+        request = """GET status
+Columns: plan_cache_hits plan_cache_misses
+"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual('%d;%d\n' % (hits + 1, misses + 3), response)
+
+    def test_filter_compiler(self):
+        self.print_header()
+        self.update_broker()
+        livestatus = self.livestatus_broker.livestatus
+        request = """GET services
+Filter: host_name = test_host_0
+Filter: state != 0
+Negate:
+Filter: description ~~ OK
+Or: 2
+Filter: host_groups >= hostgroup_01
+Filter: description !=~ TEST_OK_0
+Stats: state = 0
+Stats: last_check > 0
+StatsOr: 2
+Stats: sum latency
+"""
+
+        def make_query():
+            return LiveStatusQuery(livestatus.datamgr, livestatus.query_cache, livestatus.db,
+                                   livestatus.pnp_path, livestatus.return_queue, livestatus.counters)
+        query = make_query()
+        query.parse_input(request)
+        self.assertIsNotNone(query.compiled_filters['filter_stack'].factory)
+        self.assertIsNotNone(query.compiled_filters['stats_filter_stack'].factory)
+        # the same stacks, built of closures
+        reference = make_query()
+        reference.table = query.table
+        for stack_name in ('filter_stack', 'stats_filter_stack'):
+            for operation in query.stack_programs[stack_name]:
+                reference.run_stack_operation(stack_name, operation)
+        reference.filter_stack.and_elements(reference.filter_stack.qsize())
+        for stack_name in ('filter_stack', 'stats_filter_stack'):
+            compiled = list(getattr(query, stack_name).queue)
+            closures = list(getattr(reference, stack_name).queue)
+            self.assertEqual(len(closures), len(compiled))
+            for svc in livestatus.datamgr.rg.services:
+                for compiled_func, closure in zip(compiled, closures):
+                    self.assertEqual(bool(closure(svc)), bool(compiled_func(svc)))
+
+        # unknown columns are still an error
+        query = make_query()
+        query.parse_input("GET services\nFilter: nosuchcolumn = 1\n")
+        filter_func = query.filter_stack.get_stack()
+        svc = livestatus.datamgr.rg.services.find_srv_by_name_and_hostname("test_host_0", "test_ok_0")
+        self.assertRaises(LiveStatusQueryError, filter_func, svc)
+
+    def test_secondary_indexes(self):
+        self.print_header()
+        objlist = []
+        for host in self.sched.hosts:
+            objlist.append([host, 0, 'UP'])
+        for service in self.sched.services:
+            objlist.append([service, 2, 'CRIT'])
+        self.scheduler_loop(1, objlist)
+        self.update_broker()
+        services = self.livestatus_broker.rg.services
+        index = services._indexes['state']
+        self.assertEqual(set(services.items.keys()), index.lookup(2))
+        self.assertEqual(set(), index.lookup(0))
+
+        request = """GET services
+Columns: host_name description
+Filter: state = 0
+Filter: host_name = test_host_0
+OutputFormat: csv
+"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual('', response)
+
+        # the check result brok moves the service to another posting
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_0", "test_ok_0")
+        self.scheduler_loop(1, [[svc, 0, 'OK']])
+        self.update_broker()
+        lssvc = services.find_srv_by_name_and_hostname("test_host_0", "test_ok_0")
+        self.assertIn(lssvc.id, index.lookup(0))
+        self.assertNotIn(lssvc.id, index.lookup(2))
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual('test_host_0;test_ok_0\n', response)
+
+        # a column whose value depends on the request isn't indexed
+        registry = LiveStatusIndexRegistry(['state', 'pnpgraph_present'])
+        self.assertEqual(['state'], registry.columns['services'])
+        registry.register('hosts', 'host_state')
+        self.assertEqual(['state'], registry.columns['hosts'])
+
+    def test_index_planner(self):
+        self.print_header()
+        self.update_broker()
+        livestatus = self.livestatus_broker.livestatus
+
+        def launch(request):
+            query = LiveStatusQuery(livestatus.datamgr, livestatus.query_cache, livestatus.db,
+                                    livestatus.pnp_path, livestatus.return_queue, livestatus.counters)
+            query.parse_input(request)
+            names = [host.get_name() for host in query.launch_query()]
+            print query.execution_plan
+            return names, query.execution_plan
+
+        names, execution_plan = launch("""GET hosts
+Filter: name = test_host_0
+Filter: state != 0
+And: 2
+Filter: name = test_host_0
+Or: 2
+""")
+        self.assertEqual(['test_host_0'], names)
+        self.assertTrue(execution_plan.startswith('index or('))
+
+        names, execution_plan = launch("""GET hosts
+Filter: name = test_host_0
+Negate:
+""")
+        self.assertEqual(['test_router_0'], names)
+        self.assertTrue(execution_plan.startswith('index not('))
+
+        # a regex can't be looked up
+        names, execution_plan = launch("""GET hosts
+Filter: name ~ test_
+""")
+        self.assertEqual(['test_host_0', 'test_router_0'], sorted(names))
+        self.assertTrue(execution_plan.startswith('full scan'))
+
+    def test_columnar_status(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        router = self.sched.hosts.find_by_name("test_router_0")
+        self.scheduler_loop(1, [[host, 2, 'DOWN'], [router, 0, 'UP']])
+        self.update_broker()
+        livestatus = self.livestatus_broker.livestatus
+        hosts = self.livestatus_broker.rg.hosts
+        self.assertIn('state', hosts._columns.values)
+
+        def launch(request):
+            query = LiveStatusQuery(livestatus.datamgr, livestatus.query_cache, livestatus.db,
+                                    livestatus.pnp_path, livestatus.return_queue, livestatus.counters)
+            query.parse_input(request)
+            names = [item.get_name() for item in query.launch_query()]
+            print query.execution_plan
+            return names, query.execution_plan
+
+        request = """GET hosts
+Filter: state != 0
+Filter: last_check > 0
+Filter: is_flapping = 1
+Negate:
+And: 3
+"""
+        names, execution_plan = launch(request)
+        self.assertEqual(['test_host_0'], names)
+        self.assertTrue(execution_plan.startswith('columns: 1 of'))
+
+        # the mirror follows the check results
+        self.scheduler_loop(1, [[host, 0, 'UP'], [router, 2, 'DOWN']])
+        self.update_broker()
+        names, execution_plan = launch(request)
+        self.assertEqual(['test_router_0'], names)
+
+    def test_state_counters(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        router = self.sched.hosts.find_by_name("test_router_0")
+        self.scheduler_loop(3, [[host, 2, 'DOWN'], [router, 0, 'UP']])
+        self.update_broker()
+        livestatus = self.livestatus_broker.livestatus
+
+        def launch(request):
+            query = LiveStatusQuery(livestatus.datamgr, livestatus.query_cache, livestatus.db,
+                                    livestatus.pnp_path, livestatus.return_queue, livestatus.counters)
+            query.parse_input(request)
+            result = query.launch_query()
+            print query.execution_plan, result
+            return result, query.execution_plan
+
+        request = """GET hosts
+Stats: state = 0
+Stats: state = 1
+Stats: state = 2
+Stats: state != 0
+Stats: acknowledged = 0
+StatsAnd: 2
+Stats: has_been_checked = 0
+"""
+        result, execution_plan = launch(request)
+        self.assertEqual([{0: 1, 1: 1, 2: 0, 3: 1, 4: 0}], result)
+        self.assertTrue(execution_plan.startswith('state counters'))
+
+        # the counters follow the status updates
+        self.scheduler_loop(3, [[host, 0, 'UP'], [router, 0, 'UP']])
+        self.update_broker()
+        result, execution_plan = launch(request)
+        self.assertEqual([{0: 2, 1: 0, 2: 0, 3: 0, 4: 0}], result)
+
+        # a Filter: needs the hosts
+        result, execution_plan = launch(request + "Filter: name = test_host_0\n")
+        self.assertEqual([{0: 1, 1: 0, 2: 0, 3: 0, 4: 0}], result)
+        self.assertFalse(execution_plan.startswith('state counters'))
+
+    def test_host_service_states(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_0", "test_ok_0")
+        self.scheduler_loop(1, [[svc, 2, 'CRIT']])
+        self.update_broker()
+        self.assertTrue(hasattr(self.livestatus_broker.rg.hosts.find_by_name("test_host_0"), '_service_states'))
+
+        request = """GET hosts
+Columns: name num_services num_services_crit num_services_hard_crit num_services_ok num_services_pending worst_service_state worst_service_hard_state
+Filter: name = test_host_0
+OutputFormat: python
+"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        print response
+        self.assertEqual([['test_host_0', 1, 1, 0, 0, 0, 2, 0]], eval(response))
+
+        # the service becomes hard CRIT
+        self.scheduler_loop(3, [[svc, 2, 'CRIT']])
+        self.update_broker()
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        print response
+        self.assertEqual([['test_host_0', 1, 1, 1, 0, 0, 2, 2]], eval(response))
+
+        request = """GET services
+Columns: host_num_services_crit host_num_services_warn host_worst_service_state
+Filter: host_name = test_host_0
+OutputFormat: python
+"""
+        self.scheduler_loop(1, [[svc, 1, 'WARN']])
+        self.update_broker()
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        print response
+        self.assertEqual([[0, 1, 1]], eval(response))
+
+    def test_group_member_states(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        router = self.sched.hosts.find_by_name("test_router_0")
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_0", "test_ok_0")
+        rg = self.livestatus_broker.rg
+
+        def check(states):
+            self.scheduler_loop(3, states)
+            self.update_broker()
+            verify()
+
+        def verify():
+            request = """GET hostgroups
+Columns: name num_hosts_up num_hosts_down num_services_ok num_services_crit num_services_hard_crit worst_service_state
+OutputFormat: python
+"""
+            response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+            print response
+            expected = []
+            for hg in rg.hostgroups:
+                services = [s for h in hg.members for s in h.services]
+                expected.append([hg.get_name(),
+                                 len([h for h in hg.members if h.state_id == 0]),
+                                 len([h for h in hg.members if h.state_id == 1]),
+                                 len([s for s in services if s.state_id == 0]),
+                                 len([s for s in services if s.state_id == 2]),
+                                 len([s for s in services if s.state_id == 2 and s.state_type_id == 1]),
+                                 max([0] + [s.state_id for s in services])])
+            self.assertEqual(sorted(expected), sorted(eval(response)))
+
+            request = """GET servicegroups
+Columns: name num_services_ok num_services_crit worst_service_state
+OutputFormat: python
+"""
+            response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+            print response
+            expected = []
+            for sg in rg.servicegroups:
+                expected.append([sg.get_name(),
+                                 len([s for s in sg.members if s.state_id == 0]),
+                                 len([s for s in sg.members if s.state_id == 2]),
+                                 max([0] + [s.state_id for s in sg.members])])
+            self.assertEqual(sorted(expected), sorted(eval(response)))
+
+        check([[host, 1, 'DOWN'], [router, 0, 'UP'], [svc, 2, 'CRIT']])
+        check([[host, 0, 'UP'], [router, 0, 'UP'], [svc, 0, 'OK']])
+
+        # the services of a host change before the next configuration is
+        # linked: the counts kept by the regenerator are stale
+        lshost = rg.hosts.find_by_name("test_host_0")
+        removed = lshost.services.pop()
+        try:
+            verify()
+        finally:
+            lshost.services.append(removed)
+
+    def test_incremental_heaps(self):
+        self.print_header()
+        rg = self.livestatus_broker.rg
+        self.assertEqual([], rg.verify_heaps())
+        # nothing changed since
+        self.assertFalse(rg.update_heaps())
+
+        def renewed(item):
+            new = object.__new__(item.__class__)
+            new.__dict__.update(item.__dict__)
+            return new
+
+        # a host and its services go away, then come back as new objects
+        host = rg.hosts.find_by_name("test_host_0")
+        services = host.services
+        del rg.hosts.items[host.id]
+        for s in services:
+            del rg.services.items[s.id]
+        self.assertTrue(rg.update_heaps())
+        rg.build_group_contact_heaps()
+        self.assertNotIn(host.id, rg.hosts._id_heap)
+        self.assertNotIn("test_host_0", rg.hosts._id_by_host_name_heap)
+        self.assertNotIn("test_host_0", rg.services._id_by_host_name_heap)
+        self.assertEqual([], rg.verify_heaps())
+
+        rg.hosts.items[host.id] = renewed(host)
+        for s in services:
+            rg.services.items[s.id] = renewed(s)
+        self.assertTrue(rg.update_heaps())
+        rg.build_group_contact_heaps()
+        self.assertEqual(host.id, rg.hosts._id_by_host_name_heap["test_host_0"])
+        self.assertEqual(sorted([s.id for s in services], key=lambda i: rg.services[i].get_full_name()),
+                         rg.services._id_by_host_name_heap["test_host_0"])
+        self.assertEqual([], rg.verify_heaps())
+
+    def test_brok_coalescing(self):
+        self.print_header()
+
+        def check_result(desc, state_id, output):
+            return Brok('service_check_result', {'host_name': 'test_host_0', 'service_description': desc,
+                                                 'state_id': state_id, 'plugin_output': output})
+
+        broks = [
+            check_result('test_ok_0', 2, 'first'),
+            Brok('log', {'log': 'SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;HARD;1;first'}),
+            check_result('test_ok_0', 1, 'second'),
+            Brok('host_check_result', {'host_name': 'test_host_0', 'state_id': 0, 'plugin_output': 'host up'}),
+            check_result('test_ok_0', 0, 'last'),
+        ]
+        for b in broks:
+            b.prepare()
+        applied = coalesce_broks(broks)
+        # the log brok and the host check are kept, the check results of
+        # test_ok_0 collapse into the last one
+        self.assertEqual([broks[1], broks[3], broks[4]], applied)
+
+        # another brok about the service keeps the previous updates
+        barrier = Brok('initial_service_status', {'host_name': 'test_host_0', 'service_description': 'test_ok_0'})
+        barrier.prepare()
+        self.assertEqual(3, len(coalesce_broks(broks[:1] + [barrier] + broks[4:])))
+
+        for b in applied:
+            self.livestatus_broker.rg.manage_brok(b)
+        request = """GET services
+Filter: host_name = test_host_0
+Filter: description = test_ok_0
+Columns: description state plugin_output host_plugin_output
+OutputFormat: csv
+"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual('test_ok_0;0;last;host up\n', response)
+
+    def test_versions_with_groups(self):
+        self.print_header()
+        # the initial broks of the setup went through bump_versions before
+        # the groups of their hosts and services were linked
+        rg = self.livestatus_broker.rg
+        host = rg.hosts.find_by_name("test_host_0")
+        svc = rg.services.find_srv_by_name_and_hostname("test_host_0", "test_ok_0")
+        self.assertTrue(host.hostgroups)
+        versions = [getattr(item, '_version', 0) for item in [host, svc] + host.hostgroups + svc.servicegroups]
+        sched_svc = self.sched.services.find_srv_by_name_and_hostname("test_host_0", "test_ok_0")
+        self.scheduler_loop(1, [[sched_svc, 2, 'CRITICAL']])
+        self.update_broker()
+        for before, item in zip(versions, [host, svc] + host.hostgroups + svc.servicegroups):
+            self.assertTrue(item._version > before)
+
+    def test_stats_aggregates(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        router = self.sched.hosts.find_by_name("test_router_0")
+        self.scheduler_loop(1, [[host, 2, 'DOWN'], [router, 0, 'UP']])
+        self.update_broker()
+
+        request = """GET hosts
+Stats: state = 0
+Stats: sum state
+Stats: min state
+Stats: max state
+Stats: avg state
+Stats: std state
+OutputFormat: python
+"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        print response
+        row = eval(response)[0]
+        self.assertEqual(1, row[0])
+        self.assertEqual([2.0, 0.0, 2.0, 1.0], row[1:5])
+        # the sample standard deviation of 0 and 2
+        self.assertAlmostEqual(2 ** 0.5, row[5])
+
+        request = """GET hosts
+Stats: avg state
+Stats: std state
+StatsGroupBy: name
+OutputFormat: python
+"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        print response
+        self.assertEqual([['test_host_0', 2.0, 0.0], ['test_router_0', 0.0, 0.0]], sorted(eval(response)))
+
     def test_check_type(self):
         self.print_header()
         now = time.time()
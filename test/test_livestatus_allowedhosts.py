@@ -140,6 +140,39 @@ class TestConfigAuth(TestConfig):
         self.assertFalse(self.query_livestatus(modconf.host, int(modconf.port), "GET hosts\n\n"))
 
 
+    def test_04_eventloop_allow_localhost(self):
+        modconf = Module({'module_name': 'LiveStatus',
+            'module_type': 'livestatus',
+            'port': str(random.randint(50000, 65534)),
+            'pnp_path': 'tmp/pnp4nagios_test' + self.testid,
+            'host': '127.0.0.1',
+            'name': 'test',
+            'modules': '',
+            'allowed_hosts': '127.0.0.1',
+            'server_mode': 'eventloop',
+            'server_workers': '2'
+        })
+        self.init_livestatus(modconf)
+
+        # test livestatus connection
+        self.assertTrue(self.query_livestatus(modconf.host, int(modconf.port), "GET hosts\n\n"))
+
+    def test_05_eventloop_dont_allow_localhost(self):
+        modconf = Module({'module_name': 'LiveStatus',
+            'module_type': 'livestatus',
+            'port': str(random.randint(50000, 65534)),
+            'pnp_path': 'tmp/pnp4nagios_test' + self.testid,
+            'host': '127.0.0.1',
+            'name': 'test',
+            'modules': '',
+            'allowed_hosts': '192.168.0.1',
+            'server_mode': 'eventloop'
+        })
+        self.init_livestatus(modconf)
+
+        # test livestatus connection
+        self.assertFalse(self.query_livestatus(modconf.host, int(modconf.port), "GET hosts\n\n"))
+
 
 if __name__ == '__main__':
     #import cProfile
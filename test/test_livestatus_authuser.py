@@ -35,6 +35,7 @@ from shinken.comment import Comment
 from test_livestatus import TestConfig, unittest
 
 from mock_livestatus import mock_livestatus_handle_request
+from livestatus.livestatus_visibility import VisibilityBitmap
 
 
 sys.setcheckinterval(10000)
@@ -145,6 +146,35 @@ www2    adm(adm1,adm2,adm3) web(web1,web2) winadm(bill,steve)
         for contact in sorted(self.livestatus_broker.datamgr.rg.hostgroups._id_contact_heap.keys()):
             print "%-10s %s" % (contact, self.livestatus_broker.datamgr.rg.hostgroups._id_contact_heap[contact])
 
+    def test_visibility_bitmaps(self):
+        self.print_header()
+        rg = self.livestatus_broker.datamgr.rg
+        # rebuild with the ids of the contacts seeing more than 2 items in bitmaps
+        rg.bitmap_threshold = 2
+        rg.verify_heaps()
+        hint = {"target": 0, "authuser": "adm1"}
+        self.assertTrue(isinstance(rg.services._visibility.get("adm1"), VisibilityBitmap))
+        self.assertEqual(rg.services._id_contact_heap["adm1"], [s.id for s in rg.services.__itersorted__(hint)])
+        self.assertEqual(15, len(rg.services._visibility.get("adm1")))
+        hint = {"target": 0, "authuser": "mydba2"}
+        self.assertEqual(["dbsrv4", "dbsrv5"], [h.get_full_name() for h in rg.hosts.__itersorted__(hint)])
+        # along with the ids found in an index
+        dbsrv5 = rg.hosts.find_by_name("dbsrv5")
+        self.assertEqual([dbsrv5], list(rg.hosts.__itersorted__(hint, set([dbsrv5.id]))))
+        hint = {"target": 0, "authuser": "oradba1"}
+        self.assertEqual([], list(rg.hosts.__itersorted__(hint, set([dbsrv5.id]))))
+
+        request = """GET services
+AuthUser: adm1
+Filter: host_name = dbsrv1
+Columns: host_name description
+OutputFormat: python
+"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        print response
+        self.assertEqual(sorted([["dbsrv1", s.service_description] for s in rg.hosts.find_by_name("dbsrv1").services]),
+                         sorted(eval(response)))
+
     def test_host_authorization(self):
         self.print_header()
         now = time.time()
@@ -512,6 +542,24 @@ windows;dbsrv3;app_db_oracle_check_alertlog
         response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
         print response
 
+    def test_group_contacts_incremental(self):
+        self.print_header()
+        rg = self.livestatus_broker.datamgr.rg
+        web = rg.hostgroups.find_by_name("web")
+        dbsrv1 = rg.hosts.find_by_name("dbsrv1")
+        hint = {"target": 0, "authuser": "web1"}
+        self.assertEqual(["web"], [hg.get_name() for hg in rg.hostgroups.__itersorted__(hint)])
+        # web1 is no contact of dbsrv1
+        web.members.append(dbsrv1)
+        rg.build_group_contact_heaps()
+        self.assertEqual([], [hg.get_name() for hg in rg.hostgroups.__itersorted__(hint)])
+        self.assertEqual(6, len(rg.hostgroups._id_contact_heap["adm1"]))
+        self.assertEqual([], rg.verify_heaps())
+        web.members.remove(dbsrv1)
+        rg.build_group_contact_heaps()
+        self.assertEqual(["web"], [hg.get_name() for hg in rg.hostgroups.__itersorted__(hint)])
+        self.assertEqual([], rg.verify_heaps())
+
     def test_group_authorization_loose(self):
         self.print_header()
         now = time.time()
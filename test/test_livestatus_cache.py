@@ -6,6 +6,9 @@ import sys
 import datetime
 import time
 import random
+import shutil
+import tempfile
+import threading
 
 from shinken_test import unittest, time_hacker
 
@@ -15,6 +18,11 @@ from shinken_modules import TestConfig
 from shinken.comment import Comment
 
 from mock_livestatus import mock_livestatus_handle_request
+from livestatus.livestatus_query_cache import LFU, LFUCacheMiss, LiveStatusQueryCache
+from livestatus.livestatus_query_coalescer import LiveStatusQueryCoalescer
+from livestatus.livestatus_history_cache import LiveStatusHistoryCache
+from livestatus.livestatus_query_metainfo import CACHE_GLOBAL_STATS, CACHE_SERVICE_STATS, CACHE_ROWS, CACHE_IRREVERSIBLE_HISTORY
+from livestatus.livestatus_query_metainfo import LiveStatusQueryMetainfo
 
 
 @mock_livestatus_handle_request
@@ -117,6 +125,112 @@ Stats: state = 3"""
         print 'query_6_______________\n%s\n%s\n' % (statsrequest, response)
         self.assertEqual('2000;1994;3;3;0\n', response )
 
+    def test_row_query_versions(self):
+        self.print_header()
+        query_cache = self.livestatus_broker.query_cache
+        svc1 = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_ok_00")
+        svc2 = self.sched.services.find_srv_by_name_and_hostname("test_host_007", "test_ok_05")
+        request = """GET hosts
+Filter: name = test_host_005
+Columns: name state num_services_warn"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        hits = query_cache.hits
+        cachedresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(response, cachedresponse)
+        self.assertEqual(hits + 1, query_cache.hits)
+
+        # a service of another host doesn't move the version of test_host_005
+        self.scheduler_loop(1, [[svc2, 1, 'W']])
+        self.update_broker()
+        cachedresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(response, cachedresponse)
+        self.assertEqual(hits + 2, query_cache.hits)
+
+        # one of its own services does
+        outdated = query_cache.outdated
+        self.scheduler_loop(1, [[svc1, 1, 'W']])
+        self.update_broker()
+        newresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        print "new", newresponse
+        self.assertEqual('test_host_005;0;1\n', newresponse)
+        self.assertEqual(outdated + 1, query_cache.outdated)
+
+    def test_row_query_sibling_versions(self):
+        self.print_header()
+        query_cache = self.livestatus_broker.query_cache
+        svc1 = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_ok_00")
+        request = """GET services
+Filter: host_name = test_host_005
+Filter: description = test_ok_01
+Columns: description host_num_services_warn"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        hits = query_cache.hits
+        cachedresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(response, cachedresponse)
+        self.assertEqual(hits + 1, query_cache.hits)
+
+        # another service of the same host changes the aggregates in the row
+        outdated = query_cache.outdated
+        self.scheduler_loop(1, [[svc1, 1, 'W']])
+        self.update_broker()
+        newresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        print "new", newresponse
+        self.assertEqual('test_ok_01;1\n', newresponse)
+        self.assertEqual(outdated + 1, query_cache.outdated)
+
+    def test_reload_keeps_cache(self):
+        self.print_header()
+        query_cache = self.livestatus_broker.query_cache
+        rg = self.livestatus_broker.rg
+        request = """GET hosts
+Filter: name = test_host_005
+Columns: name state"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+
+        def reload_host(name):
+            # as if a new configuration brought another object for it
+            host = rg.hosts.find_by_name(name)
+            renewed = object.__new__(host.__class__)
+            renewed.__dict__.update(host.__dict__)
+            rg.hosts.items[host.id] = renewed
+            heap = rg.hosts._id_heap
+            rg.all_done_linking(0)
+            # the queries used the previous sorted ids until the end
+            self.assertFalse(rg.hosts._id_heap is heap)
+
+        reload_host("test_host_007")
+        hits = query_cache.hits
+        cachedresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(response, cachedresponse)
+        self.assertEqual(hits + 1, query_cache.hits)
+
+        reload_host("test_host_005")
+        newresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(response, newresponse)
+        self.assertEqual(hits + 1, query_cache.hits)
+
+    def test_cached_outputs(self):
+        self.print_header()
+        self.livestatus_broker.query_cache.cache_outputs = True
+        counters = self.livestatus_broker.livestatus.counters
+        request = """GET services
+Filter: host_name = test_host_005
+Columns: host_name description state
+OutputFormat: json"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        hits = counters.count('output_cache_hits')
+        cachedresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(''.join(response), ''.join(cachedresponse))
+        self.assertEqual(hits + 1, counters.count('output_cache_hits'))
+
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_ok_00")
+        self.scheduler_loop(1, [[svc, 2, 'C']])
+        self.update_broker()
+        newresponse, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertNotEqual(''.join(response), ''.join(newresponse))
+        self.assertIn('["test_host_005","test_ok_00",2]', ''.join(newresponse))
+        self.assertEqual(hits + 1, counters.count('output_cache_hits'))
+
     def test_a_long_history(self):
         #return
         print datetime.datetime.now()
@@ -321,6 +435,284 @@ Maybe you could relaunch the test and it will succeed.
 
 
 
+class TestQueryCacheEngine(unittest.TestCase):
+
+    def test_lfu_eviction(self):
+        cache = LFU(maxbytes=300)
+        for key in 'abc':
+            cache.put(key, key, 100)
+        cache.get('a')
+        cache.get('a')
+        cache.get('c')
+        # b was read least times
+        cache.put('d', 'd', 100)
+        self.assertEqual(['a', 'c', 'd'], sorted(cache.entries))
+        # between c and d, read once and never, d goes
+        cache.get('c')
+        cache.put('e', 'e', 100)
+        self.assertEqual(['a', 'c', 'e'], sorted(cache.entries))
+        self.assertEqual(300, cache.size)
+        # a result bigger than the whole cache isn't stored
+        self.assertFalse(cache.put('f', 'f', 301))
+        self.assertNotIn('f', cache)
+
+    def test_lfu_ttl_and_tags(self):
+        cache = LFU()
+        cache.put('a', [1, 2], ttl=60, tag=1)
+        cache.put('b', [3], tag=2)
+        cache.put('c', [4], tag=1)
+        self.assertEqual([1, 2], cache.get('a'))
+        cache.entries['a'].expires = time.time() - 1
+        self.assertRaises(LFUCacheMiss, cache.get, 'a')
+        cache.remove_tag(1)
+        self.assertEqual(['b'], sorted(cache.entries))
+        self.assertEqual(cache.entries['b'].size, cache.size)
+
+    def test_admission_and_categories(self):
+        class Metainfo(object):
+            def __init__(self, category, key):
+                self.cache_category, self.key, self.data = category, key, ''
+
+        query_cache = LiveStatusQueryCache(ttls={'global_stats': 30}, min_compute_time=0.5)
+        fast, slow = Metainfo(CACHE_GLOBAL_STATS, 1), Metainfo(CACHE_GLOBAL_STATS, 2)
+        other = Metainfo(CACHE_SERVICE_STATS, 1)
+        query_cache.cache_query(fast, {'result': [1]}, 0.1)
+        query_cache.cache_query(slow, {'result': [2]}, 1.0)
+        query_cache.cache_query(other, {'result': [3]}, 1.0)
+        self.assertEqual((True, False, []), query_cache.get_cached_query(fast))
+        self.assertEqual((True, True, {'result': [2]}), query_cache.get_cached_query(slow))
+        self.assertEqual(1, query_cache.rejected)
+        key = (CACHE_GLOBAL_STATS, 2)
+        self.assertTrue(query_cache.stripe(key).cache.entries[key].expires > time.time())
+        key = (CACHE_SERVICE_STATS, 1)
+        self.assertEqual(None, query_cache.stripe(key).cache.entries[key].expires)
+        query_cache.invalidate_category(CACHE_GLOBAL_STATS)
+        self.assertEqual((True, False, []), query_cache.get_cached_query(slow))
+        self.assertEqual((True, True, {'result': [3]}), query_cache.get_cached_query(other))
+
+    def test_cached_outputs(self):
+        class Metainfo(object):
+            cache_category, key, data = CACHE_SERVICE_STATS, 1, ''
+
+        query_cache = LiveStatusQueryCache(max_bytes=100000, cache_outputs=True)
+        response = {'result': [1]}
+        query_cache.cache_query(Metainfo, response)
+        size = query_cache.size
+        query_cache.cache_output(Metainfo, response, 'a;b\n')
+        self.assertEqual('a;b\n', query_cache.get_cached_query(Metainfo)[2]['output'])
+        self.assertTrue(query_cache.size > size)
+        # a result replaced in the meantime doesn't get the output of the old one
+        query_cache.cache_query(Metainfo, {'result': [2]})
+        query_cache.cache_output(Metainfo, response, 'a;b\n')
+        self.assertNotIn('output', query_cache.get_cached_query(Metainfo)[2])
+        # and the output goes away with its result
+        query_cache.invalidate_category(CACHE_SERVICE_STATS)
+        self.assertEqual(0, query_cache.size)
+
+    def test_shared_budget(self):
+        class Metainfo(object):
+            def __init__(self, key):
+                self.cache_category, self.key, self.data = CACHE_SERVICE_STATS, key, ''
+
+        query_cache = LiveStatusQueryCache(max_bytes=10000, stripes=8)
+        # much more than the share of one stripe, but less than the whole cache
+        big = Metainfo(0)
+        query_cache.cache_query(big, {'result': ['x' * 5000]})
+        self.assertEqual(True, query_cache.get_cached_query(big)[1])
+        # the results of the other stripes make room for the next ones
+        for key in range(1, 100):
+            query_cache.cache_query(Metainfo(key), {'result': ['y' * 500]})
+        self.assertTrue(query_cache.size <= 10000)
+        self.assertEqual(query_cache.size, query_cache.budget.used)
+        self.assertTrue(len(query_cache) > 8)
+        # a result bigger than the whole cache isn't stored
+        huge = Metainfo(100)
+        query_cache.cache_query(huge, {'result': ['z' * 20000]})
+        self.assertEqual(False, query_cache.get_cached_query(huge)[1])
+        query_cache.wipeout()
+        self.assertEqual(0, query_cache.budget.used)
+
+    def test_coalescer(self):
+        coalescer = LiveStatusQueryCoalescer()
+        leader, flight = coalescer.join('GET hosts\nAuthUser: a')
+        self.assertTrue(leader)
+        # another AuthUser: is another query
+        self.assertTrue(coalescer.join('GET hosts\nAuthUser: b')[0])
+        results = []
+        followers = []
+        for i in range(3):
+            leads, followed = coalescer.join('GET hosts\nAuthUser: a')
+            self.assertFalse(leads)
+            followers.append(threading.Thread(target=lambda: results.append(followed.wait())))
+            followers[-1].start()
+        self.assertEqual(3, coalescer.close('GET hosts\nAuthUser: a', flight))
+        # the next identical query is executed again
+        self.assertTrue(coalescer.join('GET hosts\nAuthUser: a')[0])
+        flight.land([1, 2])
+        for follower in followers:
+            follower.join()
+        self.assertEqual([[1, 2]] * 3, results)
+
+    def test_history_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            history = LiveStatusHistoryCache(path, max_bytes=150)
+            history.put('GET log\nFilter: time >= 1', 'a' * 40)
+            history.put('GET log\nFilter: time >= 2', 'b' * 40)
+            self.assertEqual('a' * 40, history.get('GET log\nFilter: time >= 1'))
+            self.assertEqual(None, history.get('GET log\nFilter: time >= 3'))
+            # the responses survive a restart
+            os.utime(os.path.join(path, history.file_name('GET log\nFilter: time >= 2')), (1, 1))
+            history = LiveStatusHistoryCache(path, max_bytes=150)
+            self.assertEqual(2, len(history.entries))
+            # the response used least recently goes
+            history.put('GET log\nFilter: time >= 3', 'c' * 40)
+            self.assertEqual(None, history.get('GET log\nFilter: time >= 2'))
+            self.assertEqual('a' * 40, history.get('GET log\nFilter: time >= 1'))
+            self.assertEqual('c' * 40, history.get('GET log\nFilter: time >= 3'))
+            self.assertEqual(2, len(os.listdir(path)))
+        finally:
+            shutil.rmtree(path)
+
+    def test_history_cache_keeps(self):
+        path = tempfile.mkdtemp()
+        try:
+            history = LiveStatusHistoryCache(path, margin=300)
+            now = int(time.time())
+
+            def metainfo(end, columns='time type message'):
+                return LiveStatusQueryMetainfo('GET log\nColumns: %s\nFilter: time >= %d\nFilter: time <= %d\n'
+                                               % (columns, end - 3600, end))
+            closed = metainfo(now - 600)
+            self.assertEqual(CACHE_IRREVERSIBLE_HISTORY, closed.cache_category)
+            self.assertTrue(history.keeps(closed))
+            # its last logs may not have been stored yet
+            recent = metainfo(now - 10)
+            self.assertEqual(CACHE_IRREVERSIBLE_HISTORY, recent.cache_category)
+            self.assertFalse(history.keeps(recent))
+            # the groups change with the configuration
+            self.assertFalse(history.keeps(metainfo(now - 600, 'time host_name current_host_groups')))
+        finally:
+            shutil.rmtree(path)
+
+    def test_concurrent_access(self):
+        class Metainfo(object):
+            def __init__(self, category, key):
+                self.cache_category, self.key, self.data = category, key, ''
+
+        query_cache = LiveStatusQueryCache(max_bytes=40000, stripes=4)
+        categories = [CACHE_GLOBAL_STATS, CACHE_SERVICE_STATS, CACHE_ROWS]
+        errors = []
+        stop = threading.Event()
+
+        def client(seed):
+            rand = random.Random(seed)
+            try:
+                for i in range(2000):
+                    query = Metainfo(rand.choice(categories), rand.randint(0, 300))
+                    stamp = query.cache_category == CACHE_ROWS and rand.randint(0, 3) or None
+                    cacheable, hit, cached = query_cache.get_cached_query(query, stamp)
+                    if hit:
+                        self.assertEqual(query.key, cached['result'][0])
+                        continue
+                    dependencies = None
+                    if rand.random() < 0.5:
+                        dependencies = [('services', frozenset(['state_id']), frozenset([rand.randint(0, 20)]))]
+                    query_cache.cache_query(query, {'result': [query.key] * rand.randint(1, 50), 'stamp': stamp},
+                                            dependencies=dependencies)
+            except Exception, exp:
+                errors.append(exp)
+
+        def feeder():
+            rand = random.Random(0)
+            try:
+                while not stop.is_set():
+                    query_cache.invalidate_dependents('services', rand.randint(0, 20), set(['state_id']))
+                    query_cache.invalidate_untracked(rand.choice(categories))
+                    if rand.random() < 0.01:
+                        query_cache.wipeout()
+            except Exception, exp:
+                errors.append(exp)
+
+        brok_thread = threading.Thread(target=feeder)
+        brok_thread.start()
+        clients = [threading.Thread(target=client, args=(seed,)) for seed in range(16)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        stop.set()
+        brok_thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(query_cache.size, query_cache.budget.used)
+        self.assertTrue(query_cache.size <= 40000)
+        for stripe in query_cache.stripes:
+            cache = stripe.cache
+            self.assertEqual(cache.size, sum([entry.size for entry in cache.entries.values()]))
+            self.assertTrue(cache.size <= cache.maxbytes)
+            self.assertEqual(len(cache.entries), sum([len(keys) for keys in cache.tags.values()]))
+            self.assertTrue(set(stripe.dependencies).issubset(cache.entries))
+            linked = 0
+            bucket = cache.buckets.next
+            while bucket is not cache.buckets:
+                entry = bucket.root.next
+                while entry is not bucket.root:
+                    linked += 1
+                    entry = entry.next
+                bucket = bucket.next
+            self.assertEqual(len(cache.entries), linked)
+
+    def test_dependency_invalidation(self):
+        class Metainfo(object):
+            def __init__(self, key):
+                self.cache_category, self.key, self.data = CACHE_SERVICE_STATS, key, ''
+
+        query_cache = LiveStatusQueryCache()
+        states, outputs, untracked = Metainfo(1), Metainfo(2), Metainfo(3)
+        query_cache.cache_query(states, {'result': [1]},
+                                dependencies=[('services', frozenset(['state_id']), frozenset([3, 4]))])
+        query_cache.cache_query(outputs, {'result': [2]},
+                                dependencies=[('services', frozenset(['output']), None)])
+        query_cache.cache_query(untracked, {'result': [3]})
+        # a change of another service, or of an attribute nobody reads
+        query_cache.invalidate_dependents('services', 5, set(['state_id']))
+        query_cache.invalidate_dependents('services', 3, set(['last_chk']))
+        self.assertEqual(3, len(query_cache))
+        query_cache.invalidate_dependents('services', 3, set(['state_id', 'last_chk']))
+        self.assertEqual((True, False, []), query_cache.get_cached_query(states))
+        self.assertEqual((True, True, {'result': [2]}), query_cache.get_cached_query(outputs))
+        self.assertNotIn(states.key, [key for stripe in query_cache.stripes for _, key in stripe.dependencies])
+        # the untracked results are still invalidated by category only
+        query_cache.invalidate_untracked(CACHE_SERVICE_STATS)
+        self.assertEqual((True, True, {'result': [2]}), query_cache.get_cached_query(outputs))
+        self.assertEqual((True, False, []), query_cache.get_cached_query(untracked))
+
+    def test_reload_invalidation(self):
+        class Metainfo(object):
+            def __init__(self, key, category=CACHE_SERVICE_STATS):
+                self.cache_category, self.key, self.data = category, key, ''
+
+        query_cache = LiveStatusQueryCache()
+        some, others, every, hosts, untracked, history = \
+            Metainfo(1), Metainfo(2), Metainfo(3), Metainfo(4), Metainfo(5), Metainfo(6, CACHE_IRREVERSIBLE_HISTORY)
+        query_cache.cache_query(some, {'result': [1]},
+                                dependencies=[('services', frozenset(['state_id']), frozenset([3, 4]))])
+        query_cache.cache_query(others, {'result': [2]},
+                                dependencies=[('services', frozenset(['state_id']), frozenset([5, 6]))])
+        query_cache.cache_query(every, {'result': [3]}, dependencies=[('services', frozenset(), None)])
+        query_cache.cache_query(hosts, {'result': [4]}, dependencies=[('hosts', None, None)])
+        query_cache.cache_query(untracked, {'result': [5]})
+        query_cache.cache_query(history, {'result': [6]})
+        # the service 4 is replaced, no host changed
+        query_cache.invalidate_reloaded({'hosts': set(), 'services': set([4])})
+        self.assertEqual((True, False, []), query_cache.get_cached_query(some))
+        self.assertEqual((True, False, []), query_cache.get_cached_query(every))
+        self.assertEqual((True, False, []), query_cache.get_cached_query(untracked))
+        self.assertEqual((True, True, {'result': [2]}), query_cache.get_cached_query(others))
+        self.assertEqual((True, True, {'result': [4]}), query_cache.get_cached_query(hosts))
+        self.assertEqual((True, True, {'result': [6]}), query_cache.get_cached_query(history))
+
+
 if __name__ == '__main__':
     #import cProfile
     command = """unittest.main()"""
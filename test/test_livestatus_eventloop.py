@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from shinken.objects.module import Module
+
+from shinken_modules import TestConfig
+from shinken_test import time_hacker, unittest
+
+
+class TestEventLoop(TestConfig):
+    ''' The requests served with server_mode eventloop, through a tcp
+    port and a unix socket. '''
+
+    def setUp(self):
+        super(TestEventLoop, self).setUp()
+        time_hacker.set_real_time()
+        self.testid = str(os.getpid() + random.randint(1, 1000))
+        self.socket_dir = tempfile.mkdtemp()
+        self.modconf = Module({'module_name': 'LiveStatus',
+            'module_type': 'livestatus',
+            'port': str(random.randint(50000, 65534)),
+            'socket': os.path.join(self.socket_dir, 'live'),
+            'pnp_path': 'tmp/pnp4nagios_test' + self.testid,
+            'host': '127.0.0.1',
+            'name': 'test',
+            'modules': '',
+            'server_mode': 'eventloop',
+            'server_workers': '2'
+        })
+        self.init_livestatus(self.modconf)
+
+    def tearDown(self):
+        self.livestatus_broker.interrupted = True
+        self.lql_thread.join()
+        shutil.rmtree(self.socket_dir)
+        super(TestEventLoop, self).tearDown()
+
+    def init_livestatus(self, conf):
+        super(TestEventLoop, self).init_livestatus(conf)
+        self.sched.brokers['Default-Broker'] = {'broks' : {}, 'has_full_broks' : False}
+        self.sched.fill_initial_broks('Default-Broker')
+        self.update_broker()
+        self.lql_thread = threading.Thread(target=self.livestatus_broker.main_thread_run, name='lqlthread')
+        self.lql_thread.start()
+        t0 = time.time()
+        while not self.livestatus_broker.listeners:
+            if time.time() - t0 > 10:
+                self.livestatus_broker.interrupted = True
+                raise RuntimeError('Livestatus listening thread should have created its input socket(s) quite quickly !!')
+            time.sleep(0.5)
+
+    def connect(self, unix=False):
+        if unix:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(self.modconf.socket)
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.connect((self.modconf.host, int(self.modconf.port)))
+        s.settimeout(30)
+        return s
+
+    def recv_exactly(self, s, size):
+        data = []
+        while size:
+            chunk = s.recv(size)
+            if not chunk:
+                break
+            data.append(chunk)
+            size -= len(chunk)
+        return b''.join(data)
+
+    def recv_fixed16(self, s):
+        ''' :return: the status code and the body of a fixed16 response '''
+        header = self.recv_exactly(s, 16)
+        self.assertEqual(16, len(header))
+        code, length = header.split()
+        body = self.recv_exactly(s, int(length))
+        self.assertEqual(int(length), len(body))
+        return int(code), body
+
+    def test_fixed16(self):
+        s = self.connect()
+        try:
+            s.sendall(b'GET hosts\nColumns: name\nFilter: name = test_host_0\nResponseHeader: fixed16\n\n')
+            self.assertEqual((200, b'test_host_0\n'), self.recv_fixed16(s))
+            # the connection is closed after a request without KeepAlive
+            self.assertEqual(b'', s.recv(16))
+        finally:
+            s.close()
+
+        s = self.connect(unix=True)
+        try:
+            s.sendall(b'GET nosuchtable\nResponseHeader: fixed16\n\n')
+            code, body = self.recv_fixed16(s)
+            self.assertNotEqual(200, code)
+        finally:
+            s.close()
+
+    def test_keepalive(self):
+        s = self.connect()
+        try:
+            for i in range(3):
+                s.sendall(b'GET hosts\nColumns: name\nFilter: name = test_host_0\n'
+                          b'KeepAlive: on\nResponseHeader: fixed16\n\n')
+                self.assertEqual((200, b'test_host_0\n'), self.recv_fixed16(s))
+            # pipelined requests are answered in order on the same connection
+            s.sendall(b'GET hosts\nColumns: name\nFilter: name = test_host_0\nKeepAlive: on\nResponseHeader: fixed16\n\n'
+                      b'GET hosts\nColumns: name state\nFilter: name = test_host_0\nKeepAlive: on\nResponseHeader: fixed16\n\n')
+            self.assertEqual((200, b'test_host_0\n'), self.recv_fixed16(s))
+            self.assertEqual((200, b'test_host_0;0\n'), self.recv_fixed16(s))
+        finally:
+            s.close()
+
+    def test_wait_condition(self):
+        s = self.connect()
+        try:
+            t0 = time.time()
+            s.sendall(b'GET hosts\nWaitObject: test_host_0\nWaitCondition: name = test_host_0\nWaitTimeout: 10000\n'
+                      b'Columns: name\nFilter: name = test_host_0\nKeepAlive: on\nResponseHeader: fixed16\n\n')
+            self.assertEqual((200, b'test_host_0\n'), self.recv_fixed16(s))
+            # the condition is fulfilled, no need to wait for the timeout
+            self.assertLess(time.time() - t0, 5)
+        finally:
+            s.close()
+
+    def test_wait_timeout(self):
+        s = self.connect()
+        try:
+            t0 = time.time()
+            s.sendall(b'GET hosts\nWaitObject: test_host_0\nWaitCondition: last_check >= %d\nWaitTimeout: 2000\n'
+                      b'Columns: name\nFilter: name = test_host_0\nKeepAlive: on\nResponseHeader: fixed16\n\n'
+                      % (time.time() + 3600))
+            # a request of another client is served meanwhile
+            other = self.connect()
+            try:
+                other.sendall(b'GET hosts\nColumns: name\nFilter: name = test_host_0\nResponseHeader: fixed16\n\n')
+                self.assertEqual((200, b'test_host_0\n'), self.recv_fixed16(other))
+            finally:
+                other.close()
+            self.assertLess(time.time() - t0, 2)
+            self.assertEqual((200, b'test_host_0\n'), self.recv_fixed16(s))
+            self.assertGreaterEqual(time.time() - t0, 2)
+        finally:
+            s.close()
+
+    def test_wait_client_left(self):
+        server = self.livestatus_broker.event_server
+        s = self.connect(unix=True)
+        s.sendall(b'GET hosts\nWaitObject: test_host_0\nWaitCondition: last_check >= %d\n'
+                  b'Columns: name\nFilter: name = test_host_0\nResponseHeader: fixed16\n\n'
+                  % (time.time() + 3600))
+        time.sleep(1)
+        self.assertEqual(1, len(server.connections))
+        # without WaitTimeout, the parked query is dropped once the client left
+        s.close()
+        t0 = time.time()
+        while server.connections and time.time() - t0 < 10:
+            time.sleep(0.5)
+        self.assertEqual({}, server.connections)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -43,6 +43,9 @@ ColumnHeaders: off
         self.assertEqual(2, len(response), 'should contains Wait + Query')
         self.assertIsInstance(response[0], LiveStatusWaitQuery)
         self.assertIsInstance(response[1], LiveStatusQuery)
+        # WaitObject: and WaitCondition: make one compiled filter
+        self.assertIsNotNone(response[0].compiled_filters['filter_stack'].factory)
+        self.assertEqual(1, response[0].filter_stack.qsize())
 
 
 